@@ -150,3 +150,452 @@ CREATE TABLE IF NOT EXISTS comments (
 
 ALTER TABLE comments
 ALTER COLUMN race DROP NOT NULL;
+
+-- Records how each ingest_run stored its results in ap_result: 'full' if it
+-- wrote every row, 'delta' if it only wrote the rows that changed since the
+-- last stored value for that elex_id, or NULL if it didn't write anything.
+ALTER TABLE ingest_run
+ADD COLUMN IF NOT EXISTS ap_result_mode TEXT;
+
+-- Before we had delta storage, every ingest that wrote to ap_result wrote a
+-- full snapshot on the 15-minute waypoint
+UPDATE ingest_run
+SET ap_result_mode = 'full'
+WHERE ap_result_mode IS NULL
+  AND waypoint_15_dt IS NOT NULL
+  AND EXISTS (SELECT 1 FROM ap_result WHERE ap_result.ingest_id = ingest_run.ingest_id);
+
+-- The last stored values for each elex_id, used to work out which rows have
+-- changed when storing deltas
+CREATE TABLE IF NOT EXISTS ap_result_latest (
+  elex_id TEXT PRIMARY KEY,
+  -- The ingest that last stored a changed value for this elex_id
+  ingest_id INTEGER NOT NULL REFERENCES ingest_run(ingest_id) ON DELETE CASCADE,
+  votecount INTEGER,
+  winner BOOLEAN,
+  electwon INTEGER
+);
+
+-- Rebuilds the full set of ap_result rows as of the given ingest: starting
+-- from the most recent full snapshot at or before that ingest, take the latest
+-- stored row for each elex_id. Rows keep the ingest_id they were stored with.
+CREATE OR REPLACE FUNCTION ap_result_snapshot(snapshot_ingest_id INTEGER)
+RETURNS SETOF ap_result AS $$
+  SELECT DISTINCT ON (ap_result.elex_id) ap_result.*
+  FROM ap_result
+  WHERE ap_result.ingest_id <= snapshot_ingest_id
+    AND ap_result.ingest_id >= (
+      SELECT MAX(ingest_id)
+      FROM ingest_run
+      WHERE ingest_id <= snapshot_ingest_id
+        AND ap_result_mode = 'full'
+    )
+  ORDER BY ap_result.elex_id, ap_result.ingest_id DESC
+$$ LANGUAGE SQL STABLE;
+
+-- Stores a fingerprint of the inputs to the last successful run of each
+-- export (e.g. "national" or "states/MA"), so we can skip exports when
+-- nothing has changed
+CREATE TABLE IF NOT EXISTS export_fingerprint (
+  export_name TEXT PRIMARY KEY,
+  fingerprint TEXT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- ap_result is partitioned by ranges of ingest_id, so that indexes and vacuums
+-- only ever have to deal with the recent partitions, old results can be
+-- detached and archived (see enip_backend/ingest/partitions.py), and queries
+-- that only look at recent ingests can skip the older partitions entirely.
+-- Each partition is named ap_result_<start>_<end> and holds the ingest_ids
+-- from start (inclusive) to end (exclusive).
+--
+-- Postgres can't partition an existing table, so if ap_result isn't
+-- partitioned yet we rename it, create the partitioned table, and attach the
+-- old table as the first partition (or drop it, if it's empty).
+DO $$
+DECLARE
+  legacy_end INTEGER;
+  legacy_name TEXT;
+BEGIN
+  IF (SELECT relkind FROM pg_class WHERE oid = 'ap_result'::regclass) = 'p' THEN
+    RETURN;
+  END IF;
+
+  -- ap_result_snapshot returns ap_result rows, so it would hold on to the old
+  -- table. We recreate it below.
+  DROP FUNCTION IF EXISTS ap_result_snapshot(INTEGER);
+
+  SELECT COALESCE(MAX(ingest_id), 0) + 1 INTO legacy_end FROM ingest_run;
+  legacy_name := format('ap_result_1_%s', legacy_end);
+
+  ALTER TABLE ap_result RENAME TO ap_result_unpartitioned;
+  EXECUTE format('ALTER INDEX ap_result_pkey RENAME TO %I', legacy_name || '_pkey');
+
+  -- New partitions only get the primary key index
+  CREATE TABLE ap_result (
+    LIKE ap_result_unpartitioned INCLUDING DEFAULTS,
+    PRIMARY KEY (ingest_id, elex_id),
+    FOREIGN KEY (ingest_id) REFERENCES ingest_run(ingest_id) ON DELETE CASCADE
+  ) PARTITION BY RANGE (ingest_id);
+
+  IF EXISTS (SELECT 1 FROM ap_result_unpartitioned) THEN
+    EXECUTE format('ALTER TABLE ap_result_unpartitioned RENAME TO %I', legacy_name);
+    EXECUTE format(
+      'ALTER TABLE ap_result ATTACH PARTITION %I FOR VALUES FROM (1) TO (%s)',
+      legacy_name,
+      legacy_end
+    );
+  ELSE
+    DROP TABLE ap_result_unpartitioned;
+  END IF;
+END
+$$;
+
+-- Same as above, for the partitioned ap_result. Because this is inlined into
+-- the calling query, the ingest_id bounds let Postgres skip the partitions
+-- from before the last full snapshot.
+CREATE OR REPLACE FUNCTION ap_result_snapshot(snapshot_ingest_id INTEGER)
+RETURNS SETOF ap_result AS $$
+  SELECT DISTINCT ON (ap_result.elex_id) ap_result.*
+  FROM ap_result
+  WHERE ap_result.ingest_id <= snapshot_ingest_id
+    AND ap_result.ingest_id >= (
+      SELECT MAX(ingest_id)
+      FROM ingest_run
+      WHERE ingest_id <= snapshot_ingest_id
+        AND ap_result_mode = 'full'
+    )
+  ORDER BY ap_result.elex_id, ap_result.ingest_id DESC
+$$ LANGUAGE SQL STABLE;
+
+-- Creates ap_result partitions (of partition_size ingest_ids each) so that
+-- there's a partition for the next ingest, and for the one after that. This
+-- means partitions are normally created well before they're needed, rather
+-- than in the middle of an ingest.
+CREATE OR REPLACE FUNCTION ap_result_ensure_partitions(partition_size INTEGER)
+RETURNS VOID AS $$
+DECLARE
+  next_ingest_id INTEGER;
+  partition_start INTEGER;
+BEGIN
+  -- Make sure two ingests don't try to create the same partition
+  PERFORM pg_advisory_xact_lock(hashtext('ap_result_ensure_partitions'));
+
+  SELECT COALESCE(MAX(ingest_id), 0) + 1 INTO next_ingest_id FROM ingest_run;
+
+  -- Carry on from the end of the newest partition (whether or not it's
+  -- attached), or start at the next ingest if there aren't any
+  SELECT MAX(substring(relname FROM '^ap_result_[0-9]+_([0-9]+)$')::INTEGER)
+  INTO partition_start
+  FROM pg_class
+  WHERE relkind = 'r'
+    AND relname ~ '^ap_result_[0-9]+_[0-9]+$'
+    AND pg_table_is_visible(oid);
+
+  partition_start := COALESCE(partition_start, next_ingest_id);
+
+  WHILE partition_start <= next_ingest_id + partition_size LOOP
+    EXECUTE format(
+      'CREATE TABLE %I PARTITION OF ap_result FOR VALUES FROM (%s) TO (%s)',
+      format('ap_result_%s_%s', partition_start, partition_start + partition_size),
+      partition_start,
+      partition_start + partition_size
+    );
+    partition_start := partition_start + partition_size;
+  END LOOP;
+END
+$$ LANGUAGE plpgsql;
+
+SELECT ap_result_ensure_partitions(288);
+
+-- The exports only ever look up ap_result rows by ingest_id (a range of them
+-- for the current results, and each historical waypoint for the historicals),
+-- racetypeid = 'G', level, and (for the states) statepostal. This index covers
+-- exactly that, and includes the columns the historicals need so they can be
+-- read from the index alone.
+--
+-- Once the static columns have moved to ap_candidate (see below), this is
+-- replaced by ap_result_elex_id_idx, so we skip it.
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = current_schema()
+      AND table_name = 'ap_result'
+      AND column_name = 'racetypeid'
+  ) THEN
+    RETURN;
+  END IF;
+
+  CREATE INDEX IF NOT EXISTS ap_result_results_idx
+    ON ap_result (ingest_id, level, statepostal)
+    INCLUDE (elex_id, votecount)
+    WHERE racetypeid = 'G';
+END
+$$;
+
+-- None of our queries use these, and each one slows down every COPY into
+-- ap_result. (ap_result_ingest_id_idx is covered by the primary key.)
+--
+-- When this file is re-run, the CREATE INDEX statements for these near the
+-- top either fail (most of their columns have moved to ap_candidate, below),
+-- like the ones for the old waypoint_5/10_dt columns, or recreate the index
+-- for it to be dropped again here. psql carries on past the failures (see
+-- scripts/migrate-db.sh).
+DROP INDEX IF EXISTS ap_result_statepostal_idx;
+DROP INDEX IF EXISTS ap_result_winner_idx;
+DROP INDEX IF EXISTS ap_result_reportingunitid_idx;
+DROP INDEX IF EXISTS ap_result_party_idx;
+DROP INDEX IF EXISTS ap_result_officeid_idx;
+DROP INDEX IF EXISTS ap_result_level_idx;
+DROP INDEX IF EXISTS ap_result_lastupdated_idx;
+DROP INDEX IF EXISTS ap_result_ingest_id_idx;
+
+-- The historicals look up the waypoint ingests in a range of ingest_dt
+CREATE INDEX IF NOT EXISTS ingest_run_waypoint_60_ingest_dt_idx
+  ON ingest_run (ingest_dt)
+  INCLUDE (ingest_id, waypoint_60_dt)
+  WHERE waypoint_60_dt IS NOT NULL;
+
+-- The columns of ap_result that don't change from ingest to ingest (the
+-- candidate, race, and reporting unit) are stored once per elex_id in
+-- ap_candidate rather than being repeated in every ingest's rows. ap_result
+-- keeps the counts. The ingester upserts an ap_candidate row whenever any of
+-- its columns change.
+CREATE TABLE IF NOT EXISTS ap_candidate (
+  elex_id TEXT PRIMARY KEY,
+  -- A hash of the columns below (computed by the ingester), so it can tell
+  -- which rows have changed without reading them all back
+  static_hash TEXT NOT NULL,
+  -- The ingest that last changed this row
+  ingest_id INTEGER NOT NULL,
+
+  raceid INTEGER,
+  racetype TEXT,
+  racetypeid TEXT,
+  ballotorder INTEGER,
+  candidateid INTEGER,
+  description TEXT,
+  delegatecount INTEGER,
+  electiondate DATE,
+  electtotal INTEGER,
+  fipscode TEXT,
+  first TEXT,
+  incumbent BOOLEAN,
+  initialization_data BOOLEAN,
+  is_ballot_measure BOOLEAN,
+  last TEXT,
+  level TEXT,
+  national BOOLEAN,
+  officeid TEXT,
+  officename TEXT,
+  party TEXT,
+  polid INTEGER,
+  polnum INTEGER,
+  reportingunitid TEXT,
+  reportingunitname TEXT,
+  runoff BOOLEAN,
+  seatname TEXT,
+  seatnum INTEGER,
+  statename TEXT,
+  statepostal TEXT,
+  test BOOLEAN,
+  uncontested BOOLEAN
+);
+
+-- The exports look up the candidates by racetypeid = 'G', level, and (for the
+-- states) statepostal
+CREATE INDEX IF NOT EXISTS ap_candidate_results_idx
+  ON ap_candidate (level, statepostal)
+  WHERE racetypeid = 'G';
+
+-- Move the static columns out of ap_result. The migrated rows get an empty
+-- static_hash, so the next ingest rewrites them. Dropping the columns doesn't
+-- rewrite the existing partitions: that space is reclaimed when they're
+-- archived.
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = current_schema()
+      AND table_name = 'ap_result'
+      AND column_name = 'raceid'
+  ) THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO ap_candidate (
+      elex_id,
+      static_hash,
+      ingest_id,
+      raceid,
+      racetype,
+      racetypeid,
+      ballotorder,
+      candidateid,
+      description,
+      delegatecount,
+      electiondate,
+      electtotal,
+      fipscode,
+      first,
+      incumbent,
+      initialization_data,
+      is_ballot_measure,
+      last,
+      level,
+      national,
+      officeid,
+      officename,
+      party,
+      polid,
+      polnum,
+      reportingunitid,
+      reportingunitname,
+      runoff,
+      seatname,
+      seatnum,
+      statename,
+      statepostal,
+      test,
+      uncontested
+  )
+  SELECT DISTINCT ON (elex_id)
+      elex_id,
+      '',
+      ingest_id,
+      raceid,
+      racetype,
+      racetypeid,
+      ballotorder,
+      candidateid,
+      description,
+      delegatecount,
+      electiondate,
+      electtotal,
+      fipscode,
+      first,
+      incumbent,
+      initialization_data,
+      is_ballot_measure,
+      last,
+      level,
+      national,
+      officeid,
+      officename,
+      party,
+      polid,
+      polnum,
+      reportingunitid,
+      reportingunitname,
+      runoff,
+      seatname,
+      seatnum,
+      statename,
+      statepostal,
+      test,
+      uncontested
+  FROM ap_result
+  ORDER BY elex_id, ingest_id DESC
+  ON CONFLICT (elex_id) DO NOTHING;
+
+  DROP INDEX IF EXISTS ap_result_results_idx;
+
+  ALTER TABLE ap_result
+      DROP COLUMN raceid,
+      DROP COLUMN racetype,
+      DROP COLUMN racetypeid,
+      DROP COLUMN ballotorder,
+      DROP COLUMN candidateid,
+      DROP COLUMN description,
+      DROP COLUMN delegatecount,
+      DROP COLUMN electiondate,
+      DROP COLUMN electtotal,
+      DROP COLUMN fipscode,
+      DROP COLUMN first,
+      DROP COLUMN incumbent,
+      DROP COLUMN initialization_data,
+      DROP COLUMN is_ballot_measure,
+      DROP COLUMN last,
+      DROP COLUMN level,
+      DROP COLUMN national,
+      DROP COLUMN officeid,
+      DROP COLUMN officename,
+      DROP COLUMN party,
+      DROP COLUMN polid,
+      DROP COLUMN polnum,
+      DROP COLUMN reportingunitid,
+      DROP COLUMN reportingunitname,
+      DROP COLUMN runoff,
+      DROP COLUMN seatname,
+      DROP COLUMN seatnum,
+      DROP COLUMN statename,
+      DROP COLUMN statepostal,
+      DROP COLUMN test,
+      DROP COLUMN uncontested;
+END
+$$;
+
+-- The exports read the counts for a set of elex_ids from a range of ingests
+-- (the current results), or from each historical waypoint. Along with the
+-- primary key, this lets them do either with an index scan, and the
+-- historicals can be read from the index alone.
+CREATE INDEX IF NOT EXISTS ap_result_elex_id_idx
+  ON ap_result (elex_id, ingest_id)
+  INCLUDE (votecount);
+
+-- The vote count history the exports show: a row for each hourly waypoint
+-- where an elex_id's votecount differs from its previous waypoint. The
+-- ingester appends to this on every waypoint_60 ingest, so reading the
+-- history costs as much as the number of changes rather than a scan of every
+-- stored ap_result row.
+CREATE TABLE IF NOT EXISTS ap_result_history (
+  elex_id TEXT NOT NULL,
+  waypoint_60_dt TIMESTAMPTZ NOT NULL,
+  -- The ingest that stored this count
+  ingest_id INTEGER NOT NULL REFERENCES ingest_run(ingest_id) ON DELETE CASCADE,
+  votecount INTEGER,
+  PRIMARY KEY (elex_id, waypoint_60_dt)
+);
+
+-- Backfill the history from the waypoint_60 snapshots already in ap_result,
+-- if we haven't yet
+INSERT INTO ap_result_history (elex_id, waypoint_60_dt, ingest_id, votecount)
+SELECT elex_id, waypoint_60_dt, ingest_id, votecount
+FROM (
+  SELECT
+      ap_result.elex_id,
+      ingest_run.waypoint_60_dt,
+      ap_result.ingest_id,
+      ap_result.votecount,
+      LAG(ap_result.votecount) OVER waypoints AS previous_votecount,
+      ROW_NUMBER() OVER waypoints AS n
+  FROM ap_result
+  JOIN ingest_run ON ingest_run.ingest_id = ap_result.ingest_id
+  WHERE ingest_run.waypoint_60_dt IS NOT NULL
+  WINDOW waypoints AS (
+    PARTITION BY ap_result.elex_id ORDER BY ingest_run.waypoint_60_dt
+  )
+) changes
+WHERE (n = 1 OR votecount IS DISTINCT FROM previous_votecount)
+  AND NOT EXISTS (SELECT 1 FROM ap_result_history)
+ON CONFLICT DO NOTHING;
+
+-- The historicals read every change for a set of elex_ids. Each waypoint
+-- appends its changes to the end of ap_result_history, so an elex_id's rows
+-- are spread across the whole table; this lets them be read from the index
+-- alone instead.
+CREATE INDEX IF NOT EXISTS ap_result_history_elex_id_idx
+  ON ap_result_history (elex_id, waypoint_60_dt)
+  INCLUDE (ingest_id, votecount);
+
+-- Deltas are stored when any of the counts differ from the last stored ones
+-- (not just votecount, winner or electwon), so the full results can be
+-- rebuilt exactly. The rows from before these columns were added will differ
+-- from the next ingest's, so it stores every row again.
+ALTER TABLE ap_result_latest
+  ADD COLUMN IF NOT EXISTS lastupdated TIMESTAMPTZ,
+  ADD COLUMN IF NOT EXISTS precinctsreporting INTEGER,
+  ADD COLUMN IF NOT EXISTS precinctsreportingpct DOUBLE PRECISION,
+  ADD COLUMN IF NOT EXISTS precinctstotal INTEGER,
+  ADD COLUMN IF NOT EXISTS votepct DOUBLE PRECISION;
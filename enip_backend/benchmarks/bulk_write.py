@@ -0,0 +1,143 @@
+import logging
+import time
+from datetime import datetime, timezone
+
+from ..enip_common.pg import bulk_insert, bulk_update, get_cursor
+from ..enip_common.states import PRESIDENTIAL_REPORTING_UNITS
+from ..ingest.run import _calls_on_conflict
+
+# Compares executemany (one statement, and so one round trip, per row) with
+# the multi-row bulk_insert and bulk_update helpers, for the calls and
+# comments writes. Uses scratch copies of the tables (which are rolled back),
+# so it's safe to run against a local Postgres with the schema from
+# db/init.sql.
+#
+# Run with: pipenv run python -m enip_backend.benchmarks.bulk_write
+N_COMMENTS = 500
+ITERATIONS = 5
+
+
+def time_it(fn):
+    start = time.monotonic()
+    for _ in range(ITERATIONS):
+        fn()
+    return (time.monotonic() - start) / ITERATIONS
+
+
+def benchmark_calls(cursor):
+    cursor.execute(
+        "CREATE TEMPORARY TABLE bench_calls (LIKE president_calls INCLUDING ALL) ON COMMIT DROP"
+    )
+    cursor.execute(
+        "INSERT INTO bench_calls (state) SELECT unnest(%s::text[])",
+        [sorted(PRESIDENTIAL_REPORTING_UNITS)],
+    )
+
+    # Alternate the calls so every write actually changes something
+    calls = iter(["Dem", "GOP"] * ITERATIONS * 2)
+
+    def rows():
+        call = next(calls)
+        return [(state, call) for state in sorted(PRESIDENTIAL_REPORTING_UNITS)]
+
+    def upsert_executemany():
+        cursor.executemany(
+            f"""
+            INSERT INTO bench_calls (state, ap_call, ap_called_at)
+            VALUES (%s, %s, NOW())
+            {_calls_on_conflict("bench_calls")}
+            """,
+            rows(),
+        )
+
+    def upsert_bulk():
+        bulk_insert(
+            cursor,
+            "bench_calls",
+            ["state", "ap_call", "ap_called_at"],
+            rows(),
+            on_conflict=_calls_on_conflict("bench_calls"),
+            template="(%s, %s, NOW())",
+        )
+
+    published = iter([True, False] * ITERATIONS * 2)
+
+    def published_rows():
+        value = next(published)
+        return [(state, value) for state in sorted(PRESIDENTIAL_REPORTING_UNITS)]
+
+    def update_executemany():
+        cursor.executemany(
+            "UPDATE bench_calls SET published = %s WHERE state = %s",
+            [(value, state) for state, value in published_rows()],
+        )
+
+    def update_bulk():
+        bulk_update(cursor, "bench_calls", ["state", "published"], published_rows())
+
+    n = len(PRESIDENTIAL_REPORTING_UNITS)
+    for name, fn in [
+        ("calls upsert, executemany", upsert_executemany),
+        ("calls upsert, bulk_insert", upsert_bulk),
+        ("publish update, executemany", update_executemany),
+        ("publish update, bulk_update", update_bulk),
+    ]:
+        logging.info(f"  {name} ({n} rows): {time_it(fn) * 1000:.1f}ms")
+
+
+def benchmark_comments(cursor):
+    cursor.execute(
+        "CREATE TEMPORARY TABLE bench_comments (LIKE comments INCLUDING ALL) ON COMMIT DROP"
+    )
+    ts = datetime(2020, 11, 3, 20, 0, tzinfo=timezone.utc)
+    rows = [
+        {
+            "ts": ts,
+            "submitted_by": "Benchmark",
+            "office_id": "P",
+            "race": "PA",
+            "title": f"Comment {i}",
+            "body": "Lorem ipsum dolor sit amet " * 10,
+        }
+        for i in range(N_COMMENTS)
+    ]
+
+    def insert_executemany():
+        cursor.execute("DELETE FROM bench_comments")
+        cursor.executemany(
+            """
+            INSERT INTO bench_comments (ts, submitted_by, office_id, race, title, body)
+            VALUES  (%(ts)s, %(submitted_by)s, %(office_id)s, %(race)s, %(title)s, %(body)s)
+            """,
+            rows,
+        )
+
+    def insert_bulk():
+        cursor.execute("DELETE FROM bench_comments")
+        bulk_insert(
+            cursor,
+            "bench_comments",
+            ["ts", "submitted_by", "office_id", "race", "title", "body"],
+            rows,
+            template="(%(ts)s, %(submitted_by)s, %(office_id)s, %(race)s, %(title)s, %(body)s)",
+        )
+
+    for name, fn in [
+        ("comments, executemany", insert_executemany),
+        ("comments, bulk_insert", insert_bulk),
+    ]:
+        logging.info(f"  {name} ({N_COMMENTS} rows): {time_it(fn) * 1000:.1f}ms")
+
+
+def run_benchmark():
+    with get_cursor() as cursor:
+        benchmark_calls(cursor)
+        benchmark_comments(cursor)
+
+        # Don't leave any trace
+        cursor.connection.rollback()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark()
@@ -0,0 +1,96 @@
+import logging
+import sys
+import time
+
+from ..enip_common.pg import IteratorFile, binary_copy_chunks, get_cursor
+from ..ingest import apjson
+from ..ingest.apapi import (
+    COPY_BINARY_ENCODERS,
+    COPY_CHUNK_SIZE,
+    COPY_COLUMNS,
+    csv_chunks,
+    get_count_values,
+    get_row_values,
+)
+
+# Compares the CSV and binary COPY formats for the ap_result rows from a
+# recorded AP results payload: how long it takes us to serialize them, how big
+# the output is, and (with --postgres) how long Postgres takes to COPY them
+# into a scratch copy of ap_result (which is rolled back), so it's safe to run
+# against a local Postgres with the schema from db/init.sql.
+#
+# Run with:
+#   pipenv run python -m enip_backend.benchmarks.copy_format path/to/ap.json [--postgres]
+ITERATIONS = 5
+
+
+def load_rows(path):
+    with open(path, "r") as f:
+        text = f.read()
+    return [
+        (1,) + get_count_values(get_row_values(result))
+        for result in apjson.parse_results(text)
+    ]
+
+
+FORMATS = {
+    "csv": (
+        "DELIMITER AS ','  CSV HEADER",
+        lambda rows: csv_chunks(COPY_COLUMNS, rows),
+    ),
+    "binary": (
+        "(FORMAT binary)",
+        lambda rows: binary_copy_chunks(COPY_BINARY_ENCODERS, rows, COPY_CHUNK_SIZE),
+    ),
+}
+
+
+def time_it(fn):
+    start = time.monotonic()
+    for _ in range(ITERATIONS):
+        fn()
+    return (time.monotonic() - start) / ITERATIONS
+
+
+def benchmark_encode(rows):
+    for name, (_, chunks) in FORMATS.items():
+        size = sum(len(chunk) for chunk in chunks(rows))
+        seconds = time_it(lambda: sum(1 for _ in chunks(rows)))
+        logging.info(
+            f"  {name} encode ({len(rows)} rows): {seconds * 1000:.1f}ms, {size / 1024:.1f}KB"
+        )
+
+
+def benchmark_copy(rows):
+    with get_cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE bench_ap_result (LIKE ap_result) ON COMMIT DROP"
+        )
+
+        for name, (options, chunks) in FORMATS.items():
+
+            def copy():
+                cursor.execute("TRUNCATE bench_ap_result")
+                cursor.copy_expert(
+                    sql=f"COPY bench_ap_result ({','.join(COPY_COLUMNS)}) FROM stdin WITH {options};",
+                    file=IteratorFile(chunks(rows)),
+                )
+
+            logging.info(
+                f"  {name} COPY ({len(rows)} rows): {time_it(copy) * 1000:.1f}ms"
+            )
+
+        # Don't leave any trace
+        cursor.connection.rollback()
+
+
+def run_benchmark(path, postgres):
+    rows = load_rows(path)
+    benchmark_encode(rows)
+    if postgres:
+        benchmark_copy(rows)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark(sys.argv[1], "--postgres" in sys.argv[2:])
@@ -0,0 +1,95 @@
+import csv
+import io
+import logging
+import sys
+import timeit
+
+from elex.api.models import Election
+
+from ..export.helpers import sqlrecord_from_dict
+from ..ingest.apapi import (
+    AP_RESULT_COLUMNS,
+    OFFICE_IDS,
+    ap_result_values,
+    record_from_row,
+)
+
+# Compares the per-row cost of extracting records from elex results with
+# obj.serialize() (the old approach) vs. reading attributes directly, over a
+# recorded AP payload (e.g. one saved with `elex results 2020-11-03 -o json`
+# or a raw response from the AP elections API).
+#
+# Run with:
+#   pipenv run python -m enip_backend.benchmarks.ingest_extract path/to/ap.json
+ITERATIONS = 3
+RETURN_LEVELS = {"county"}
+
+
+def extract_serialize(results, filter_levels=None):
+    writer = csv.writer(io.StringIO())
+    records = []
+    for obj in results:
+        row = obj.serialize()
+        row["ingest_id"] = -1
+        row["elex_id"] = row["id"]
+        del row["id"]
+
+        if filter_levels and row["level"] not in filter_levels:
+            continue
+
+        writer.writerow(row.values())
+        if row["level"] in RETURN_LEVELS:
+            records.append(sqlrecord_from_dict(row))
+
+    return records
+
+
+def extract_attributes(results, filter_levels=None):
+    writer = csv.writer(io.StringIO())
+    records = []
+    for obj in results:
+        level = obj.level
+        if filter_levels and level not in filter_levels:
+            continue
+
+        row = (obj.id,) + ap_result_values(obj)
+        writer.writerow((-1,) + row)
+        if level in RETURN_LEVELS:
+            records.append(record_from_row(row, -1))
+
+    return records
+
+
+def run_benchmark(path):
+    results = Election(
+        datafile=path,
+        resultslevel="ru",
+        officeids=OFFICE_IDS,
+        setzerocounts=False,
+    ).results
+    logging.info(f"Benchmarking with {len(results)} results from {path}")
+
+    # Make sure the fast path produces the same records and CSV columns
+    assert extract_serialize(results) == extract_attributes(results)
+    assert set(AP_RESULT_COLUMNS) == set(results[0].serialize().keys()) - {"id"} | {
+        "ingest_id",
+        "elex_id",
+    }
+
+    for filter_levels in [None, ["district"]]:
+        for name, fn in [
+            ("serialize()", extract_serialize),
+            ("attributes", extract_attributes),
+        ]:
+            elapsed = (
+                timeit.timeit(lambda: fn(results, filter_levels), number=ITERATIONS)
+                / ITERATIONS
+            )
+            logging.info(
+                f"  {name} (filter_levels={filter_levels}): {elapsed * 1e6 / len(results):.2f}us per row"
+            )
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark(sys.argv[1])
@@ -0,0 +1,68 @@
+import logging
+import sys
+import time
+import tracemalloc
+
+from elex.api.models import Election
+
+from ..ingest import apjson
+from ..ingest.apapi import ap_result_values, get_row_values
+
+# Compares the time and peak memory of turning a recorded AP results payload
+# into rows with elex (which builds model objects for every result before
+# returning any of them) vs. our streaming parser in ingest/apjson.py.
+#
+# Run with:
+#   pipenv run python -m enip_backend.benchmarks.ingest_parse path/to/ap.json
+
+
+def rows_elex(path):
+    results = Election(datafile=path, setzerocounts=False).results
+    return [(obj.id,) + ap_result_values(obj) for obj in results]
+
+
+def rows_direct(path):
+    with open(path, "r") as f:
+        text = f.read()
+    return [get_row_values(result) for result in apjson.parse_results(text)]
+
+
+def count_rows_direct(path):
+    # How we actually consume the parser: one row at a time, without keeping
+    # them all
+    with open(path, "r") as f:
+        text = f.read()
+    return sum(1 for _ in apjson.parse_results(text))
+
+
+def measure(fn, path):
+    tracemalloc.start()
+    start = time.monotonic()
+    result = fn(path)
+    elapsed = time.monotonic() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_benchmark(path):
+    elex_rows, _, _ = measure(rows_elex, path)
+    direct_rows, _, _ = measure(rows_direct, path)
+    assert elex_rows == direct_rows
+    logging.info(f"Benchmarking with {len(elex_rows)} results from {path}")
+    del elex_rows, direct_rows
+
+    for name, fn in [
+        ("elex", rows_elex),
+        ("direct", rows_direct),
+        ("direct (streaming)", count_rows_direct),
+    ]:
+        _, elapsed, peak = measure(fn, path)
+        logging.info(
+            f"  {name}: {elapsed:.2f}s, peak memory {peak / 1024 / 1024:.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark(sys.argv[1])
@@ -0,0 +1,62 @@
+import logging
+import timeit
+import tracemalloc
+
+from ..export.helpers import SQLRecord, partition_by_state
+from ..export.table import IngestTable
+from .state_partition import make_county_records
+
+# Compares the memory use and partitioning time of county-level results held
+# as a list of SQLRecords vs. an IngestTable.
+#
+# Run with: pipenv run python -m enip_backend.benchmarks.ingest_table
+ITERATIONS = 5
+
+
+def copy_strings(records):
+    """
+    Records parsed from the AP's JSON have their own copy of every string, so
+    we copy the (shared) strings in the generated records to match
+    """
+    return [
+        SQLRecord(
+            *(
+                value.encode().decode() if isinstance(value, str) else value
+                for value in record
+            )
+        )
+        for record in records
+    ]
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, size
+
+
+def run_benchmark():
+    records, list_size = measure_memory(lambda: copy_strings(make_county_records()))
+    table, table_size = measure_memory(lambda: IngestTable.from_records(records))
+    logging.info(f"Benchmarking with {len(records)} county records")
+
+    # The list size includes the records themselves, and the table has to be
+    # built from them, so measure the list without the table in memory
+    for name, data, size in [
+        ("list of SQLRecords", records, list_size),
+        ("IngestTable", table, table_size),
+    ]:
+        elapsed = (
+            timeit.timeit(lambda: partition_by_state(data), number=ITERATIONS)
+            / ITERATIONS
+        )
+        logging.info(
+            f"  {name}: {size / 1024 / 1024:.1f}MB, partition by state in {elapsed * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark()
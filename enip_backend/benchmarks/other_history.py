@@ -0,0 +1,193 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from ..enip_common.states import STATES
+from ..export import helpers, historicals_cache, history_grid, structs
+from ..export.helpers import SQLRecord, compact_historicals, handle_candidate_results
+from ..export.historicals_cache import CachedHistoricals
+from ..export.history_grid import OtherHistories
+from ..export.state import StateDataExporter
+
+# Compares adding up the "other" candidates' histories one candidate at a time
+# (as handle_candidate_results does with EXPORT_NUMPY_HISTORIES off) with adding them up on a
+# common waypoint grid with NumPy (see EXPORT_NUMPY_HISTORIES), over a
+# synthetic full county snapshot where each candidate's count changes every
+# hour. Reports the time spent on the "other" rollups in every state export,
+# and the time for the state exports end to end (which also checks that
+# their output matches), with both POP_VOTE_HISTORY_FORMATs.
+#
+# Run with: pipenv run python -m enip_backend.benchmarks.other_history
+COUNTIES_PER_STATE = 60
+OFFICE_IDS = ["P", "S", "H"]
+# The leading Dem and GOP candidates, then the ones in the "other" bucket
+PARTIES = ["Dem", "GOP", "Lib", "Grn", "Ind", "Dem"]
+N_WAYPOINTS = 48
+ITERATIONS = 3
+
+START = datetime(2020, 11, 3, 12, 0, tzinfo=timezone.utc)
+
+
+def make_county_snapshot():
+    records = []
+    historical_counts = {}
+    waypoints = [str(START + timedelta(hours=i)) for i in range(N_WAYPOINTS)]
+
+    for state in sorted(STATES):
+        for county in range(COUNTIES_PER_STATE):
+            fipscode = f"{state}{county:03}"
+            for officeid in OFFICE_IDS:
+                for candidate, party in enumerate(PARTIES):
+                    elex_id = f"{fipscode}-{officeid}-{candidate}"
+                    records.append(
+                        SQLRecord(
+                            ingest_id=-1,
+                            elex_id=elex_id,
+                            statepostal=state,
+                            fipscode=fipscode,
+                            level="county",
+                            reportingunitname=None,
+                            officeid=officeid,
+                            seatnum=1 if officeid == "H" else None,
+                            party=party,
+                            first="Foo",
+                            last="Barson",
+                            electtotal=0,
+                            electwon=0,
+                            votecount=N_WAYPOINTS * (len(PARTIES) - candidate),
+                            votepct=0.0,
+                            winner=False,
+                        )
+                    )
+                    historical_counts[elex_id] = {
+                        waypoint: i * (len(PARTIES) - candidate)
+                        for i, waypoint in enumerate(waypoints)
+                    }
+
+    return records, historical_counts
+
+
+def rollup_other_histories(records_by_state, historical_counts, use_numpy):
+    """
+    Runs each state's non-leading candidates through handle_candidate_results,
+    and returns how long that took and the "other" histories
+    """
+    leading_dem = structs.StateSummaryCandidateNamed(
+        first_name="Foo", last_name="Barson", pop_vote=0, pop_pct=0.0
+    )
+
+    elapsed = 0.0
+    histories = {}
+    for state in sorted(STATES):
+        other_records = [
+            record
+            for record in records_by_state.get(state, [])
+            if not record.elex_id.endswith(("-0", "-1"))
+        ]
+        results = {
+            (record.fipscode, record.officeid): structs.CountyCongressionalResult(
+                dem=leading_dem
+            )
+            for record in other_records
+        }
+
+        start = time.monotonic()
+        other_histories = (
+            OtherHistories.for_historicals(historical_counts) if use_numpy else None
+        )
+        for record in other_records:
+            handle_candidate_results(
+                results[(record.fipscode, record.officeid)],
+                structs.StateSummaryCandidateNamed,
+                record,
+                historical_counts,
+                other_histories=other_histories,
+            )
+        if other_histories:
+            other_histories.finish()
+        elapsed += time.monotonic() - start
+
+        for key, result in results.items():
+            histories[key] = result.oth.pop_vote_history
+
+    return elapsed, histories
+
+
+def export_all_states(records_by_state, historical_counts):
+    # Like export_all_states in export/run.py, each state gets its share of
+    # the historicals, and the grid for all of them
+    historicals_by_state = helpers.partition_historicals_by_state(
+        historical_counts,
+        {state: records_by_state.get(state, []) for state in STATES},
+    )
+    return {
+        state: json.loads(
+            StateDataExporter(
+                START, state, historicals_by_state[state], historical_counts
+            )
+            .run_export(records_by_state.get(state, []))
+            .json(by_alias=True)
+        )
+        for state in sorted(STATES)
+    }
+
+
+def run_benchmark():
+    records, historical_counts = make_county_snapshot()
+    records_by_state = helpers.partition_by_state(records)
+    logging.info(
+        f"Benchmarking with {len(records)} county records and {N_WAYPOINTS} waypoints"
+    )
+
+    for history_format in ["map", "compact"]:
+        helpers.POP_VOTE_HISTORY_FORMAT = history_format
+        historicals = (
+            compact_historicals(historical_counts)
+            if history_format == "compact"
+            else historical_counts
+        )
+
+        # The grids are kept for the cached historicals, so we cache ours
+        # like export_all_states would. Then we build the grid up front (the
+        # state exports share it, and it lasts as long as the cached
+        # historicals), and report how long that takes separately.
+        historicals_cache.cache.clear()
+        historicals_cache.cache[("level = 'county'", ())] = CachedHistoricals(
+            START + timedelta(hours=N_WAYPOINTS - 1), historicals
+        )
+        history_grid.grid_cache.clear()
+        start = time.monotonic()
+        history_grid.load_grid(historicals)
+        logging.info(
+            f"  {history_format}, building the grid: {(time.monotonic() - start) * 1000:.1f}ms"
+        )
+
+        rollups = {}
+        exports = {}
+        for name, use_numpy in [("per candidate", False), ("numpy", True)]:
+            history_grid.EXPORT_NUMPY_HISTORIES = use_numpy
+
+            elapsed = 0.0
+            for _ in range(ITERATIONS):
+                seconds, rollups[name] = rollup_other_histories(
+                    records_by_state, historicals, use_numpy
+                )
+                elapsed += seconds / ITERATIONS
+            logging.info(
+                f"  {history_format}, {name}, other rollups: {elapsed * 1000:.1f}ms"
+            )
+
+            start = time.monotonic()
+            exports[name] = export_all_states(records_by_state, historicals)
+            logging.info(
+                f"  {history_format}, {name}, state exports: {(time.monotonic() - start) * 1000:.1f}ms"
+            )
+
+        assert rollups["per candidate"] == rollups["numpy"]
+        assert exports["per candidate"] == exports["numpy"]
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark()
@@ -0,0 +1,82 @@
+import logging
+import time
+from datetime import datetime, timezone
+
+from ..enip_common.pg import execute_prepared, get_ro_cursor, prepare_sql
+from ..enip_common.states import STATES
+from ..export.helpers import historicals_params, historicals_query
+
+# Compares planning the state exports' historicals query from scratch for
+# every state (as cursor.execute does) with preparing it once and executing
+# the prepared statement for each state (as execute_prepared does). Reports
+# the planning time Postgres reports with EXPLAIN ANALYZE, and the wall time
+# of running the query for every state. Postgres plans the first few
+# executions of a prepared statement with the actual parameters before it
+# switches to a cached generic plan, so we run every state a few times.
+#
+# Run against a database with ingested data:
+#   pipenv run python -m enip_backend.benchmarks.prepared_statements
+ITERATIONS = 3
+STATE_FILTER = "level = 'county' AND statepostal = %s"
+
+
+def planning_ms(cursor, sql, params):
+    cursor.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", params)
+    return cursor.fetchone()[0][0]["Planning Time"]
+
+
+def benchmark_planning(cursor, query, now):
+    name, numbered_sql, n_params = prepare_sql(query)
+    cursor.execute(f"PREPARE {name} AS {numbered_sql}")
+    execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * n_params)})"
+
+    plain = prepared = 0.0
+    for _ in range(ITERATIONS):
+        for state in sorted(STATES):
+            params = historicals_params(now, [state])
+            plain += planning_ms(cursor, query, params)
+            prepared += planning_ms(cursor, execute_sql, params)
+
+    cursor.execute(f"DEALLOCATE {name}")
+
+    n = ITERATIONS * len(STATES)
+    logging.info(f"  planning, execute ({n} queries): {plain:.1f}ms")
+    logging.info(f"  planning, execute_prepared ({n} queries): {prepared:.1f}ms")
+
+
+def benchmark_wall_time(cursor, query, now):
+    def execute(state):
+        cursor.execute(query, historicals_params(now, [state]))
+        cursor.fetchall()
+
+    def execute_prepared_(state):
+        execute_prepared(cursor, query, historicals_params(now, [state]))
+        cursor.fetchall()
+
+    # Warm up the cache, so the first approach isn't penalized
+    for state in sorted(STATES):
+        execute(state)
+
+    n = ITERATIONS * len(STATES)
+    for name, fn in [("execute", execute), ("execute_prepared", execute_prepared_)]:
+        start = time.monotonic()
+        for _ in range(ITERATIONS):
+            for state in sorted(STATES):
+                fn(state)
+        logging.info(
+            f"  wall time, {name} ({n} queries): {(time.monotonic() - start) * 1000:.1f}ms"
+        )
+
+
+def run_benchmark():
+    query = historicals_query(STATE_FILTER)
+    now = datetime.now(tz=timezone.utc)
+
+    with get_ro_cursor() as cursor:
+        benchmark_planning(cursor, query, now)
+        benchmark_wall_time(cursor, query, now)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark()
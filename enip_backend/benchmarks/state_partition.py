@@ -0,0 +1,87 @@
+import logging
+import timeit
+
+from ..enip_common.states import STATES
+from ..export.helpers import SQLRecord, partition_by_state
+
+# Compares the old state export scan (every state worker walks the full
+# county-level dataset) with partitioning the dataset by state once up front.
+#
+# Run with: pipenv run python -m enip_backend.benchmarks.state_partition
+COUNTIES_PER_STATE = 60
+CANDIDATES_PER_RACE = 4
+OFFICE_IDS = ["P", "S", "H"]
+ITERATIONS = 5
+
+
+def make_county_records():
+    records = []
+    for state in sorted(STATES):
+        for county in range(COUNTIES_PER_STATE):
+            fipscode = f"{state}{county:03}"
+            for officeid in OFFICE_IDS:
+                for candidate in range(CANDIDATES_PER_RACE):
+                    records.append(
+                        SQLRecord(
+                            ingest_id=-1,
+                            elex_id=f"{fipscode}-{officeid}-{candidate}",
+                            statepostal=state,
+                            fipscode=fipscode,
+                            level="county",
+                            reportingunitname=None,
+                            officeid=officeid,
+                            seatnum=1 if officeid == "H" else None,
+                            party="Dem",
+                            first="Foo",
+                            last="Barson",
+                            electtotal=0,
+                            electwon=0,
+                            votecount=candidate,
+                            votepct=0.0,
+                            winner=False,
+                        )
+                    )
+    return records
+
+
+def scan_per_state(records):
+    """The old approach: each of the state exports filters the full list"""
+    visited = 0
+    for state in STATES:
+        for record in records:
+            visited += 1
+            if record.statepostal == state:
+                pass
+    return visited
+
+
+def scan_partitioned(records):
+    """The new approach: partition once, then each state walks its own slice"""
+    visited = len(records)
+    by_state = partition_by_state(records)
+    for state in STATES:
+        for record in by_state.get(state, []):
+            visited += 1
+            if record.statepostal == state:
+                pass
+    return visited
+
+
+def run_benchmark():
+    records = make_county_records()
+    logging.info(f"Benchmarking with {len(records)} county records")
+
+    for name, fn in [
+        ("per-state scan", scan_per_state),
+        ("partitioned scan", scan_partitioned),
+    ]:
+        visited = fn(records)
+        elapsed = timeit.timeit(lambda: fn(records), number=ITERATIONS) / ITERATIONS
+        logging.info(
+            f"  {name}: {visited} record visits ({visited / len(records):.1f} passes), {elapsed * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run_benchmark()
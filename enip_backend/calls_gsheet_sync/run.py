@@ -1,10 +1,10 @@
 import logging
 
-import psycopg2
 from dateutil.parser import parse as parse_date
 from pytz import timezone
 
-from ..enip_common.config import CALLS_GSHEET_ID, POSTGRES_URL
+from ..enip_common.config import CALLS_GSHEET_ID
+from ..enip_common.pg import bulk_update, get_cursor
 from ..enip_common.gsheets import (
     get_gsheets_client,
     get_worksheet_data,
@@ -79,12 +79,12 @@ def _update_db_published_from_sheet(cursor, table, worksheet):
         for row in sheet_data
     ]
     rows.sort(key=lambda r: r["state"])
-    statement = f"""
-    UPDATE {table}
-    SET published = %(published)s
-    WHERE state = %(state)s
-    """
-    cursor.executemany(statement, rows)
+    bulk_update(
+        cursor,
+        table,
+        ["state", "published"],
+        [(row["state"], row["published"]) for row in rows],
+    )
 
 
 def sync_calls_gsheet():
@@ -92,7 +92,7 @@ def sync_calls_gsheet():
     sheet = client.open_by_key(CALLS_GSHEET_ID)
     senate_sheet = worksheet_by_title(sheet, "Senate Calls")
     president_sheet = worksheet_by_title(sheet, "President Calls")
-    with psycopg2.connect(POSTGRES_URL) as conn, conn.cursor() as cur:
+    with get_cursor() as cur:
         logging.info("Syncing calls from the db to google sheets")
         _update_calls_sheet_from_db(cur, "senate_calls", senate_sheet)
         _update_calls_sheet_from_db(cur, "president_calls", president_sheet)
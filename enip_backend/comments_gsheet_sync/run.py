@@ -2,11 +2,11 @@ import logging
 from datetime import datetime
 from itertools import chain
 
-import psycopg2
 import sentry_sdk
 from pytz import timezone
 
-from ..enip_common.config import COMMENTS_GSHEET_ID, POSTGRES_URL
+from ..enip_common.config import COMMENTS_GSHEET_ID
+from ..enip_common.pg import bulk_insert, get_cursor
 from ..enip_common.gsheets import (
     get_gsheets_client,
     get_worksheet_data,
@@ -85,13 +85,15 @@ def sync_comments_gsheet():
     # TODO: this fails fast if any of the rows is invalid, we might want to skip instead
     db_rows = chain(*[_map_sheet_row_to_db(row) for row in data])
 
-    insert_stmt = """
-    INSERT INTO comments (ts, submitted_by, office_id, race, title, body)
-    VALUES  (%(ts)s, %(submitted_by)s, %(office_id)s, %(race)s, %(title)s, %(body)s)
-    """
-    with psycopg2.connect(POSTGRES_URL) as conn, conn.cursor() as cursor:
+    with get_cursor() as cursor:
         cursor.execute("DELETE FROM comments")
-        cursor.executemany(insert_stmt, list(db_rows))
+        bulk_insert(
+            cursor,
+            "comments",
+            ["ts", "submitted_by", "office_id", "race", "title", "body"],
+            list(db_rows),
+            template="(%(ts)s, %(submitted_by)s, %(office_id)s, %(race)s, %(title)s, %(body)s)",
+        )
     logging.info("Comments sync complete")
 
 
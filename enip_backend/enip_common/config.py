@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from environs import Env
 
 env = Env()
@@ -5,6 +7,15 @@ env.read_env()
 
 POSTGRES_URL = env("POSTGRES_URL")
 POSTGRES_RO_URL = env("POSTGRES_RO_URL", POSTGRES_URL)
+# Pooled connections that have been idle for longer than this are checked
+# before they're reused
+POSTGRES_POOL_HEALTH_CHECK_AFTER = env.float(
+    "POSTGRES_POOL_HEALTH_CHECK_AFTER_SECONDS", 30
+)
+# PREPARE the exports' repeated queries once per pooled connection, so
+# Postgres can reuse their plans. Turn this off behind a pooler (like
+# PgBouncer in transaction mode) that doesn't keep us on one session.
+POSTGRES_PREPARED_STATEMENTS = env.bool("POSTGRES_PREPARED_STATEMENTS", True)
 AP_API_KEY = env("AP_API_KEY")
 INGEST_TEST_DATA = env.bool("INGEST_TEST_DATA")
 ELECTION_DATE = env("ELECTION_DATE")
@@ -12,7 +23,66 @@ SENTRY_DSN = env("SENTRY_DSN", None)
 SENTRY_ENVIRONMENT = env("SENTRY_ENVIRONMENT", "unknown")
 S3_BUCKET = env("S3_BUCKET")
 S3_PREFIX = env("S3_PREFIX")
+# How we parse AP responses: "elex" (elex's model objects), "direct" (our
+# own streaming parser in ingest/apjson.py, which is faster and uses less
+# memory), or "incremental" (the direct parser, but only fetching the changes
+# since the last ingest -- see ingest/apfeed.py)
+AP_INGEST_ENGINE = env("AP_INGEST_ENGINE", "elex")
+# With the incremental engine, how often we re-fetch the full results
+AP_FULL_RESYNC_INTERVAL = timedelta(
+    seconds=env.int("AP_FULL_RESYNC_INTERVAL_SECONDS", 900)
+)
+# With the incremental engine, how often we checkpoint the merged AP data to
+# the AP_SNAPSHOT_STORE for cold starts (between checkpoints, it's only kept
+# in memory)
+AP_FEED_CHECKPOINT_INTERVAL = timedelta(
+    seconds=env.int("AP_FEED_CHECKPOINT_INTERVAL_SECONDS", 300)
+)
+# Number of states we export in parallel (this also sizes the connection pools)
+EXPORT_THREADS = env.int("EXPORT_THREADS", 4)
+# When the exports stream results from Postgres (rather than using the AP data
+# from the ingest), the number of rows to fetch at a time
+EXPORT_RESULTS_ITERSIZE = env.int("EXPORT_RESULTS_ITERSIZE", 2000)
+# How the exports cache the historicals between runs (they only change when a
+# new hourly waypoint is ingested): "none", "memory" (for the life of the
+# process), or "snapshot" (in memory, and also in the AP_SNAPSHOT_STORE so
+# cold starts can use them)
+HISTORICALS_CACHE = env("HISTORICALS_CACHE", "memory")
+# How the exports encode each candidate's pop_vote_history: "map" (waypoint ->
+# count) or "compact" (each document lists the waypoints once, in
+# historyWaypoints, and each candidate has an array of its counts at them)
+POP_VOTE_HISTORY_FORMAT = env("POP_VOTE_HISTORY_FORMAT", "map")
+# Add up the "other" candidates' histories on a NumPy grid of the historicals
+# rather than one candidate at a time. The grid is built once for each set of historicals,
+# so we only do this when they're cached (see HISTORICALS_CACHE).
+EXPORT_NUMPY_HISTORIES = env.bool("EXPORT_NUMPY_HISTORIES", True)
 HISTORICAL_START = env.datetime("HISTORICAL_START", "2020-10-01T00:00:00Z")
+# Save the rows that changed to ap_result on every ingest, not just full
+# snapshots on the 15-minute waypoints
+SAVE_AP_RESULT_DELTAS = env.bool("SAVE_AP_RESULT_DELTAS", False)
+# How the ingester formats the rows it COPYs into ap_result: "csv" or "binary"
+# (Postgres's binary COPY format, which is cheaper for Postgres to parse)
+AP_RESULT_COPY_FORMAT = env("AP_RESULT_COPY_FORMAT", "csv")
+# Number of ingest_ids in each ap_result partition. We ingest every 5 minutes,
+# so the default is about a day's worth.
+AP_RESULT_PARTITION_SIZE = env.int("AP_RESULT_PARTITION_SIZE", 288)
+# How long to keep ap_result partitions attached after their last ingest (see
+# enip_backend/ingest/partitions.py), so recent results can still be
+# re-exported
+AP_RESULT_RETENTION = timedelta(hours=env.int("AP_RESULT_RETENTION_HOURS", 24))
+# Where the national run stores a snapshot of the AP data for the state
+# exports to reuse: "s3", "local" (in AP_SNAPSHOT_DIR), or "none"
+AP_SNAPSHOT_STORE = env("AP_SNAPSHOT_STORE", "none")
+AP_SNAPSHOT_DIR = env("AP_SNAPSHOT_DIR", "./ap_snapshots")
+# The state exports only use snapshots that are newer than this, and fetch
+# from the AP otherwise
+AP_SNAPSHOT_MAX_AGE = timedelta(seconds=env.int("AP_SNAPSHOT_MAX_AGE_SECONDS", 600))
+# How many of the latest AP snapshots to keep: older ones are deleted whenever
+# a new one is written. 0 keeps them all.
+AP_SNAPSHOT_RETENTION = env.int("AP_SNAPSHOT_RETENTION", 12)
+# If an export's inputs haven't changed since it last ran, we skip it -- unless
+# it last ran longer ago than this (so code changes eventually get exported)
+EXPORT_SKIP_MAX_AGE = timedelta(seconds=env.int("EXPORT_SKIP_MAX_AGE_SECONDS", 3600))
 CDN_URL = f"https://enip-data.voteamerica.com/{S3_PREFIX}/"
 
 GSHEET_API_CREDENTIALS_SSM_PATH = env("GSHEET_API_CREDENTIALS_SSM_PATH")
@@ -1,21 +1,609 @@
+import functools
+import hashlib
+import io
+import logging
+import re
+import struct
+import threading
+import time
+import weakref
 from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-import psycopg2.pool
+from ddtrace import tracer
 
-from ..enip_common.config import POSTGRES_RO_URL, POSTGRES_URL
+from ..enip_common.config import (
+    EXPORT_THREADS,
+    POSTGRES_POOL_HEALTH_CHECK_AFTER,
+    POSTGRES_PREPARED_STATEMENTS,
+    POSTGRES_RO_URL,
+    POSTGRES_URL,
+)
 
+# Each export thread uses one connection at a time, plus one for the thread
+# that starts them
+POOL_MAX_SIZE = EXPORT_THREADS + 1
 
-@contextmanager
-def get_cursor():
-    with psycopg2.connect(POSTGRES_URL) as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+
+class ConnectionPool:
+    """
+    A thread-safe pool of connections to one database. When all max_size
+    connections are in use, callers wait for one to be returned.
+
+    Connections that have been idle for longer than
+    POSTGRES_POOL_HEALTH_CHECK_AFTER (e.g. because Lambda froze us between
+    invocations) are checked with a SELECT 1 before we hand them out, and
+    replaced if they've gone away.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        dsn: str,
+        max_size: int,
+        connect: Callable[[str], Any] = psycopg2.connect,
+    ):
+        self.name = name
+        self.dsn = dsn
+        self.max_size = max_size
+        self.connect = connect
+
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        # (connection, when it was returned to the pool)
+        self.idle: List[Tuple[Any, float]] = []
+
+        # Counters, for metrics and tests
+        self.n_connects = 0
+        self.n_waits = 0
+        self.wait_seconds = 0.0
+
+    def is_healthy(self, conn: Any, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+
+        if time.monotonic() - idle_since < POSTGRES_POOL_HEALTH_CHECK_AFTER:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            logging.info(f"Discarding broken {self.name} connection")
+            return False
+
+    def get_connection(self) -> Any:
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, idle_since = self.idle.pop()
+
+            if self.is_healthy(conn, idle_since):
+                return conn
+            close_quietly(conn)
+
+        self.n_connects += 1
+        return self.connect(self.dsn)
+
+    def checkout(self) -> Any:
+        with tracer.trace("enip.pg.checkout", resource=self.name) as span:
+            if not self.slots.acquire(blocking=False):
+                # Every connection is in use
+                start = time.monotonic()
+                self.slots.acquire()
+                wait = time.monotonic() - start
+
+                self.n_waits += 1
+                self.wait_seconds += wait
+                span.set_metric("enip.pg.pool_wait_ms", wait * 1000)
+                logging.info(f"Waited {wait:.3f}s for a {self.name} connection")
+
+            try:
+                return self.get_connection()
+            except BaseException:
+                self.slots.release()
+                raise
+
+    def checkin(self, conn: Any) -> None:
+        try:
+            if (
+                conn.closed
+                or conn.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                close_quietly(conn)
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def cursor(self, name: Optional[str] = None, itersize: Optional[int] = None):
+        """
+        Yields a NamedTupleCursor on a pooled connection, in a transaction that
+        is committed if the block succeeds and rolled back otherwise.
+
+        If a name is given, this is a server-side cursor: iterating over it
+        fetches the results itersize rows at a time, rather than fetching
+        them all when the query runs.
+        """
+        conn = self.checkout()
+        with self.cursor_on(conn, name, itersize) as cursor:
             yield cursor
 
+    @contextmanager
+    def cursor_on(
+        self, conn: Any, name: Optional[str] = None, itersize: Optional[int] = None
+    ):
+        """
+        Like cursor, but on a connection that has already been checked out.
+        The connection is checked back in afterwards.
+        """
+        try:
+            with conn:
+                with conn.cursor(
+                    name=name, cursor_factory=psycopg2.extras.NamedTupleCursor
+                ) as cursor:
+                    if itersize:
+                        cursor.itersize = itersize
+                    yield cursor
+        finally:
+            self.checkin(conn)
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            close_quietly(conn)
+
+
+def close_quietly(conn: Any) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+# These live at module level so connections are reused across warm Lambda
+# invocations
+rw_pool = ConnectionPool("rw", POSTGRES_URL, POOL_MAX_SIZE)
+ro_pool = ConnectionPool("ro", POSTGRES_RO_URL, POOL_MAX_SIZE)
+
+
+@contextmanager
+def get_cursor(name: Optional[str] = None, itersize: Optional[int] = None):
+    with rw_pool.cursor(name, itersize) as cursor:
+        yield cursor
+
 
 @contextmanager
-def get_ro_cursor():
-    with psycopg2.connect(POSTGRES_RO_URL) as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as cursor:
+def get_ro_cursor(name: Optional[str] = None, itersize: Optional[int] = None):
+    with ro_pool.cursor(name, itersize) as cursor:
+        yield cursor
+
+
+# How many reads get_fresh_cursor has sent to each database, for metrics and
+# tests
+fresh_cursor_routes = {"replica": 0, "primary": 0}
+
+
+def load_primary_lsn() -> str:
+    """
+    Returns the primary's current WAL position. A replica that has replayed up
+    to here has seen every transaction committed so far (e.g. the last
+    comments or calls sync).
+    """
+    with get_cursor() as cursor:
+        cursor.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+        return cursor.fetchone().lsn
+
+
+def fresh_conditions(
+    ingest_id: Optional[Union[int, str]], lsn: Optional[str]
+) -> Tuple[List[str], List[Any]]:
+    """
+    Returns the SQL conditions (and their parameters) that hold on a database
+    that has the ingest (which is committed in the same transaction as its
+    results) and has replayed the WAL up to lsn
+    """
+    conditions = []
+    params: List[Any] = []
+    if ingest_id is not None:
+        conditions.append("EXISTS (SELECT 1 FROM ingest_run WHERE ingest_id = %s)")
+        params.append(ingest_id)
+    if lsn is not None:
+        # pg_last_wal_replay_lsn() is NULL if this isn't a replica
+        conditions.append(
+            "(NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= %s::pg_lsn)"
+        )
+        params.append(lsn)
+    return conditions, params
+
+
+def replica_is_fresh(
+    cursor, ingest_id: Optional[Union[int, str]], lsn: Optional[str]
+) -> bool:
+    """
+    Checks whether the database cursor is connected to has the ingest and has
+    replayed the WAL up to lsn (see fresh_conditions)
+    """
+    conditions, params = fresh_conditions(ingest_id, lsn)
+    if not conditions:
+        return True
+
+    cursor.execute(f"SELECT {' AND '.join(conditions)} AS fresh", params)
+    return bool(cursor.fetchone().fresh)
+
+
+def fetchone_fresh(
+    sql: str,
+    params: Sequence[Any],
+    ingest_id: Optional[Union[int, str]] = None,
+    check_lsn: bool = False,
+) -> Any:
+    """
+    Runs a query that returns a single row and returns it, reading from the
+    replica if it's fresh (as get_fresh_cursor, with check_lsn checking the
+    primary's current WAL position). Rather than checking the replica first,
+    the freshness conditions go in the query's WHERE clause, so reading from
+    a fresh replica is a single statement on a single snapshot. If the
+    replica is behind, the query returns no rows (Postgres checks the
+    conditions before running it) and we run it again on the primary.
+    """
+    if ro_pool.dsn == rw_pool.dsn:
+        # There's no replica
+        with rw_pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+
+    conditions, fresh_params = fresh_conditions(
+        ingest_id, load_primary_lsn() if check_lsn else None
+    )
+    record = None
+    with tracer.trace("enip.pg.fetchone_fresh") as span:
+        try:
+            with ro_pool.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    SELECT fresh_query.* FROM ({sql}) fresh_query
+                    WHERE {' AND '.join(conditions) or 'true'}
+                    """,
+                    list(params) + fresh_params,
+                )
+                record = cursor.fetchone()
+        except psycopg2.Error:
+            # The replica is down or broken, so we'll use the primary
+            logging.exception("Failed to read from the replica")
+
+        route = "replica" if record is not None else "primary"
+        fresh_cursor_routes[route] += 1
+        span.set_tag("enip.pg.route", route)
+        span.set_metric(f"enip.pg.fresh_cursor_{route}", 1)
+
+    if record is None:
+        logging.info("The replica is behind, reading from the primary")
+        with rw_pool.cursor() as cursor:
+            cursor.execute(sql, params)
+            record = cursor.fetchone()
+
+    return record
+
+
+@contextmanager
+def get_fresh_cursor(
+    ingest_id: Optional[Union[int, str]] = None,
+    lsn: Optional[str] = None,
+    name: Optional[str] = None,
+    itersize: Optional[int] = None,
+):
+    """
+    Yields a cursor (as get_cursor) that is guaranteed to see the given ingest
+    and everything committed up to the given WAL position (see
+    load_primary_lsn). That's a cursor on the read replica if it has caught up
+    far enough, and otherwise on the primary.
+    """
+    if ro_pool.dsn == rw_pool.dsn:
+        # There's no replica
+        with rw_pool.cursor(name, itersize) as cursor:
+            yield cursor
+        return
+
+    with tracer.trace("enip.pg.get_fresh_cursor") as span:
+        conn = None
+        try:
+            conn = ro_pool.checkout()
+            with conn.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor) as check:
+                fresh = replica_is_fresh(check, ingest_id, lsn)
+            conn.rollback()
+        except psycopg2.Error:
+            # The replica is down or broken, so we'll use the primary. checkin
+            # discards the connection if it's unusable.
+            logging.exception("Failed to check the replica's replay position")
+            fresh = False
+
+        route = "replica" if fresh else "primary"
+        fresh_cursor_routes[route] += 1
+        span.set_tag("enip.pg.route", route)
+        span.set_metric(f"enip.pg.fresh_cursor_{route}", 1)
+
+    if fresh:
+        with ro_pool.cursor_on(conn, name, itersize) as cursor:
+            yield cursor
+    else:
+        if conn is not None:
+            ro_pool.checkin(conn)
+        logging.info("The replica is behind, reading from the primary")
+        with rw_pool.cursor(name, itersize) as cursor:
             yield cursor
+
+
+# The names of the statements we've prepared on each connection. Prepared
+# statements last as long as the session, so the entry goes away with the
+# connection.
+prepared_statements: "weakref.WeakKeyDictionary[Any, Set[str]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+PLACEHOLDER_RE = re.compile(r"%([%s])")
+
+
+@functools.lru_cache(maxsize=None)
+def prepare_sql(sql: str) -> Tuple[str, str, int]:
+    """
+    Returns (statement name, sql with $1, $2... placeholders, number of
+    parameters) for a query with psycopg2-style %s placeholders. The name is
+    derived from the query, so the same query always gets the same name.
+    """
+    n_params = 0
+
+    def replace(match):
+        nonlocal n_params
+        if match.group(1) == "%":
+            return "%"
+        n_params += 1
+        return f"${n_params}"
+
+    numbered_sql = PLACEHOLDER_RE.sub(replace, sql)
+    name = "enip_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+    return name, numbered_sql, n_params
+
+
+def execute_prepared(cursor, sql: str, params: Sequence[Any]) -> None:
+    """
+    Like cursor.execute(sql, params), but PREPAREs the query the first time
+    it's run on the cursor's connection and EXECUTEs the prepared statement
+    after that, so Postgres can skip parsing and (once it settles on a generic
+    plan) planning it. Only works with unnamed cursors.
+    """
+    if not POSTGRES_PREPARED_STATEMENTS:
+        cursor.execute(sql, params)
+        return
+
+    name, numbered_sql, n_params = prepare_sql(sql)
+    if len(params) != n_params:
+        raise ValueError(f"Expected {n_params} parameters, got {len(params)}")
+
+    statements = prepared_statements.setdefault(cursor.connection, set())
+    if name not in statements:
+        with tracer.trace("enip.pg.prepare", resource=name):
+            cursor.execute(f"PREPARE {name} AS {numbered_sql}")
+        statements.add(name)
+
+    if n_params:
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * n_params)})", params)
+    else:
+        cursor.execute(f"EXECUTE {name}")
+
+
+# Max rows per statement for bulk_insert and bulk_update
+BULK_PAGE_SIZE = 500
+
+
+def bulk_insert(
+    cursor,
+    table: str,
+    columns: Sequence[str],
+    rows: Sequence[Sequence[Any]],
+    on_conflict: str = "",
+    template: Optional[str] = None,
+    page_size: int = BULK_PAGE_SIZE,
+) -> None:
+    """
+    Inserts rows (sequences of values for columns) with multi-row INSERTs of
+    up to page_size rows each, rather than one statement per row like
+    executemany. on_conflict (e.g. "ON CONFLICT (state) DO UPDATE ...") is
+    appended to each INSERT, and template is as for execute_values.
+
+    Postgres inserts (and so locks) the rows in the order we give them, so
+    callers that need a consistent lock order should sort them first.
+    """
+    psycopg2.extras.execute_values(
+        cursor,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s {on_conflict}",
+        rows,
+        template=template,
+        page_size=page_size,
+    )
+
+
+def bulk_update(
+    cursor,
+    table: str,
+    columns: Sequence[str],
+    rows: Sequence[Sequence[Any]],
+    template: Optional[str] = None,
+    page_size: int = BULK_PAGE_SIZE,
+) -> None:
+    """
+    Updates rows with UPDATE ... FROM (VALUES ...) statements of up to
+    page_size rows each. The first column is the key to match on, and the
+    rest are the columns to set. If a key appears more than once, the last
+    row for it wins (as it would with executemany).
+
+    Unlike an INSERT, the order an UPDATE ... FROM finds rows in is up to the
+    planner. So each statement first locks the rows it's going to update in
+    key order, which keeps us from deadlocking with other writers that work
+    in key order.
+    """
+    key = columns[0]
+    deduped = list({row[0]: row for row in rows}.values())
+
+    psycopg2.extras.execute_values(
+        cursor,
+        f"""
+        WITH new_values ({', '.join(columns)}) AS (VALUES %s),
+        locked AS (
+            SELECT {key} FROM {table}
+            WHERE {key} IN (SELECT {key} FROM new_values)
+            ORDER BY {key}
+            FOR UPDATE
+        )
+        UPDATE {table}
+        SET {', '.join(f"{column} = new_values.{column}" for column in columns[1:])}
+        FROM new_values
+        WHERE {table}.{key} = new_values.{key}
+            AND {table}.{key} IN (SELECT {key} FROM locked)
+        """,
+        deduped,
+        template=template,
+        page_size=page_size,
+    )
+
+
+class IteratorFile(io.IOBase):
+    """
+    A read-only file-like object that reads from an iterator of str (or bytes)
+    chunks. This lets us stream data into cursor.copy_expert as it's produced,
+    rather than building the whole COPY payload in memory first.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = None
+        self._empty = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # Pull chunks until we have enough data buffered (or run out)
+        pending = [self._buffer] if self._buffer else []
+        pending_len = len(self._buffer) if self._buffer else 0
+        while size is None or size < 0 or pending_len < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._empty = chunk[:0]
+            pending.append(chunk)
+            pending_len += len(chunk)
+
+        if not pending:
+            self._buffer = None
+            return self._empty
+
+        data = self._empty.join(pending)
+        if size is None or size < 0:
+            self._buffer = None
+            return data
+
+        self._buffer = data[size:]
+        return data[:size]
+
+
+# Postgres's binary COPY format: a header, then each row as a field count
+# followed by each field's length and value (in network byte order), then a
+# trailer. See https://www.postgresql.org/docs/current/sql-copy.html
+BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+BINARY_COPY_TRAILER = struct.pack(">h", -1)
+BINARY_NULL = struct.pack(">i", -1)
+
+# Binary timestamps are microseconds since this
+POSTGRES_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+_int4_field = struct.Struct(">ii")
+_int8_field = struct.Struct(">iq")
+_float8_field = struct.Struct(">id")
+_length = struct.Struct(">i")
+
+
+# Encoders for the binary COPY format, one per column type. Each returns the
+# field's length and value.
+def encode_int4(value: Any) -> bytes:
+    return _int4_field.pack(4, int(value))
+
+
+def encode_float8(value: Any) -> bytes:
+    return _float8_field.pack(8, float(value))
+
+
+def encode_bool(value: Any) -> bytes:
+    return b"\x00\x00\x00\x01\x01" if value else b"\x00\x00\x00\x01\x00"
+
+
+def encode_text(value: Any) -> bytes:
+    data = str(value).encode("utf-8")
+    return _length.pack(len(data)) + data
+
+
+def encode_timestamptz(value: Union[str, datetime]) -> bytes:
+    """
+    Encodes a datetime, or an ISO 8601 string like the AP's
+    "2020-11-04T03:12:45Z". Timestamps without a timezone are taken to be UTC.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+
+    delta = value - POSTGRES_EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return _int8_field.pack(8, microseconds)
+
+
+def binary_copy_chunks(
+    encoders: Sequence[Callable[[Any], bytes]],
+    rows: Iterable[Sequence[Any]],
+    chunk_size: int,
+):
+    """
+    Serializes rows to Postgres's binary COPY format, using the given encoder
+    for each column, and yields the output in chunks of roughly chunk_size
+    bytes. This is cheaper for Postgres to read than CSV, since it doesn't
+    have to parse any numbers or timestamps.
+    """
+    field_count = struct.pack(">h", len(encoders))
+    buffer = bytearray(BINARY_COPY_HEADER)
+
+    for row in rows:
+        buffer += field_count
+        for encode, value in zip(encoders, row):
+            # Like an unquoted empty CSV field, an empty string is a NULL
+            if value is None or value == "":
+                buffer += BINARY_NULL
+            else:
+                buffer += encode(value)
+
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            del buffer[:]
+
+    buffer += BINARY_COPY_TRAILER
+    yield bytes(buffer)
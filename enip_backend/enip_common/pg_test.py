@@ -0,0 +1,532 @@
+import struct
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import pytest
+
+from ..export.query_plans_test import EXPLAIN_TEST_POSTGRES_URL
+from . import pg
+from .pg import (
+    BINARY_COPY_HEADER,
+    BINARY_COPY_TRAILER,
+    POSTGRES_EPOCH,
+    ConnectionPool,
+    IteratorFile,
+    binary_copy_chunks,
+    bulk_insert,
+    bulk_update,
+    encode_bool,
+    encode_float8,
+    encode_int4,
+    encode_text,
+    encode_timestamptz,
+    execute_prepared,
+)
+
+
+def read_all(f, size):
+    out = []
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return out
+        out.append(chunk)
+
+
+def test_iterator_file_sized_reads():
+    f = IteratorFile(["abc", "", "defgh", "i"])
+    assert read_all(f, 4) == ["abcd", "efgh", "i"]
+
+
+def test_iterator_file_read_all():
+    f = IteratorFile(["abc", "def"])
+    assert f.read() == "abcdef"
+    assert f.read() == ""
+
+
+def test_iterator_file_bytes():
+    f = IteratorFile([b"ab", b"cd"])
+    assert read_all(f, 3) == [b"abc", b"d"]
+    assert f.read(3) == b""
+
+
+def test_iterator_file_empty():
+    assert IteratorFile([]).read(8192) == ""
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.itersize = 2000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.executed.append(sql)
+
+    def fetchone(self):
+        return self.conn.dsn
+
+
+class FakeConnection:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = 0
+        self.broken = False
+        self.executed = []
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self, name=None, cursor_factory=None):
+        return FakeCursor(self, name)
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def close(self):
+        self.closed = 1
+
+
+def make_pool(max_size=2):
+    return ConnectionPool("test", "postgres://test", max_size, connect=FakeConnection)
+
+
+def test_pool_reuses_connections():
+    pool = make_pool()
+    with pool.cursor() as cursor:
+        first = cursor.conn
+    with pool.cursor() as cursor:
+        assert cursor.conn is first
+
+    assert pool.n_connects == 1
+
+
+def test_pool_replaces_broken_connections(mocker):
+    mocker.patch.object(pg, "POSTGRES_POOL_HEALTH_CHECK_AFTER", 0)
+    pool = make_pool()
+    with pool.cursor() as cursor:
+        first = cursor.conn
+    first.broken = True
+
+    with pool.cursor() as cursor:
+        assert cursor.conn is not first
+    assert first.closed
+    assert pool.n_connects == 2
+
+
+def test_pool_discards_connections_in_a_transaction():
+    pool = make_pool()
+    with pool.cursor() as cursor:
+        first = cursor.conn
+        first.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+
+    assert first.closed
+    assert pool.idle == []
+
+
+def test_pool_waits_when_full():
+    pool = make_pool(max_size=1)
+    conn = pool.checkout()
+
+    def return_later():
+        time.sleep(0.05)
+        pool.checkin(conn)
+
+    thread = threading.Thread(target=return_later)
+    thread.start()
+    with pool.cursor() as cursor:
+        assert cursor.conn is conn
+    thread.join()
+
+    assert pool.n_waits == 1
+    assert pool.wait_seconds > 0
+    assert pool.n_connects == 1
+
+
+def test_pool_named_cursor():
+    pool = make_pool()
+    with pool.cursor() as cursor:
+        assert cursor.name is None
+        assert cursor.itersize == 2000
+
+    with pool.cursor("results", itersize=100) as cursor:
+        assert cursor.name == "results"
+        assert cursor.itersize == 100
+
+    assert pool.n_connects == 1
+
+
+@pytest.fixture
+def replica_pools(mocker):
+    rw_pool = ConnectionPool("rw", "postgres://primary", 2, connect=FakeConnection)
+    ro_pool = ConnectionPool("ro", "postgres://replica", 2, connect=FakeConnection)
+    mocker.patch.object(pg, "rw_pool", rw_pool)
+    mocker.patch.object(pg, "ro_pool", ro_pool)
+    mocker.patch.object(pg, "fresh_cursor_routes", {"replica": 0, "primary": 0})
+    return rw_pool, ro_pool
+
+
+def test_fresh_cursor_uses_caught_up_replica(mocker, replica_pools):
+    replica_is_fresh = mocker.patch.object(pg, "replica_is_fresh", return_value=True)
+
+    with pg.get_fresh_cursor(ingest_id=12, name="results", itersize=100) as cursor:
+        assert cursor.conn.dsn == "postgres://replica"
+        assert cursor.name == "results"
+        assert cursor.itersize == 100
+
+    assert replica_is_fresh.call_args[0][1:] == (12, None)
+    assert pg.fresh_cursor_routes == {"replica": 1, "primary": 0}
+    assert len(replica_pools[1].idle) == 1
+
+
+def test_fresh_cursor_falls_back_to_primary(mocker, replica_pools):
+    mocker.patch.object(pg, "replica_is_fresh", return_value=False)
+
+    with pg.get_fresh_cursor(lsn="0/16B3748") as cursor:
+        assert cursor.conn.dsn == "postgres://primary"
+
+    assert pg.fresh_cursor_routes == {"replica": 0, "primary": 1}
+    # The replica connection goes back to the pool
+    assert len(replica_pools[1].idle) == 1
+
+
+def test_fresh_cursor_falls_back_when_replica_fails(mocker, replica_pools):
+    mocker.patch.object(
+        pg,
+        "replica_is_fresh",
+        side_effect=psycopg2.OperationalError("server closed the connection"),
+    )
+
+    with pg.get_fresh_cursor(ingest_id=12) as cursor:
+        assert cursor.conn.dsn == "postgres://primary"
+
+    assert pg.fresh_cursor_routes == {"replica": 0, "primary": 1}
+
+
+def test_fresh_cursor_without_replica(mocker, replica_pools):
+    replica_is_fresh = mocker.patch.object(pg, "replica_is_fresh")
+    replica_pools[1].dsn = replica_pools[0].dsn
+
+    with pg.get_fresh_cursor(ingest_id=12) as cursor:
+        assert cursor.conn.dsn == "postgres://primary"
+
+    assert not replica_is_fresh.called
+
+
+def test_fetchone_fresh_without_replica(mocker, replica_pools):
+    load_primary_lsn = mocker.patch.object(pg, "load_primary_lsn")
+    replica_pools[1].dsn = replica_pools[0].dsn
+
+    assert pg.fetchone_fresh("SELECT 1", [], check_lsn=True) == "postgres://primary"
+    assert not load_primary_lsn.called
+
+
+def test_fetchone_fresh_checks_in_the_query(mocker, replica_pools):
+    mocker.patch.object(pg, "load_primary_lsn", return_value="0/16B3748")
+
+    assert pg.fetchone_fresh("SELECT 1", [], check_lsn=True) == "postgres://replica"
+    [conn] = [conn for conn, _ in replica_pools[1].idle]
+    # The freshness check is part of the one statement
+    [sql] = conn.executed
+    assert "pg_last_wal_replay_lsn() >= %s::pg_lsn" in sql
+    assert pg.fresh_cursor_routes == {"replica": 1, "primary": 0}
+
+
+CheckRecord = namedtuple("CheckRecord", ["fresh"])
+
+
+class CheckCursor:
+    def __init__(self, fresh):
+        self.fresh = fresh
+        self.executed = None
+
+    def execute(self, sql, params):
+        self.executed = (sql, params)
+
+    def fetchone(self):
+        return CheckRecord(self.fresh)
+
+
+def test_replica_is_fresh():
+    cursor = CheckCursor(True)
+    assert pg.replica_is_fresh(cursor, None, None)
+    assert cursor.executed is None
+
+    cursor = CheckCursor(False)
+    assert not pg.replica_is_fresh(cursor, 12, "0/16B3748")
+    sql, params = cursor.executed
+    assert "ingest_id = %s" in sql
+    assert "pg_last_wal_replay_lsn() >= %s::pg_lsn" in sql
+    assert params == [12, "0/16B3748"]
+
+
+def test_prepare_sql():
+    name, sql, n_params = pg.prepare_sql(
+        "SELECT * FROM ingest_run WHERE ingest_id %% 3 = %s AND ingest_dt < %s"
+    )
+    assert sql == "SELECT * FROM ingest_run WHERE ingest_id % 3 = $1 AND ingest_dt < $2"
+    assert n_params == 2
+    assert name.startswith("enip_")
+    assert pg.prepare_sql("SELECT 1")[0] != name
+
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+def test_execute_prepared():
+    conn = FakeConnection("postgres://test")
+    sql = "SELECT * FROM ap_candidate WHERE statepostal = %s"
+    name, _, _ = pg.prepare_sql(sql)
+
+    cursor = RecordingCursor(conn)
+    execute_prepared(cursor, sql, ["AK"])
+    execute_prepared(cursor, sql, ["AL"])
+    assert cursor.executed == [
+        (f"PREPARE {name} AS SELECT * FROM ap_candidate WHERE statepostal = $1", None),
+        (f"EXECUTE {name} (%s)", ["AK"]),
+        (f"EXECUTE {name} (%s)", ["AL"]),
+    ]
+
+    # Each connection prepares the statement once
+    other_cursor = RecordingCursor(FakeConnection("postgres://test"))
+    execute_prepared(other_cursor, sql, ["AZ"])
+    assert other_cursor.executed[0][0].startswith("PREPARE")
+
+    with pytest.raises(ValueError):
+        execute_prepared(cursor, sql, [])
+
+
+def test_execute_prepared_disabled(mocker):
+    mocker.patch.object(pg, "POSTGRES_PREPARED_STATEMENTS", False)
+    cursor = RecordingCursor(FakeConnection("postgres://test"))
+    execute_prepared(cursor, "SELECT %s", [1])
+    assert cursor.executed == [("SELECT %s", [1])]
+
+
+def test_bulk_insert(mocker):
+    execute_values = mocker.patch("psycopg2.extras.execute_values")
+    rows = [("AK", "GOP"), ("AL", None)]
+    bulk_insert(
+        "cursor",
+        "senate_calls",
+        ["state", "ap_call"],
+        rows,
+        on_conflict="ON CONFLICT (state) DO NOTHING",
+    )
+
+    execute_values.assert_called_once_with(
+        "cursor",
+        "INSERT INTO senate_calls (state, ap_call) VALUES %s ON CONFLICT (state) DO NOTHING",
+        rows,
+        template=None,
+        page_size=pg.BULK_PAGE_SIZE,
+    )
+
+
+def test_bulk_update(mocker):
+    execute_values = mocker.patch("psycopg2.extras.execute_values")
+    bulk_update(
+        "cursor",
+        "senate_calls",
+        ["state", "published"],
+        [("AK", True), ("AL", False), ("AK", False)],
+        page_size=10,
+    )
+
+    (_, sql, rows), kwargs = execute_values.call_args
+    # The last row for each key wins, and we keep the order rows were given in
+    assert rows == [("AK", False), ("AL", False)]
+    assert kwargs == {"template": None, "page_size": 10}
+
+    sql = " ".join(sql.split())
+    assert "WITH new_values (state, published) AS (VALUES %s)" in sql
+    assert "ORDER BY state FOR UPDATE" in sql
+    assert "SET published = new_values.published FROM new_values" in sql
+
+
+# The rest of the bulk_update tests run against a scratch schema in the same
+# local Postgres as query_plans_test. They're skipped unless
+# EXPLAIN_TEST_POSTGRES_URL is set.
+BULK_UPDATE_SCHEMA = "bulk_update_test"
+
+
+@pytest.fixture
+def calls_cursor():
+    """
+    A cursor on a scratch senate_calls table, with a row for 1,200 made-up
+    states, none of them published
+    """
+    conn = psycopg2.connect(
+        EXPLAIN_TEST_POSTGRES_URL, cursor_factory=psycopg2.extras.NamedTupleCursor
+    )
+    conn.autocommit = True
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {BULK_UPDATE_SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {BULK_UPDATE_SCHEMA}")
+            cursor.execute(f"SET search_path TO {BULK_UPDATE_SCHEMA}")
+            cursor.execute(
+                """
+                CREATE TABLE senate_calls (
+                  state TEXT PRIMARY KEY,
+                  ap_call TEXT,
+                  published BOOLEAN NOT NULL DEFAULT FALSE
+                );
+                INSERT INTO senate_calls (state)
+                SELECT 'S' || lpad(i::text, 4, '0') FROM generate_series(1, 1200) i;
+                """
+            )
+
+            yield cursor
+
+            cursor.execute(f"DROP SCHEMA {BULK_UPDATE_SCHEMA} CASCADE")
+    finally:
+        conn.close()
+
+
+def load_calls(cursor):
+    cursor.execute("SELECT state, ap_call, published FROM senate_calls")
+    return {record.state: (record.ap_call, record.published) for record in cursor}
+
+
+@pytest.mark.skipif(
+    not EXPLAIN_TEST_POSTGRES_URL, reason="EXPLAIN_TEST_POSTGRES_URL is not set"
+)
+@pytest.mark.parametrize("page_size", [pg.BULK_PAGE_SIZE, 7])
+def test_bulk_update_db(calls_cursor, page_size):
+    expected = load_calls(calls_cursor)
+
+    # Every other state, in reverse order, so they're spread over more than
+    # one page
+    rows = []
+    for i, state in enumerate(sorted(expected, reverse=True)):
+        if i % 2 == 0:
+            rows.append((state, f"call {i}", i % 4 == 0))
+            expected[state] = (f"call {i}", i % 4 == 0)
+    # Keys that appear more than once (on the same page and on different
+    # pages), where the last row wins, and a key that isn't in the table,
+    # which is ignored
+    rows.insert(0, ("S0001", "first", False))
+    rows.insert(1, ("S1200", "early", True))
+    rows.append(("S0001", "last", True))
+    rows.append(("S1200", None, False))
+    rows.append(("XX", "missing", True))
+    expected["S0001"] = ("last", True)
+    expected["S1200"] = (None, False)
+    assert len(rows) > pg.BULK_PAGE_SIZE
+
+    bulk_update(
+        calls_cursor,
+        "senate_calls",
+        ["state", "ap_call", "published"],
+        rows,
+        page_size=page_size,
+    )
+
+    assert load_calls(calls_cursor) == expected
+
+
+# Decoders for the binary COPY format, the inverse of pg's encoders
+BINARY_DECODERS = {
+    encode_int4: lambda data: struct.unpack(">i", data)[0],
+    encode_float8: lambda data: struct.unpack(">d", data)[0],
+    encode_bool: lambda data: data == b"\x01",
+    encode_text: lambda data: data.decode("utf-8"),
+    encode_timestamptz: lambda data: POSTGRES_EPOCH
+    + timedelta(microseconds=struct.unpack(">q", data)[0]),
+}
+
+
+def read_binary_copy(data, encoders):
+    """
+    Parses binary COPY data back into rows, like Postgres would
+    """
+    assert data.startswith(BINARY_COPY_HEADER)
+    assert data.endswith(BINARY_COPY_TRAILER)
+
+    rows = []
+    offset = len(BINARY_COPY_HEADER)
+    while offset < len(data) - len(BINARY_COPY_TRAILER):
+        (field_count,) = struct.unpack_from(">h", data, offset)
+        assert field_count == len(encoders)
+        offset += 2
+
+        row = []
+        for encoder in encoders:
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(BINARY_DECODERS[encoder](data[offset : offset + length]))
+                offset += length
+        rows.append(tuple(row))
+
+    assert offset == len(data) - len(BINARY_COPY_TRAILER)
+    return rows
+
+
+def test_encode_timestamptz():
+    expected = datetime(2020, 11, 4, 3, 12, 45, tzinfo=timezone.utc)
+    for value in [
+        "2020-11-04T03:12:45Z",
+        "2020-11-03T22:12:45-05:00",
+        datetime(2020, 11, 4, 3, 12, 45),
+        expected,
+    ]:
+        assert BINARY_DECODERS[encode_timestamptz](encode_timestamptz(value)[4:]) == (
+            expected
+        )
+
+    assert encode_timestamptz(POSTGRES_EPOCH) == struct.pack(">iq", 8, 0)
+
+
+def test_binary_copy_chunks():
+    encoders = [encode_int4, encode_text, encode_float8, encode_bool]
+    rows = [
+        (1, "ünïcode", 0.5, True),
+        (-2, None, 12.25, False),
+        (3, "", 0, None),
+    ]
+
+    chunks = list(binary_copy_chunks(encoders, rows, 16))
+    assert len(chunks) > 1
+
+    assert read_binary_copy(b"".join(chunks), encoders) == [
+        (1, "ünïcode", 0.5, True),
+        (-2, None, 12.25, False),
+        (3, None, 0.0, None),
+    ]
+
+
+def test_binary_copy_chunks_empty():
+    assert b"".join(binary_copy_chunks([encode_int4], [], 16)) == (
+        BINARY_COPY_HEADER + BINARY_COPY_TRAILER
+    )
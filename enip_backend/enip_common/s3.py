@@ -26,17 +26,51 @@ def read_json(path):
     return json.loads(response["Body"].read())
 
 
-def write_string(path, content, content_type, acl, cache_control):
+def read_bytes(path):
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=os.path.join(S3_PREFIX, path))
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        else:
+            raise
+
+    return response["Body"].read()
+
+
+def list_names(path):
+    """
+    Lists the names of the objects under path (a "directory" ending in /),
+    relative to it
+    """
+    prefix = os.path.join(S3_PREFIX, path)
+    names = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            names.append(obj["Key"][len(prefix) :])
+    return names
+
+
+def delete(path):
+    s3.delete_object(Bucket=S3_BUCKET, Key=os.path.join(S3_PREFIX, path))
+
+
+def write_bytes(path, content, content_type, acl, cache_control):
     s3.put_object(
         Bucket=S3_BUCKET,
         Key=os.path.join(S3_PREFIX, path),
-        Body=content.encode(),
+        Body=content,
         ContentType=content_type,
         ACL=acl,
         CacheControl=cache_control,
     )
 
 
+def write_string(path, content, content_type, acl, cache_control):
+    write_bytes(path, content.encode(), content_type, acl, cache_control)
+
+
 def write_cacheable_json(path, content):
     write_string(
         path,
@@ -2,8 +2,11 @@ import json
 import logging
 from datetime import datetime, timezone
 
+from ..enip_common.config import EXPORT_RESULTS_ITERSIZE
 from ..enip_common.pg import get_ro_cursor
+from .helpers import load_election_results
 from .run import export_all_states, export_national
+from .table import IngestTable
 
 # Bulk-exports a range of ingests for testing purposes. Prints out a JSON
 # blob describing the exports.
@@ -11,6 +14,19 @@ START_TIME = datetime(2020, 10, 15, 16, 0, 0, tzinfo=timezone.utc)
 END_TIME = datetime(2020, 10, 15, 18, 0, 0, tzinfo=timezone.utc)
 
 
+def load_county_results(ingest_id):
+    """
+    Loads the county-level results for an ingest (the AP data the state
+    exports need), streaming them into an IngestTable so we only ever hold
+    the compact form in memory
+    """
+    return IngestTable.from_records(
+        load_election_results(
+            ingest_id, "level = 'county'", [], itersize=EXPORT_RESULTS_ITERSIZE
+        )
+    )
+
+
 def export_bulk():
     ingests = []
     with get_ro_cursor() as cursor:
@@ -35,7 +51,7 @@ def export_bulk():
                         ingest_id, ingest_dt, ingest_dt.strftime("%Y%m%d%H%M%S")
                     ),
                     "states": export_all_states(
-                        ingest_id, ingest_dt, ingest_dt.strftime("%Y%m%d%H%M%S")
+                        load_county_results(ingest_id), ingest_dt, ingest_id
                     ),
                 },
             }
@@ -1,10 +1,38 @@
+import hashlib
+from array import array
 from datetime import datetime
-from typing import Any, Dict, Generator, List, NamedTuple, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Union,
+)
 
-from ..enip_common.config import HISTORICAL_START
-from ..enip_common.pg import get_cursor, get_ro_cursor
+from ..enip_common.config import (
+    EXPORT_SKIP_MAX_AGE,
+    HISTORICAL_START,
+    POP_VOTE_HISTORY_FORMAT,
+)
+from ..enip_common.pg import (
+    bulk_insert,
+    execute_prepared,
+    fetchone_fresh,
+    get_cursor,
+    get_fresh_cursor,
+    get_ro_cursor,
+    load_primary_lsn,
+)
 from . import structs
 
+if TYPE_CHECKING:
+    from .history_grid import OtherHistories
+
 SQLRecord = NamedTuple(
     "SQLRecord",
     [
@@ -51,9 +79,196 @@ def sqlrecord_from_dict(dict: Dict[str, Any]) -> SQLRecord:
     )
 
 
+def partition_by_state(
+    records: Iterable[SQLRecord],
+) -> Mapping[str, Iterable[SQLRecord]]:
+    """
+    Splits a list of records into a map of (statepostal -> records) in a single
+    pass, preserving the order of the records within each state.
+    """
+    if hasattr(records, "partition_by"):
+        # This is an IngestTable, which can partition itself more efficiently
+        return records.partition_by("statepostal")  # type: ignore
+
+    partitioned: Dict[str, List[SQLRecord]] = {}
+    for record in records:
+        if record.statepostal not in partitioned:
+            partitioned[record.statepostal] = []
+        partitioned[record.statepostal].append(record)
+
+    return partitioned
+
+
+def fingerprint_records(records: Iterable[SQLRecord], *context: str) -> str:
+    """
+    Computes a digest of the given records (ignoring their ingest_id) and any
+    additional context strings. Used to detect when the inputs to an export
+    haven't changed since the last time we ran it.
+    """
+    digest = hashlib.sha1()
+    for item in context:
+        digest.update(item.encode())
+        digest.update(b"\0")
+
+    for record in records:
+        digest.update(repr(record[1:]).encode())
+
+    return digest.hexdigest()
+
+
+def load_context_fingerprint(
+    ingest_run_dt: datetime, include_comments_and_calls: bool
+) -> str:
+    """
+    Returns a string that changes whenever the non-AP inputs to an export
+    change: the latest historical waypoint and, optionally, the comments and
+    calls tables.
+    """
+    # Read from the replica only if it has the latest ingest and syncs, so we
+    # don't skip an export because it's behind
+    with get_fresh_cursor(lsn=load_primary_lsn()) as cursor:
+        if include_comments_and_calls:
+            cursor.execute(
+                """
+                SELECT
+                    (
+                        SELECT MAX(waypoint_60_dt) FROM ingest_run
+                        WHERE ingest_dt < %s
+                    ) AS waypoint_60_dt,
+                    (
+                        SELECT md5(string_agg(
+                            concat_ws('|', ts, submitted_by, office_id, race, title, body),
+                            '\n' ORDER BY ts, submitted_by, office_id, race, title, body
+                        ))
+                        FROM comments
+                    ) AS comments_md5,
+                    (
+                        SELECT md5(string_agg(concat_ws('|', state, published), ',' ORDER BY state))
+                        FROM senate_calls
+                    ) AS senate_calls_md5,
+                    (
+                        SELECT md5(string_agg(concat_ws('|', state, published), ',' ORDER BY state))
+                        FROM president_calls
+                    ) AS president_calls_md5
+                """,
+                [ingest_run_dt],
+            )
+        else:
+            cursor.execute(
+                "SELECT MAX(waypoint_60_dt) AS waypoint_60_dt FROM ingest_run WHERE ingest_dt < %s",
+                [ingest_run_dt],
+            )
+
+        return "|".join(str(value) for value in cursor.fetchone())
+
+
+def load_export_fingerprints() -> Dict[str, str]:
+    """
+    Returns a map of (export name -> fingerprint) for exports that have run
+    within the last EXPORT_SKIP_MAX_AGE
+    """
+    with get_cursor() as cursor:
+        cursor.execute(
+            "SELECT export_name, fingerprint FROM export_fingerprint WHERE updated_at > now() - %s",
+            [EXPORT_SKIP_MAX_AGE],
+        )
+        return {record.export_name: record.fingerprint for record in cursor}
+
+
+def save_export_fingerprints(fingerprints: Dict[str, str]) -> None:
+    if not fingerprints:
+        return
+
+    with get_cursor() as cursor:
+        bulk_insert(
+            cursor,
+            "export_fingerprint",
+            ["export_name", "fingerprint", "updated_at"],
+            sorted(fingerprints.items()),
+            on_conflict="""
+            ON CONFLICT (export_name) DO UPDATE
+            SET (fingerprint, updated_at) = (EXCLUDED.fingerprint, EXCLUDED.updated_at)
+            """,
+            template="(%s, %s, now())",
+        )
+
+
 # map of (elex id -> { waypoint_dt -> count})
 HistoricalResults = Dict[str, Dict[str, int]]
 
+# The compact form of HistoricalResults (for POP_VOTE_HISTORY_FORMAT=compact):
+# the waypoints, oldest first, and a map of (elex id -> counts), where counts
+# is an array of the candidate's count at each waypoint (or MISSING_COUNT if
+# it has none there). Each array stops after its last count, so it can be
+# shorter than the waypoints.
+CompactHistoricalResults = NamedTuple(
+    "CompactHistoricalResults",
+    [("waypoints", List[str]), ("counts", Dict[str, "array[int]"])],
+)
+MISSING_COUNT = -1
+
+AnyHistoricalResults = Union[HistoricalResults, CompactHistoricalResults]
+
+
+def compact_historicals(
+    historical_counts: HistoricalResults,
+) -> CompactHistoricalResults:
+    """
+    Converts historical_counts to the compact form
+    """
+    waypoints = sorted(
+        {waypoint for counts in historical_counts.values() for waypoint in counts}
+    )
+    index = {waypoint: i for i, waypoint in enumerate(waypoints)}
+
+    compact_counts = {}
+    for elex_id, counts in historical_counts.items():
+        positions = [index[waypoint] for waypoint in counts]
+        series = array("q", [MISSING_COUNT]) * (max(positions, default=-1) + 1)
+        for position, count in zip(positions, counts.values()):
+            series[position] = MISSING_COUNT if count is None else count
+        compact_counts[elex_id] = series
+
+    return CompactHistoricalResults(waypoints, compact_counts)
+
+
+def format_historicals(historical_counts: AnyHistoricalResults) -> AnyHistoricalResults:
+    """
+    Returns historical_counts in the form POP_VOTE_HISTORY_FORMAT asks for
+    """
+    if POP_VOTE_HISTORY_FORMAT == "map":
+        assert not isinstance(historical_counts, CompactHistoricalResults)
+        return historical_counts
+    elif POP_VOTE_HISTORY_FORMAT == "compact":
+        if isinstance(historical_counts, CompactHistoricalResults):
+            return historical_counts
+        return compact_historicals(historical_counts)
+    else:
+        raise RuntimeError(
+            f"Invalid POP_VOTE_HISTORY_FORMAT: {POP_VOTE_HISTORY_FORMAT}"
+        )
+
+
+def candidate_history(
+    historical_counts: AnyHistoricalResults, elex_id: str
+) -> structs.PopVoteHistory:
+    """
+    Returns a candidate's pop_vote_history: a map of (waypoint_dt -> count), or
+    with the compact form, a list of its counts at each waypoint (None where
+    it has none, and stopping after its last count)
+    """
+    if isinstance(historical_counts, CompactHistoricalResults):
+        return [
+            None if count == MISSING_COUNT else count
+            for count in historical_counts.counts.get(elex_id, [])
+        ]
+    return historical_counts.get(elex_id, {})
+
+
+# The comments are ordered by ts, newest first. The other columns are only
+# there to break ties in a consistent way.
+COMMENTS_ORDER = "ts DESC, submitted_by, office_id, race, title, body"
+
 
 def handle_candidate_results(
     data: Union[
@@ -65,7 +280,8 @@ def handle_candidate_results(
     ],
     named_candidate_factory: Any,
     record: SQLRecord,
-    historical_counts: HistoricalResults,
+    historical_counts: AnyHistoricalResults,
+    other_histories: Optional["OtherHistories"] = None,
 ) -> None:
     """
     Helper function that adds a result to dem/gop/other. This function:
@@ -74,7 +290,17 @@ def handle_candidate_results(
     - If there's already a GOP/Dem candidate, or if this record is for
         a third-party candidate, adds the results to the "other" bucket
     - Gets the historical vote counts and populates those as well
+
+    If other_histories is given, the "other" bucket's historical counts are
+    left for it to add up when the export is done.
     """
+    if isinstance(historical_counts, CompactHistoricalResults) and isinstance(
+        data.oth.pop_vote_history, dict
+    ):
+        # The "other" bucket starts with an empty map, which we swap for an
+        # empty list so the whole document uses the compact form
+        data.oth.pop_vote_history = []
+
     party = structs.Party.from_ap(record.party)
     if party == structs.Party.GOP:
         if data.gop:
@@ -89,7 +315,7 @@ def handle_candidate_results(
                 last_name=record.last,
                 pop_vote=record.votecount,
                 pop_pct=record.votepct,
-                pop_vote_history=historical_counts.get(record.elex_id, {}),
+                pop_vote_history=candidate_history(historical_counts, record.elex_id),
             )
             return
     elif party == structs.Party.DEM:
@@ -105,7 +331,7 @@ def handle_candidate_results(
                 last_name=record.last,
                 pop_vote=record.votecount,
                 pop_pct=record.votepct,
-                pop_vote_history=historical_counts.get(record.elex_id, {}),
+                pop_vote_history=candidate_history(historical_counts, record.elex_id),
             )
             return
 
@@ -113,125 +339,374 @@ def handle_candidate_results(
     data.oth.pop_vote += record.votecount
     data.oth.pop_pct += record.votepct
 
+    if other_histories is not None:
+        other_histories.add(data.oth, record.elex_id)
+        return
+
     # Merge the candidate's historical counts into the overall historical
     # counts
-    for datetime_str, count in historical_counts.get(record.elex_id, {}).items():
-        if datetime_str in data.oth.pop_vote_history:
-            data.oth.pop_vote_history[datetime_str] += count
-        else:
-            data.oth.pop_vote_history[datetime_str] = count
+    history = candidate_history(historical_counts, record.elex_id)
+    oth_history = data.oth.pop_vote_history
+    if isinstance(history, list) and isinstance(oth_history, list):
+        oth_history.extend([None] * (len(history) - len(oth_history)))
+        for i, count in enumerate(history):
+            if count is not None:
+                current = oth_history[i]
+                oth_history[i] = count if current is None else current + count
+    elif isinstance(history, dict) and isinstance(oth_history, dict):
+        for datetime_str, count in history.items():
+            if datetime_str in oth_history:
+                oth_history[datetime_str] += count
+            else:
+                oth_history[datetime_str] = count
+    else:
+        raise RuntimeError("Mismatched pop_vote_history formats")
+
+
+def candidates_query(filter_sql: str) -> str:
+    """
+    Returns a query for the elex_ids of the general election candidates
+    matching filter_sql (which can use any of the ap_candidate columns)
+    """
+    return f"SELECT elex_id FROM ap_candidate WHERE racetypeid = 'G' AND {filter_sql}"
+
+
+def historicals_query(filter_sql: str) -> str:
+    """
+    Returns the query for the historical results matching filter_sql. Its
+    parameters are given by historicals_params.
+
+    This reads ap_result_history, which only has a row when a count changes.
+    A count that last changed before HISTORICAL_START is reported as of the
+    first waypoint after it.
+    """
+    return f"""
+        SELECT
+            -- If the vote count did not change for a particular election
+            -- between two waypoints, we don't need to report the intermediate
+            -- values. We report only the first value (as per the ORDER BY
+            -- below)
+            DISTINCT ON (elex_id, votecount)
+            waypoint_60_dt,
+            elex_id,
+            votecount
+        FROM (
+            -- Every change from before the first waypoint after
+            -- HISTORICAL_START is moved up to that waypoint, where we only
+            -- keep the latest one
+            SELECT DISTINCT ON (
+                ap_result_history.elex_id,
+                GREATEST(ap_result_history.waypoint_60_dt, first_waypoint.waypoint_60_dt)
+            )
+                GREATEST(
+                    ap_result_history.waypoint_60_dt, first_waypoint.waypoint_60_dt
+                ) AS waypoint_60_dt,
+                ap_result_history.elex_id,
+                ap_result_history.votecount
+            FROM ap_result_history
+            JOIN ingest_run ON ingest_run.ingest_id = ap_result_history.ingest_id
+            CROSS JOIN (
+                SELECT MIN(waypoint_60_dt) AS waypoint_60_dt
+                FROM ingest_run
+                WHERE waypoint_60_dt IS NOT NULL
+                    AND ingest_dt > %s
+                    AND ingest_dt < %s
+            ) first_waypoint
+            WHERE first_waypoint.waypoint_60_dt IS NOT NULL
+                AND ingest_run.ingest_dt < %s
+                AND ap_result_history.elex_id IN ({candidates_query(filter_sql)})
+            ORDER BY
+                ap_result_history.elex_id,
+                GREATEST(ap_result_history.waypoint_60_dt, first_waypoint.waypoint_60_dt),
+                ap_result_history.waypoint_60_dt DESC
+        ) changes
+        ORDER BY elex_id, votecount, waypoint_60_dt ASC
+    """
+
+
+def historicals_params(ingest_run_dt: datetime, filter_params: List[Any]) -> List[Any]:
+    return [HISTORICAL_START, ingest_run_dt, ingest_run_dt] + filter_params
+
+
+def historicals_since_query(filter_sql: str) -> str:
+    """
+    Returns the query for the changes to the historical results matching
+    filter_sql after a waypoint, for bringing cached historicals up to date.
+    Its parameters are given by historicals_since_params.
+
+    This doesn't move anything up to the first waypoint after
+    HISTORICAL_START like historicals_query does, so the cached waypoint must
+    be at or after that one.
+    """
+    return f"""
+        SELECT
+            ap_result_history.waypoint_60_dt,
+            ap_result_history.elex_id,
+            ap_result_history.votecount
+        FROM ap_result_history
+        JOIN ingest_run ON ingest_run.ingest_id = ap_result_history.ingest_id
+        WHERE ap_result_history.waypoint_60_dt > %s
+            AND ingest_run.ingest_dt > %s
+            AND ingest_run.ingest_dt < %s
+            AND ap_result_history.elex_id IN ({candidates_query(filter_sql)})
+        ORDER BY ap_result_history.elex_id, ap_result_history.waypoint_60_dt
+    """
+
+
+def historicals_since_params(
+    waypoint_60_dt: datetime, ingest_run_dt: datetime, filter_params: List[Any]
+) -> List[Any]:
+    return [waypoint_60_dt, HISTORICAL_START, ingest_run_dt] + filter_params
+
+
+WaypointRange = NamedTuple(
+    "WaypointRange",
+    [
+        ("first_waypoint_60_dt", Optional[datetime]),
+        ("latest_waypoint_60_dt", Optional[datetime]),
+    ],
+)
+
+# The first waypoint after HISTORICAL_START (the one historicals_query moves
+# the earlier counts up to) and the latest waypoint, as of an ingest. Its
+# parameters are given by waypoint_range_params.
+WAYPOINT_RANGE_QUERY = """
+    SELECT
+        MIN(waypoint_60_dt) FILTER (WHERE ingest_dt > %s) AS first_waypoint_60_dt,
+        MAX(waypoint_60_dt) AS latest_waypoint_60_dt
+    FROM ingest_run
+    WHERE ingest_dt < %s
+"""
+
+
+def waypoint_range_params(ingest_run_dt: datetime) -> List[Any]:
+    return [HISTORICAL_START, ingest_run_dt]
+
+
+def historicals_from_records(records: Iterable[Any]) -> HistoricalResults:
+    """
+    Builds a map of (elex id -> { waypoint_dt -> count}) from records with
+    waypoint_60_dt, elex_id, and votecount attributes
+    """
+    historical_counts: HistoricalResults = {}
+    for record in records:
+        if record.elex_id not in historical_counts:
+            historical_counts[record.elex_id] = {}
+        historical_counts[record.elex_id][str(record.waypoint_60_dt)] = record.votecount
+
+    return historical_counts
 
 
 def load_historicals(
     ingest_run_dt: datetime, filter_sql: str, filter_params: List[Any]
 ) -> HistoricalResults:
-    historical_counts: HistoricalResults = {}
-
     with get_ro_cursor() as cursor:
-        # Fetch historical results and produce a map of (elex id -> { waypoint_dt -> count})
+        # Fetch historical results and produce a map of (elex id -> { waypoint_dt -> count}).
+        # Every state export runs the same query, so we prepare it.
+        execute_prepared(
+            cursor,
+            historicals_query(filter_sql),
+            historicals_params(ingest_run_dt, filter_params),
+        )
+        return historicals_from_records(cursor)
+
+
+def historicals_by_state_query(filter_sql: str) -> str:
+    """
+    Returns the query for the historical results matching filter_sql, with
+    the statepostal of each. Its parameters are given by historicals_params.
+    """
+    return f"""
+        SELECT historicals.*, ap_candidate.statepostal
+        FROM ({historicals_query(filter_sql)}) historicals
+        JOIN ap_candidate ON ap_candidate.elex_id = historicals.elex_id
+        ORDER BY historicals.elex_id, historicals.votecount, historicals.waypoint_60_dt
+    """
+
+
+def load_historicals_by_state(
+    ingest_run_dt: datetime,
+    filter_sql: str,
+    filter_params: List[Any],
+    itersize: int,
+) -> Dict[str, HistoricalResults]:
+    """
+    Like load_historicals, but split by state: returns a map of (statepostal
+    -> historicals). The results are streamed from a server-side cursor,
+    itersize rows at a time.
+    """
+    historicals_by_state: Dict[str, HistoricalResults] = {}
+    with get_ro_cursor(name="historicals_by_state", itersize=itersize) as cursor:
         cursor.execute(
-            f"""
-            SELECT
-                -- If the vote count did not change for a particular election
-                -- between two waypoints, we don't need to report the intermediate
-                -- values. We report only the first value (as per the ORDER BY
-                -- below)
-                DISTINCT ON (elex_id, votecount)
-                ingest_run.waypoint_60_dt,
-                ap_result.elex_id,
-                ap_result.votecount
-            FROM ap_result
-            JOIN ingest_run ON ingest_run.ingest_id = ap_result.ingest_id
-            WHERE ingest_run.waypoint_60_dt IS NOT NULL
-                AND racetypeid = 'G'
-                AND ingest_dt < %s
-                AND ingest_dt > %s
-                AND {filter_sql}
-            ORDER BY elex_id, votecount, waypoint_60_dt ASC
-            """,
-            [ingest_run_dt, HISTORICAL_START] + filter_params,
+            historicals_by_state_query(filter_sql),
+            historicals_params(ingest_run_dt, filter_params),
         )
+
         for record in cursor:
+            if record.statepostal not in historicals_by_state:
+                historicals_by_state[record.statepostal] = {}
+            historical_counts = historicals_by_state[record.statepostal]
+
             if record.elex_id not in historical_counts:
                 historical_counts[record.elex_id] = {}
             historical_counts[record.elex_id][
                 str(record.waypoint_60_dt)
             ] = record.votecount
 
-    return historical_counts
+    return historicals_by_state
 
 
-def load_election_results(
-    ingest_run_id: str, filter_sql: str, filter_params: List[Any]
-) -> Generator[SQLRecord, None, None]:
-    # Use the RW cursor to make sure we have the latest data
-    with get_cursor() as cursor:
-        # Iterate over every result
-        cursor.execute(
-            f"""
-            SELECT
-                ingest_id,
+def partition_historicals_by_state(
+    historical_counts: AnyHistoricalResults,
+    records_by_state: Mapping[str, Iterable[SQLRecord]],
+) -> Dict[str, AnyHistoricalResults]:
+    """
+    Splits the historicals for several states (e.g. the cached county
+    historicals) into a map of (statepostal -> historicals), like
+    load_historicals_by_state. Each state gets the histories of the elex_ids
+    in its records (as partition_by_state returns them), which are the only
+    ones its export looks up. Compact historicals keep their waypoints.
+    """
+    if isinstance(historical_counts, CompactHistoricalResults):
+        counts: Mapping[str, Any] = historical_counts.counts
+    else:
+        counts = historical_counts
+
+    historicals_by_state: Dict[str, AnyHistoricalResults] = {}
+    for statepostal, records in records_by_state.items():
+        if hasattr(records, "columns"):
+            # This is an IngestTable, so we can read the elex_ids without
+            # building the records
+            elex_ids: Iterable[str] = records.columns["elex_id"]  # type: ignore
+        else:
+            elex_ids = (record.elex_id for record in records)
+
+        state_counts = {
+            elex_id: counts[elex_id] for elex_id in elex_ids if elex_id in counts
+        }
+        if isinstance(historical_counts, CompactHistoricalResults):
+            historicals_by_state[statepostal] = CompactHistoricalResults(
+                historical_counts.waypoints, state_counts
+            )
+        else:
+            historicals_by_state[statepostal] = state_counts
 
-                -- A unique ID for the race that is stable across ingest
-                -- runs. Used to correlate current data with historical data.
-                elex_id,
+    return historicals_by_state
 
-                -- The state code for the result
-                statepostal,
 
-                -- FIPS code for county-level results
-                fipscode,
+def election_results_query(filter_sql: str) -> str:
+    """
+    Returns the query for the results matching filter_sql as of an ingest. Its
+    parameters are given by election_results_params.
+    """
+    return f"""
+        SELECT
+            ap_result.ingest_id,
+
+            -- A unique ID for the race that is stable across ingest
+            -- runs. Used to correlate current data with historical data.
+            ap_result.elex_id,
+
+            -- The state code for the result
+            statepostal,
 
-                -- national, state, or district
-                -- district is for ME and NE congressional district presidential results
-                level,
+            -- FIPS code for county-level results
+            fipscode,
 
-                -- For ME and NE districts, this gives us which district
-                -- (or "At Large" for statewide seats)
-                reportingunitname,
+            -- national, state, or district
+            -- district is for ME and NE congressional district presidential results
+            level,
 
-                -- P, S, or H
-                officeid,
+            -- For ME and NE districts, this gives us which district
+            -- (or "At Large" for statewide seats)
+            reportingunitname,
 
-                -- For house races, which house race. Also for the GA sentate, this
-                -- is null for the regular race and 2 for the special. Note that the
-                -- AP marks at-large districts as seatnum=1
-                seatnum,
+            -- P, S, or H
+            officeid,
 
-                -- Dem, GOP, or one of many others
-                party,
+            -- For house races, which house race. Also for the GA sentate, this
+            -- is null for the regular race and 2 for the special. Note that the
+            -- AP marks at-large districts as seatnum=1
+            seatnum,
 
-                -- Candidate name
-                first,
-                last,
+            -- Dem, GOP, or one of many others
+            party,
 
-                -- Electoral votes awarded in this race
-                electtotal,
+            -- Candidate name
+            first,
+            last,
 
-                -- Electoral votes won by this candidate. Used to work around a bug
-                -- in the AP's reporting of congressional district winners.
-                electwon,
+            -- Electoral votes awarded in this race
+            electtotal,
 
-                -- Number of votes cast for this candidate
-                votecount,
+            -- Electoral votes won by this candidate. Used to work around a bug
+            -- in the AP's reporting of congressional district winners.
+            electwon,
 
-                -- Percent of votes cast for this candidate
-                votepct,
+            -- Number of votes cast for this candidate
+            votecount,
 
-                -- Whether the AP has called the race for this candidate
-                winner
+            -- Percent of votes cast for this candidate
+            votepct,
+
+            -- Whether the AP has called the race for this candidate
+            winner
+        -- Rebuild the full counts for this ingest (which may only have
+        -- stored the rows that changed). This is ap_result_snapshot (see
+        -- init.sql), but only for the candidates we want.
+        FROM (
+            SELECT DISTINCT ON (elex_id) *
             FROM ap_result
-            WHERE ingest_id = %s
-                AND racetypeid = 'G'
-                AND {filter_sql}
-
-            -- Order by votes, descending. This means we can work through the
-            -- results in order, and mark the first dem/gop candidate we see as
-            -- the leading candidate (and fold other candidates into the "other"
-            -- totals)
-            ORDER BY votecount DESC
-            """,
-            [ingest_run_id] + filter_params,
+            WHERE ingest_id <= %s
+                AND ingest_id >= (
+                    SELECT MAX(ingest_id)
+                    FROM ingest_run
+                    WHERE ingest_id <= %s
+                        AND ap_result_mode = 'full'
+                )
+                AND elex_id IN ({candidates_query(filter_sql)})
+            ORDER BY elex_id, ingest_id DESC
+        ) AS ap_result
+        -- ...and the candidate, race and reporting unit for each one
+        JOIN ap_candidate ON ap_candidate.elex_id = ap_result.elex_id
+
+        -- Order by votes, descending. This means we can work through the
+        -- results in order, and mark the first dem/gop candidate we see as
+        -- the leading candidate (and fold other candidates into the "other"
+        -- totals)
+        ORDER BY votecount DESC
+    """
+
+
+def election_results_params(
+    ingest_run_id: Union[int, str], filter_params: List[Any]
+) -> List[Any]:
+    return [ingest_run_id, ingest_run_id] + filter_params
+
+
+def load_election_results(
+    ingest_run_id: Union[int, str],
+    filter_sql: str,
+    filter_params: List[Any],
+    itersize: Optional[int] = None,
+) -> Generator[SQLRecord, None, None]:
+    """
+    Yields the results matching filter_sql as of an ingest, ordered by
+    votecount (descending). With an itersize, the results are streamed from a
+    server-side cursor, itersize rows at a time, so we can start processing
+    them as soon as the first batch arrives and never hold all of them in
+    memory.
+    """
+    # Read from the replica only if it has this ingest
+    with get_fresh_cursor(
+        ingest_id=ingest_run_id,
+        name="election_results" if itersize else None,
+        itersize=itersize,
+    ) as cursor:
+        # Iterate over every result
+        cursor.execute(
+            election_results_query(filter_sql),
+            election_results_params(ingest_run_id, filter_params),
         )
 
         for record in cursor:
@@ -241,39 +716,48 @@ def load_election_results(
 Comments = Dict[str, Dict[str, List[structs.Comment]]]
 
 
-def load_comments() -> Comments:
+def comments_from_records(records: Iterable[Any]) -> Comments:
+    """
+    Builds the comments for each race from rows of the comments table, which
+    should be ordered by ts DESC
+    """
     comments: Comments = {"P": {}, "S": {}, "H": {}, "N": {"N": []}}
-    with get_cursor() as cursor:
-        cursor.execute("SELECT * FROM comments ORDER BY ts DESC")
+    for record in records:
+        office = comments[record.office_id]
 
-        for record in cursor:
-            office = comments[record.office_id]
+        # "N" (national) comments don't have races
+        race = "N" if record.office_id == "N" else record.race
 
-            # "N" (national) comments don't have races
-            race = "N" if record.office_id == "N" else record.race
+        if race not in office:
+            office[race] = []
 
-            if race not in office:
-                office[race] = []
-
-            office[race].append(
-                structs.Comment(
-                    timestamp=record.ts,
-                    author=record.submitted_by,
-                    title=record.title,
-                    body=record.body,
-                )
+        office[race].append(
+            structs.Comment(
+                timestamp=record.ts,
+                author=record.submitted_by,
+                title=record.title,
+                body=record.body,
             )
+        )
 
     return comments
 
 
+def load_comments() -> Comments:
+    # Read from the replica only if it has the latest comments sync
+    with get_fresh_cursor(lsn=load_primary_lsn()) as cursor:
+        cursor.execute("SELECT * FROM comments ORDER BY ts DESC")
+        return comments_from_records(cursor)
+
+
 Calls = Dict[str, Dict[str, bool]]
 
 
 def load_calls() -> Calls:
     calls: Calls = {"P": {}, "S": {}}
 
-    with get_cursor() as cursor:
+    # Read from the replica only if it has the latest calls sync
+    with get_fresh_cursor(lsn=load_primary_lsn()) as cursor:
         cursor.execute("SELECT * FROM senate_calls")
         for record in cursor:
             calls["S"][record.state] = record.published
@@ -283,3 +767,139 @@ def load_calls() -> Calls:
             calls["P"][record.state] = record.published
 
     return calls
+
+
+ExportContext = NamedTuple(
+    "ExportContext",
+    [
+        ("historical_counts", Optional[HistoricalResults]),
+        ("waypoint_range", WaypointRange),
+        ("comments", Comments),
+        ("calls", Calls),
+    ],
+)
+
+CommentRecord = NamedTuple(
+    "CommentRecord",
+    [
+        ("ts", datetime),
+        ("submitted_by", str),
+        ("office_id", str),
+        ("race", Optional[str]),
+        ("title", str),
+        ("body", str),
+    ],
+)
+
+HistoricalRecord = NamedTuple(
+    "HistoricalRecord",
+    [("waypoint_60_dt", datetime), ("elex_id", str), ("votecount", int)],
+)
+
+
+def load_export_context(
+    ingest_run_dt: datetime,
+    filter_sql: str,
+    filter_params: List[Any],
+    include_historicals: bool = True,
+) -> ExportContext:
+    """
+    Loads the historicals (as load_historicals), the waypoint range (for the
+    historicals cache), comments, and calls in a single statement, so
+    everything comes from the same snapshot of the database. Without
+    include_historicals (e.g. because they're cached), historical_counts is
+    None.
+
+    Each input comes back as a set of parallel arrays (one per column), which
+    psycopg2 converts to lists of the same types we'd get from a row-by-row
+    query. Every array in a set uses the same ORDER BY, so they line up.
+
+    This reads from the replica if it has caught up with the primary (and so
+    has the latest ingest and the latest comments and calls syncs).
+    """
+    if include_historicals:
+        historicals_sql = f"""
+            SELECT
+                array_agg(waypoint_60_dt ORDER BY elex_id, votecount) AS waypoint_60_dts,
+                array_agg(elex_id ORDER BY elex_id, votecount) AS elex_ids,
+                array_agg(votecount ORDER BY elex_id, votecount) AS votecounts
+            FROM ({historicals_query(filter_sql)}) historicals
+        """
+        params = historicals_params(ingest_run_dt, filter_params)
+    else:
+        historicals_sql = """
+            SELECT
+                NULL::timestamptz[] AS waypoint_60_dts,
+                NULL::text[] AS elex_ids,
+                NULL::integer[] AS votecounts
+        """
+        params = []
+
+    record = fetchone_fresh(
+        f"""
+        SELECT
+            historicals.*,
+            waypoint_range.*,
+            comments.*,
+            (
+                SELECT array_agg(ARRAY[state, published::text] ORDER BY state)
+                FROM senate_calls
+            ) AS senate_calls,
+            (
+                SELECT array_agg(ARRAY[state, published::text] ORDER BY state)
+                FROM president_calls
+            ) AS president_calls
+        FROM ({historicals_sql}) historicals, ({WAYPOINT_RANGE_QUERY}) waypoint_range, (
+            SELECT
+                array_agg(ts ORDER BY {COMMENTS_ORDER}) AS tss,
+                array_agg(submitted_by ORDER BY {COMMENTS_ORDER}) AS submitted_bys,
+                array_agg(office_id ORDER BY {COMMENTS_ORDER}) AS office_ids,
+                array_agg(race ORDER BY {COMMENTS_ORDER}) AS races,
+                array_agg(title ORDER BY {COMMENTS_ORDER}) AS titles,
+                array_agg(body ORDER BY {COMMENTS_ORDER}) AS bodies
+            FROM comments
+        ) comments
+        """,
+        params + waypoint_range_params(ingest_run_dt),
+        check_lsn=True,
+    )
+
+    historical_records = (
+        HistoricalRecord(*row)
+        for row in zip(
+            record.waypoint_60_dts or [],
+            record.elex_ids or [],
+            record.votecounts or [],
+        )
+    )
+    comment_records = (
+        CommentRecord(*row)
+        for row in zip(
+            record.tss or [],
+            record.submitted_bys or [],
+            record.office_ids or [],
+            record.races or [],
+            record.titles or [],
+            record.bodies or [],
+        )
+    )
+    calls: Calls = {
+        "S": {
+            state: published == "true" for state, published in record.senate_calls or []
+        },
+        "P": {
+            state: published == "true"
+            for state, published in record.president_calls or []
+        },
+    }
+
+    return ExportContext(
+        historical_counts=historicals_from_records(historical_records)
+        if include_historicals
+        else None,
+        waypoint_range=WaypointRange(
+            record.first_waypoint_60_dt, record.latest_waypoint_60_dt
+        ),
+        comments=comments_from_records(comment_records),
+        calls=calls,
+    )
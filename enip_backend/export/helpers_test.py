@@ -0,0 +1,62 @@
+from array import array
+
+from .helpers import (
+    CompactHistoricalResults,
+    fingerprint_records,
+    partition_historicals_by_state,
+)
+from .table import IngestTable
+from .testing import sql_record
+
+
+RECORD = sql_record(elex_id="12345-polid-1", votecount=100)
+
+
+def test_fingerprint_records_ignores_ingest_id():
+    assert fingerprint_records([RECORD], "context") == (
+        fingerprint_records([RECORD._replace(ingest_id=2)], "context")
+    )
+
+
+def test_fingerprint_records_changes():
+    fingerprint = fingerprint_records([RECORD], "context")
+
+    assert (
+        fingerprint_records([RECORD._replace(votecount=101)], "context") != fingerprint
+    )
+    assert fingerprint_records([RECORD._replace(winner=True)], "context") != fingerprint
+    assert fingerprint_records([RECORD, RECORD], "context") != fingerprint
+    assert fingerprint_records([], "context") != fingerprint
+    assert fingerprint_records([RECORD], "other context") != fingerprint
+
+
+def test_fingerprint_records_separates_context():
+    # The context strings are delimited, so they can't run into each other
+    assert fingerprint_records([], "ab", "c") != fingerprint_records([], "a", "bc")
+
+
+def test_partition_historicals_by_state():
+    historical_counts = {
+        "12345-polid-1": {"2020-11-03 20:00:00+00:00": 10},
+        "12345-polid-2": {"2020-11-03 20:00:00+00:00": 20},
+    }
+    records_by_state = {
+        "MA": [RECORD],
+        "NY": IngestTable.from_records([RECORD._replace(elex_id="12345-polid-2")]),
+        "CA": [],
+    }
+
+    assert partition_historicals_by_state(historical_counts, records_by_state) == {
+        "MA": {"12345-polid-1": {"2020-11-03 20:00:00+00:00": 10}},
+        "NY": {"12345-polid-2": {"2020-11-03 20:00:00+00:00": 20}},
+        "CA": {},
+    }
+
+    # Compact historicals keep all the waypoints
+    compact = CompactHistoricalResults(
+        ["2020-11-03 20:00:00+00:00", "2020-11-03 21:00:00+00:00"],
+        {"12345-polid-1": array("q", [10, 11]), "12345-polid-2": array("q", [20])},
+    )
+    assert partition_historicals_by_state(compact, records_by_state)["NY"] == (
+        CompactHistoricalResults(compact.waypoints, {"12345-polid-2": array("q", [20])})
+    )
@@ -0,0 +1,316 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from ddtrace import tracer
+
+from ..enip_common.config import (
+    HISTORICAL_START,
+    HISTORICALS_CACHE,
+    POP_VOTE_HISTORY_FORMAT,
+)
+from ..enip_common.pg import execute_prepared, get_ro_cursor
+from ..ingest.snapshots import get_snapshot_store
+from .helpers import (
+    MISSING_COUNT,
+    WAYPOINT_RANGE_QUERY,
+    AnyHistoricalResults,
+    CompactHistoricalResults,
+    HistoricalResults,
+    WaypointRange,
+    format_historicals,
+    historicals_from_records,
+    historicals_params,
+    historicals_query,
+    historicals_since_params,
+    historicals_since_query,
+    load_historicals,
+    waypoint_range_params,
+)
+
+# The historicals only change when a new hourly waypoint is ingested, so we
+# cache them between export runs, keyed by filter and tagged with the latest
+# waypoint they include. If the latest waypoint hasn't changed, we don't query
+# the history at all; if there are new waypoints, we only fetch the changes
+# since the cached one and merge them in. The cache lives in memory (so it
+# lasts across warm Lambda invocations), and with HISTORICALS_CACHE=snapshot
+# it's also written to the AP snapshot store so cold starts can use it. The
+# cached historicals are in the form POP_VOTE_HISTORY_FORMAT asks for.
+SNAPSHOT_NAME = "historicals_{key}.json.gz"
+
+CachedHistoricals = NamedTuple(
+    "CachedHistoricals",
+    [("waypoint_60_dt", datetime), ("historical_counts", AnyHistoricalResults)],
+)
+
+CacheKey = Tuple[str, Tuple[Any, ...]]
+
+cache: Dict[CacheKey, CachedHistoricals] = {}
+cache_lock = threading.Lock()
+
+
+def find_cache_key(historical_counts: AnyHistoricalResults) -> Optional[CacheKey]:
+    """
+    Returns the key historical_counts are cached under, or None if they aren't
+    (or are no longer) the cached historicals for any key
+    """
+    with cache_lock:
+        for key, cached in cache.items():
+            if cached.historical_counts is historical_counts:
+                return key
+    return None
+
+
+def snapshot_name(key: CacheKey) -> str:
+    # The history depends on HISTORICAL_START too, and we only read snapshots
+    # in the format we're using
+    digest = hashlib.sha1(
+        json.dumps(
+            [key[0], list(key[1]), str(HISTORICAL_START), POP_VOTE_HISTORY_FORMAT],
+            default=str,
+        ).encode()
+    )
+    return SNAPSHOT_NAME.format(key=digest.hexdigest()[:16])
+
+
+def read_snapshot(store, key: CacheKey) -> Optional[CachedHistoricals]:
+    content = store.read(snapshot_name(key))
+    if not content:
+        return None
+
+    snapshot = json.loads(gzip.decompress(content))
+    historical_counts: AnyHistoricalResults = snapshot["historical_counts"]
+    if "waypoints" in snapshot:
+        historical_counts = CompactHistoricalResults(
+            waypoints=snapshot["waypoints"],
+            counts={
+                elex_id: array("q", counts)
+                for elex_id, counts in snapshot["historical_counts"].items()
+            },
+        )
+
+    return CachedHistoricals(
+        waypoint_60_dt=datetime.fromisoformat(snapshot["waypoint_60_dt"]),
+        historical_counts=historical_counts,
+    )
+
+
+def write_snapshot(store, key: CacheKey, cached: CachedHistoricals) -> None:
+    snapshot: Dict[str, Any] = {"waypoint_60_dt": cached.waypoint_60_dt.isoformat()}
+    if isinstance(cached.historical_counts, CompactHistoricalResults):
+        snapshot["waypoints"] = cached.historical_counts.waypoints
+        snapshot["historical_counts"] = {
+            elex_id: counts.tolist()
+            for elex_id, counts in cached.historical_counts.counts.items()
+        }
+    else:
+        snapshot["historical_counts"] = cached.historical_counts
+
+    store.write(snapshot_name(key), gzip.compress(json.dumps(snapshot).encode()))
+
+
+def merge_historicals(
+    historical_counts: HistoricalResults, records: Iterable[Any]
+) -> HistoricalResults:
+    """
+    Returns historical_counts with the changes in records (with
+    waypoint_60_dt, elex_id, and votecount attributes, for waypoints after
+    the ones in historical_counts) merged in, as if we'd loaded them all at
+    once. historical_counts isn't modified, since other threads may be using
+    it.
+    """
+    merged = dict(historical_counts)
+    changed = set()
+    for record in records:
+        if record.elex_id not in changed:
+            merged[record.elex_id] = dict(merged.get(record.elex_id, {}))
+            changed.add(record.elex_id)
+
+        # Like the DISTINCT ON in historicals_query, we only report the first
+        # waypoint with each count
+        counts = merged[record.elex_id]
+        if record.votecount not in counts.values():
+            counts[str(record.waypoint_60_dt)] = record.votecount
+
+    # historicals_query orders each candidate's counts by votecount
+    for elex_id in changed:
+        merged[elex_id] = dict(
+            sorted(
+                merged[elex_id].items(),
+                key=lambda item: (item[1] is None, item[1] or 0),
+            )
+        )
+
+    return merged
+
+
+def merge_compact_historicals(
+    historical_counts: CompactHistoricalResults, records: Iterable[Any]
+) -> CompactHistoricalResults:
+    """
+    Like merge_historicals, for the compact form. The new waypoints go on the
+    end of the waypoints, and only the arrays of the candidates with new
+    counts are copied.
+    """
+    # Pick out the new counts first (the first waypoint with each count, like
+    # merge_historicals), so we know which waypoints we're adding
+    new_counts = []
+    seen_counts: Dict[str, set] = {}
+    for record in records:
+        if record.elex_id not in seen_counts:
+            seen_counts[record.elex_id] = set(
+                historical_counts.counts.get(record.elex_id, [])
+            )
+        count = MISSING_COUNT if record.votecount is None else record.votecount
+        if count not in seen_counts[record.elex_id]:
+            seen_counts[record.elex_id].add(count)
+            new_counts.append((record.elex_id, record.waypoint_60_dt, count))
+
+    waypoints = list(historical_counts.waypoints)
+    index = {waypoint: i for i, waypoint in enumerate(waypoints)}
+    for waypoint_60_dt in sorted(
+        {waypoint_60_dt for _, waypoint_60_dt, _ in new_counts}
+    ):
+        if str(waypoint_60_dt) not in index:
+            index[str(waypoint_60_dt)] = len(waypoints)
+            waypoints.append(str(waypoint_60_dt))
+
+    counts = dict(historical_counts.counts)
+    changed = set()
+    for elex_id, waypoint_60_dt, count in new_counts:
+        if elex_id not in changed:
+            counts[elex_id] = array("q", counts.get(elex_id, []))
+            changed.add(elex_id)
+
+        series = counts[elex_id]
+        position = index[str(waypoint_60_dt)]
+        series.extend([MISSING_COUNT] * (position + 1 - len(series)))
+        series[position] = count
+
+    return CompactHistoricalResults(waypoints, counts)
+
+
+def load_waypoint_range(cursor, ingest_run_dt: datetime) -> WaypointRange:
+    """
+    Loads the waypoint range (see WAYPOINT_RANGE_QUERY) as of ingest_run_dt
+    """
+    cursor.execute(WAYPOINT_RANGE_QUERY, waypoint_range_params(ingest_run_dt))
+    record = cursor.fetchone()
+    return WaypointRange(record.first_waypoint_60_dt, record.latest_waypoint_60_dt)
+
+
+def peek_cached_historicals(
+    filter_sql: str, filter_params: List[Any]
+) -> Optional[CachedHistoricals]:
+    """
+    Returns the historicals cached in memory for filter_sql, if any (they may
+    not be usable for a given ingest: see load_cached_historicals)
+    """
+    with cache_lock:
+        return cache.get((filter_sql, tuple(filter_params)))
+
+
+def load_cached_historicals(
+    ingest_run_dt: datetime,
+    filter_sql: str,
+    filter_params: List[Any],
+    waypoint_range: Optional[WaypointRange] = None,
+    loaded_counts: Optional[HistoricalResults] = None,
+) -> AnyHistoricalResults:
+    """
+    Returns the same historicals as load_historicals (in the form
+    POP_VOTE_HISTORY_FORMAT asks for), from the cache if we can.
+
+    If the caller has already loaded the waypoint range as of ingest_run_dt
+    (e.g. in load_export_context), we don't load it again, and if it has
+    already loaded the historicals themselves (loaded_counts, as
+    load_historicals returns them), we use those rather than the snapshot
+    store or another query when the cache misses.
+    """
+    if HISTORICALS_CACHE == "none":
+        if loaded_counts is not None:
+            return loaded_counts
+        return load_historicals(ingest_run_dt, filter_sql, filter_params)
+    elif HISTORICALS_CACHE not in ("memory", "snapshot"):
+        raise RuntimeError(f"Invalid HISTORICALS_CACHE: {HISTORICALS_CACHE}")
+
+    key: CacheKey = (filter_sql, tuple(filter_params))
+    store = get_snapshot_store() if HISTORICALS_CACHE == "snapshot" else None
+
+    with tracer.trace("enip.export.historicals_cache", resource=filter_sql) as span:
+        if waypoint_range is None:
+            with get_ro_cursor() as cursor:
+                waypoint_range = load_waypoint_range(cursor, ingest_run_dt)
+        first_waypoint, latest_waypoint = waypoint_range
+
+        with cache_lock:
+            cached = cache.get(key)
+        if cached is None and store and loaded_counts is None:
+            cached = read_snapshot(store, key)
+
+        # Until there's a waypoint after HISTORICAL_START, there are no
+        # historicals to cache. And historicals cached as of an earlier
+        # waypoint than that one don't have the counts from before
+        # HISTORICAL_START moved up to it, so we can't merge into them.
+        if cached and (
+            first_waypoint is None or cached.waypoint_60_dt < first_waypoint
+        ):
+            cached = None
+
+        if cached and latest_waypoint and cached.waypoint_60_dt == latest_waypoint:
+            outcome = "hit"
+            historical_counts = cached.historical_counts
+        elif cached and latest_waypoint and cached.waypoint_60_dt < latest_waypoint:
+            outcome = "merge"
+            with get_ro_cursor() as cursor:
+                cursor.execute(
+                    historicals_since_query(filter_sql),
+                    historicals_since_params(
+                        cached.waypoint_60_dt, ingest_run_dt, filter_params
+                    ),
+                )
+                if isinstance(cached.historical_counts, CompactHistoricalResults):
+                    historical_counts = merge_compact_historicals(
+                        cached.historical_counts, cursor
+                    )
+                else:
+                    historical_counts = merge_historicals(
+                        cached.historical_counts, cursor
+                    )
+        elif loaded_counts is not None:
+            outcome = "preloaded"
+            historical_counts = format_historicals(loaded_counts)
+        else:
+            # Nothing (usable) cached, or we're exporting an older ingest
+            # than the one we cached
+            outcome = "miss"
+            with get_ro_cursor() as cursor:
+                execute_prepared(
+                    cursor,
+                    historicals_query(filter_sql),
+                    historicals_params(ingest_run_dt, filter_params),
+                )
+                historical_counts = format_historicals(historicals_from_records(cursor))
+
+        span.set_tag("enip.export.historicals_cache", outcome)
+
+    if first_waypoint and latest_waypoint:
+        updated = CachedHistoricals(latest_waypoint, historical_counts)
+        with cache_lock:
+            current = cache.get(key)
+            # Don't replace the cache with an older export's historicals
+            if current is None or current.waypoint_60_dt <= latest_waypoint:
+                cache[key] = updated
+
+        if store and outcome != "hit":
+            try:
+                write_snapshot(store, key, updated)
+            except Exception:
+                logging.exception("Failed to write the historicals snapshot")
+
+    return historical_counts
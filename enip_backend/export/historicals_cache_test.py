@@ -0,0 +1,272 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from ..ingest.snapshots import LocalSnapshotStore
+from . import historicals_cache
+from .helpers import HistoricalRecord, compact_historicals, historicals_from_records
+from .historicals_cache import (
+    CachedHistoricals,
+    WaypointRange,
+    load_cached_historicals,
+    merge_compact_historicals,
+    merge_historicals,
+    read_snapshot,
+    write_snapshot,
+)
+
+START = datetime(2020, 11, 3, 20, 0, tzinfo=timezone.utc)
+
+# The counts for each candidate at each hourly waypoint
+WAYPOINT_COUNTS = [
+    {"dem": 0, "gop": 0},
+    {"dem": 10, "gop": 5},
+    {"dem": 10, "gop": 8},
+    {"dem": 25, "gop": 8, "lib": 1},
+    # A correction, back to an earlier count
+    {"dem": 10, "gop": 9, "lib": 1},
+    {"dem": 30, "gop": 7, "lib": 2},
+]
+
+
+def waypoint(i):
+    return START + timedelta(hours=i)
+
+
+def full_load(n_waypoints, first_waypoint=0):
+    """
+    What historicals_query returns for the first n_waypoints: the first
+    waypoint with each count, ordered by elex_id and votecount. The counts
+    from before first_waypoint (the first one after HISTORICAL_START) are
+    moved up to it, so it's as if they start there.
+    """
+    first_waypoints = {}
+    for i, counts in enumerate(WAYPOINT_COUNTS[:n_waypoints]):
+        if i < first_waypoint:
+            continue
+        for elex_id, votecount in counts.items():
+            first_waypoints.setdefault((elex_id, votecount), i)
+
+    return historicals_from_records(
+        HistoricalRecord(waypoint(i), elex_id, votecount)
+        for (elex_id, votecount), i in sorted(first_waypoints.items())
+    )
+
+
+def history_changes(start, end):
+    """
+    The ap_result_history rows for waypoints start to end: each count that
+    differs from the previous waypoint's
+    """
+    records = []
+    for i in range(start, end):
+        previous = WAYPOINT_COUNTS[i - 1] if i > 0 else {}
+        for elex_id, votecount in WAYPOINT_COUNTS[i].items():
+            if previous.get(elex_id) != votecount:
+                records.append(HistoricalRecord(waypoint(i), elex_id, votecount))
+    return sorted(records, key=lambda record: (record.elex_id, record.waypoint_60_dt))
+
+
+@pytest.mark.parametrize("n_cached", range(1, len(WAYPOINT_COUNTS)))
+def test_merge_historicals_matches_full_load(n_cached):
+    cached = full_load(n_cached)
+    merged = merge_historicals(cached, history_changes(n_cached, len(WAYPOINT_COUNTS)))
+
+    expected = full_load(len(WAYPOINT_COUNTS))
+    assert merged == expected
+    # The order of each candidate's counts is the order they're exported in
+    for elex_id, counts in expected.items():
+        assert list(merged[elex_id].items()) == list(counts.items())
+
+    # The cached historicals are left alone
+    assert cached == full_load(n_cached)
+
+
+@pytest.mark.parametrize("n_cached", range(1, len(WAYPOINT_COUNTS)))
+def test_merge_compact_historicals_matches_full_load(n_cached):
+    cached = compact_historicals(full_load(n_cached))
+    merged = merge_compact_historicals(
+        cached, history_changes(n_cached, len(WAYPOINT_COUNTS))
+    )
+
+    assert merged == compact_historicals(full_load(len(WAYPOINT_COUNTS)))
+    assert cached == compact_historicals(full_load(n_cached))
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_snapshot_round_trip(tmp_path, compact):
+    historical_counts = full_load(len(WAYPOINT_COUNTS))
+    if compact:
+        historical_counts = compact_historicals(historical_counts)
+    cached = CachedHistoricals(waypoint(len(WAYPOINT_COUNTS) - 1), historical_counts)
+
+    store = LocalSnapshotStore(str(tmp_path))
+    key = ("level = 'state'", ())
+    assert read_snapshot(store, key) is None
+
+    write_snapshot(store, key, cached)
+    assert read_snapshot(store, key) == cached
+
+
+class FakeConnection:
+    pass
+
+
+class FakeCursor:
+    def __init__(self, first_waypoint, latest_waypoint, rows):
+        self.connection = FakeConnection()
+        self.first_waypoint = first_waypoint
+        self.latest_waypoint = latest_waypoint
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((" ".join(sql.split()), params))
+
+    def fetchone(self):
+        return WaypointRange(self.first_waypoint, self.latest_waypoint)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def records(historical_counts):
+    return [
+        HistoricalRecord(waypoint, elex_id, votecount)
+        for elex_id, counts in historical_counts.items()
+        for waypoint, votecount in counts.items()
+    ]
+
+
+@pytest.fixture
+def load(mocker):
+    """
+    Returns a function that calls load_cached_historicals as of the first
+    n_waypoints, with the first one after HISTORICAL_START at first_waypoint
+    (or none yet), where the history query returns rows. It returns the
+    historicals and the history queries we ran.
+    """
+    mocker.patch.object(historicals_cache, "HISTORICALS_CACHE", "memory")
+    mocker.patch.object(historicals_cache, "cache", {})
+    cursors = []
+
+    @contextmanager
+    def get_ro_cursor():
+        yield cursors[-1]
+
+    mocker.patch.object(historicals_cache, "get_ro_cursor", get_ro_cursor)
+
+    def load(n_waypoints, rows, first_waypoint=0):
+        cursor = FakeCursor(
+            None if first_waypoint is None else waypoint(first_waypoint),
+            waypoint(n_waypoints - 1),
+            rows,
+        )
+        cursors.append(cursor)
+        historical_counts = load_cached_historicals(
+            waypoint(n_waypoints - 1) + timedelta(minutes=5), "level = 'state'", []
+        )
+        return (
+            historical_counts,
+            [sql for sql, _ in cursor.executed if "ap_result_history" in sql],
+        )
+
+    return load
+
+
+def is_since_query(sql):
+    return "ap_result_history.waypoint_60_dt > %s" in sql
+
+
+def test_load_cached_historicals(load):
+    # Nothing cached, so we load everything
+    historical_counts, queries = load(3, records(full_load(3)))
+    assert historical_counts == full_load(3)
+    [sql] = queries
+    assert not is_since_query(sql)
+
+    # Same waypoint, so we don't query the history at all
+    historical_counts, queries = load(3, [])
+    assert historical_counts == full_load(3)
+    assert not queries
+
+    # A new waypoint, so we only fetch the changes since the cached one
+    historical_counts, queries = load(
+        len(WAYPOINT_COUNTS), history_changes(3, len(WAYPOINT_COUNTS))
+    )
+    assert historical_counts == full_load(len(WAYPOINT_COUNTS))
+    [sql] = queries
+    assert is_since_query(sql)
+
+
+def test_load_cached_historicals_across_historical_start(load):
+    # HISTORICAL_START is between waypoints 1 and 2. Before then, there are
+    # no historicals, and nothing is cached.
+    historical_counts, queries = load(2, [], first_waypoint=None)
+    assert historical_counts == {}
+    assert len(queries) == 1
+    assert not historicals_cache.cache
+
+    # So the first export after it loads everything, with the earlier counts
+    # moved up to waypoint 2
+    historical_counts, queries = load(4, records(full_load(4, 2)), first_waypoint=2)
+    assert historical_counts == full_load(4, 2)
+    [sql] = queries
+    assert not is_since_query(sql)
+
+    # And then we can merge in the changes since
+    historical_counts, queries = load(
+        len(WAYPOINT_COUNTS),
+        history_changes(4, len(WAYPOINT_COUNTS)),
+        first_waypoint=2,
+    )
+    assert historical_counts == full_load(len(WAYPOINT_COUNTS), 2)
+    [sql] = queries
+    assert is_since_query(sql)
+
+
+def test_load_cached_historicals_cached_before_historical_start(load):
+    # Historicals cached as of waypoint 1, before HISTORICAL_START (say by an
+    # export with an earlier HISTORICAL_START) can't be merged into
+    key = ("level = 'state'", ())
+    historicals_cache.cache[key] = CachedHistoricals(waypoint(1), full_load(2))
+
+    historical_counts, queries = load(
+        len(WAYPOINT_COUNTS),
+        records(full_load(len(WAYPOINT_COUNTS), 2)),
+        first_waypoint=2,
+    )
+    assert historical_counts == full_load(len(WAYPOINT_COUNTS), 2)
+    [sql] = queries
+    assert not is_since_query(sql)
+    assert historicals_cache.cache[key].waypoint_60_dt == waypoint(
+        len(WAYPOINT_COUNTS) - 1
+    )
+
+
+def test_load_cached_historicals_preloaded(load, mocker):
+    # With the waypoint range and historicals from load_export_context, a
+    # miss doesn't query anything
+    get_ro_cursor = mocker.patch.object(historicals_cache, "get_ro_cursor")
+    waypoint_range = WaypointRange(waypoint(0), waypoint(2))
+    historical_counts = load_cached_historicals(
+        waypoint(2) + timedelta(minutes=5),
+        "level = 'state'",
+        [],
+        waypoint_range=waypoint_range,
+        loaded_counts=full_load(3),
+    )
+    assert historical_counts == full_load(3)
+
+    # And neither does a hit
+    assert (
+        load_cached_historicals(
+            waypoint(2) + timedelta(minutes=10),
+            "level = 'state'",
+            [],
+            waypoint_range=waypoint_range,
+        )
+        is historical_counts
+    )
+    assert not get_ro_cursor.called
@@ -0,0 +1,204 @@
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+
+from ..enip_common.config import EXPORT_NUMPY_HISTORIES, HISTORICALS_CACHE
+from .helpers import MISSING_COUNT, AnyHistoricalResults, CompactHistoricalResults
+from .historicals_cache import CacheKey, find_cache_key
+
+
+class HistoryGrid:
+    """
+    The historicals on a common grid of waypoints: a matrix with a row for
+    each elex_id and a column for each waypoint, holding the candidate's
+    count at that waypoint (or MISSING_COUNT)
+    """
+
+    def __init__(self, historical_counts: AnyHistoricalResults):
+        if isinstance(historical_counts, CompactHistoricalResults):
+            # The counts are already on a grid, so we can copy them straight
+            # in: each series starts at column 0, and some are shorter than
+            # the grid
+            self.waypoints = historical_counts.waypoints
+            series = list(historical_counts.counts.values())
+            lengths = numpy.array([len(counts) for counts in series], dtype=numpy.int64)
+            values = numpy.frombuffer(
+                b"".join(counts.tobytes() for counts in series), dtype=numpy.int64
+            )
+            columns = numpy.arange(len(values)) - numpy.repeat(
+                numpy.cumsum(lengths) - lengths, lengths
+            )
+        else:
+            histories = list(historical_counts.values())
+            self.waypoints = sorted(
+                {waypoint for history in histories for waypoint in history}
+            )
+            index = {waypoint: i for i, waypoint in enumerate(self.waypoints)}
+            lengths = numpy.array(
+                [len(history) for history in histories], dtype=numpy.int64
+            )
+            values = numpy.array(
+                [count for history in histories for count in history.values()],
+                dtype=numpy.int64,
+            )
+            columns = numpy.array(
+                [index[waypoint] for history in histories for waypoint in history],
+                dtype=numpy.int64,
+            )
+
+        elex_ids = (
+            historical_counts.counts
+            if isinstance(historical_counts, CompactHistoricalResults)
+            else historical_counts
+        )
+        self.rows = {elex_id: i for i, elex_id in enumerate(elex_ids)}
+        self.counts = numpy.full(
+            (len(self.rows), len(self.waypoints)), MISSING_COUNT, dtype=numpy.int64
+        )
+        self.counts[
+            numpy.repeat(numpy.arange(len(self.rows)), lengths), columns
+        ] = values
+
+
+# We keep the grid for the historicals in each entry of the historicals cache:
+# it hands out the same historicals until there's a new waypoint, and in a
+# batched export every state shares the county historicals. When there's a
+# new waypoint, the grid for the old historicals is replaced.
+grid_cache: Dict[CacheKey, Tuple[AnyHistoricalResults, HistoryGrid]] = {}
+grid_cache_lock = threading.Lock()
+
+
+def load_grid(historical_counts: AnyHistoricalResults) -> HistoryGrid:
+    """
+    Returns the HistoryGrid for historical_counts, reusing the one we built
+    before if they're the cached historicals we built it for
+    """
+    key = find_cache_key(historical_counts)
+    if key is None:
+        # Nobody else will ask for these historicals, so there's no point
+        # keeping their grid
+        return HistoryGrid(historical_counts)
+
+    with grid_cache_lock:
+        cached = grid_cache.get(key)
+    if cached and cached[0] is historical_counts:
+        return cached[1]
+
+    # Build it outside the lock, so the exports for other historicals don't
+    # wait for us
+    grid = HistoryGrid(historical_counts)
+    with grid_cache_lock:
+        grid_cache[key] = (historical_counts, grid)
+
+        # Drop the grids for any other historicals that are no longer cached
+        for other_key, (other_counts, _) in list(grid_cache.items()):
+            if other_key != key and find_cache_key(other_counts) != other_key:
+                del grid_cache[other_key]
+
+    return grid
+
+
+class OtherHistories:
+    """
+    Collects the candidates that go in each "other" bucket, so that when the
+    export is done we can add up all their histories at once on the
+    HistoryGrid, rather than merging them one candidate at a time
+    """
+
+    def __init__(self, grid: HistoryGrid, compact: bool):
+        self.grid = grid
+        self.compact = compact
+
+        self.buckets: List[Any] = []
+        self.bucket_indexes: Dict[int, int] = {}
+        self.pending_buckets: List[int] = []
+        self.pending_rows: List[int] = []
+
+    @classmethod
+    def for_historicals(
+        cls,
+        historical_counts: AnyHistoricalResults,
+        grid_historicals: Optional[AnyHistoricalResults] = None,
+    ) -> Optional["OtherHistories"]:
+        """
+        Returns an OtherHistories for historical_counts, or None if
+        EXPORT_NUMPY_HISTORIES is off (so handle_candidate_results adds up the
+        "other" histories one candidate at a time). Without the historicals
+        cache, every export has its own historicals, and building a grid for
+        each costs more than it saves.
+
+        If historical_counts are a subset of grid_historicals (with the same
+        waypoints, if they're compact), we use the grid for grid_historicals.
+        """
+        if not EXPORT_NUMPY_HISTORIES or HISTORICALS_CACHE == "none":
+            return None
+
+        return cls(
+            load_grid(
+                historical_counts if grid_historicals is None else grid_historicals
+            ),
+            isinstance(historical_counts, CompactHistoricalResults),
+        )
+
+    def add(self, oth: Any, elex_id: str) -> None:
+        """
+        Adds elex_id's history to oth (a candidate struct) when we finish
+        """
+        bucket = self.bucket_indexes.get(id(oth))
+        if bucket is None:
+            bucket = len(self.buckets)
+            self.bucket_indexes[id(oth)] = bucket
+            self.buckets.append(oth)
+
+        row = self.grid.rows.get(elex_id)
+        if row is not None:
+            self.pending_buckets.append(bucket)
+            self.pending_rows.append(row)
+
+    def finish(self) -> None:
+        """
+        Sets the pop_vote_history of every "other" bucket
+        """
+        grid = self.grid
+        counts = grid.counts[numpy.array(self.pending_rows, dtype=numpy.int64)]
+        present = counts != MISSING_COUNT
+
+        # Add up each bucket's counts, and note the waypoints where any of its
+        # candidates has a count
+        pending_buckets = numpy.array(self.pending_buckets, dtype=numpy.int64)
+        shape = (len(self.buckets), len(grid.waypoints))
+        totals = numpy.zeros(shape, dtype=numpy.int64)
+        numpy.add.at(totals, pending_buckets, numpy.where(present, counts, 0))
+        any_present = numpy.zeros(shape, dtype=bool)
+        numpy.logical_or.at(any_present, pending_buckets, present)
+
+        # Then turn them into pop_vote_histories, leaving as much of the work
+        # as we can to NumPy and the builtins
+        if self.compact:
+            # Each list stops after the bucket's last count
+            lengths = numpy.max(
+                numpy.where(any_present, numpy.arange(1, len(grid.waypoints) + 1), 0),
+                axis=1,
+                initial=0,
+            ).tolist()
+            values = totals.astype(object)
+            values[~any_present] = None
+
+            for oth, row, length in zip(self.buckets, values.tolist(), lengths):
+                oth.pop_vote_history = row[:length]
+        else:
+            bucket_indexes, columns = numpy.nonzero(any_present)
+            waypoints = numpy.array(grid.waypoints, dtype=object)[columns].tolist()
+            bucket_counts = totals[any_present].tolist()
+            bucket_sizes = numpy.bincount(
+                bucket_indexes, minlength=len(self.buckets)
+            ).tolist()
+
+            start = 0
+            for oth, size in zip(self.buckets, bucket_sizes):
+                end = start + size
+                oth.pop_vote_history = dict(
+                    zip(waypoints[start:end], bucket_counts[start:end])
+                )
+                start = end
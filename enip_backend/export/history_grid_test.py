@@ -0,0 +1,166 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from . import historicals_cache, history_grid, structs
+from .helpers import (
+    MISSING_COUNT,
+    compact_historicals,
+    handle_candidate_results,
+    partition_historicals_by_state,
+)
+from .historicals_cache import CachedHistoricals
+from .history_grid import HistoryGrid, OtherHistories
+from .testing import sql_record
+
+HISTORICALS = {
+    "dem": {"2020-11-03 21:00:00+00:00": 20, "2020-11-03 20:00:00+00:00": 10},
+    "gop": {"2020-11-03 20:00:00+00:00": 5},
+    "lib": {"2020-11-03 22:00:00+00:00": 3, "2020-11-03 20:00:00+00:00": 1},
+    "grn": {"2020-11-03 21:00:00+00:00": 2},
+    "dem2": {"2020-11-03 20:00:00+00:00": 7, "2020-11-03 23:00:00+00:00": 8},
+    "ind": {},
+}
+
+# The candidates in each race, in the order we see them
+RACES = [
+    [("dem", "Dem"), ("gop", "GOP"), ("lib", "Lib"), ("grn", "Grn")],
+    [("dem2", "Dem"), ("dem", "Dem"), ("lib", "Lib")],
+    [("gop", "GOP"), ("ind", "Ind"), ("unknown", "Lib")],
+    [("dem", "Dem")],
+]
+
+
+def export_races(historical_counts, other_histories):
+    results = []
+    for race in RACES:
+        result = structs.CountyPresidentialResult()
+        for elex_id, party in race:
+            handle_candidate_results(
+                result,
+                structs.StateSummaryCandidateNamed,
+                sql_record(elex_id=elex_id, party=party),
+                historical_counts,
+                other_histories=other_histories,
+            )
+        results.append(result)
+
+    if other_histories:
+        other_histories.finish()
+
+    # Compare the parsed JSON, since the "other" histories are in waypoint
+    # order rather than the order we merged them in
+    return [json.loads(result.json()) for result in results]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_history_grid(compact):
+    historical_counts = compact_historicals(HISTORICALS) if compact else HISTORICALS
+    grid = HistoryGrid(historical_counts)
+
+    assert grid.waypoints == [
+        "2020-11-03 20:00:00+00:00",
+        "2020-11-03 21:00:00+00:00",
+        "2020-11-03 22:00:00+00:00",
+        "2020-11-03 23:00:00+00:00",
+    ]
+    assert {
+        elex_id: grid.counts[row].tolist() for elex_id, row in grid.rows.items()
+    } == {
+        "dem": [10, 20, MISSING_COUNT, MISSING_COUNT],
+        "gop": [5, MISSING_COUNT, MISSING_COUNT, MISSING_COUNT],
+        "lib": [1, MISSING_COUNT, 3, MISSING_COUNT],
+        "grn": [MISSING_COUNT, 2, MISSING_COUNT, MISSING_COUNT],
+        "dem2": [7, MISSING_COUNT, MISSING_COUNT, 8],
+        "ind": [MISSING_COUNT] * 4,
+    }
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_other_histories_match_merging_each_candidate(compact):
+    historical_counts = compact_historicals(HISTORICALS) if compact else HISTORICALS
+    other_histories = OtherHistories.for_historicals(historical_counts)
+    assert other_histories
+
+    assert export_races(historical_counts, other_histories) == export_races(
+        historical_counts, None
+    )
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_other_histories_on_grid_historicals(compact, mocker):
+    # A state's share of the historicals uses the grid for all of them
+    mocker.patch.object(history_grid, "grid_cache", {})
+    mocker.patch.object(historicals_cache, "cache", {})
+    grid_historicals = compact_historicals(HISTORICALS) if compact else HISTORICALS
+    historicals_cache.cache[("level = 'county'", ())] = CachedHistoricals(
+        datetime(2020, 11, 3, 23, tzinfo=timezone.utc), grid_historicals
+    )
+
+    elex_ids = {elex_id for race in RACES for elex_id, _ in race} - {"ind"}
+    historical_counts = partition_historicals_by_state(
+        grid_historicals, {"MA": [sql_record(elex_id=elex_id) for elex_id in elex_ids]}
+    )["MA"]
+    assert "ind" not in (historical_counts.counts if compact else historical_counts)
+    other_histories = OtherHistories.for_historicals(
+        historical_counts, grid_historicals
+    )
+    assert other_histories.grid is history_grid.load_grid(grid_historicals)
+
+    assert export_races(historical_counts, other_histories) == export_races(
+        historical_counts, None
+    )
+
+
+def test_other_histories_disabled(mocker):
+    mocker.patch.object(history_grid, "EXPORT_NUMPY_HISTORIES", False)
+    assert OtherHistories.for_historicals(HISTORICALS) is None
+
+
+def test_other_histories_without_historicals_cache(mocker):
+    mocker.patch.object(history_grid, "HISTORICALS_CACHE", "none")
+    assert OtherHistories.for_historicals(HISTORICALS) is None
+
+
+def test_load_grid_reuses_grid(mocker):
+    mocker.patch.object(history_grid, "grid_cache", {})
+    mocker.patch.object(historicals_cache, "cache", {})
+
+    def cache(key, historical_counts):
+        historicals_cache.cache[key] = CachedHistoricals(
+            datetime(2020, 11, 3, 23, tzinfo=timezone.utc), historical_counts
+        )
+
+    state_historicals = dict(HISTORICALS)
+    cache(("level = 'state'", ()), HISTORICALS)
+    cache(("level = 'county'", ()), state_historicals)
+
+    grid = history_grid.load_grid(HISTORICALS)
+    assert history_grid.load_grid(HISTORICALS) is grid
+    assert history_grid.load_grid(state_historicals) is not grid
+    assert len(history_grid.grid_cache) == 2
+
+    # Historicals that aren't cached get a grid, but we don't keep it
+    assert history_grid.load_grid(dict(HISTORICALS)) is not grid
+    assert len(history_grid.grid_cache) == 2
+
+    # When there's a new waypoint, the old grid is replaced
+    new_historicals = dict(HISTORICALS)
+    cache(("level = 'state'", ()), new_historicals)
+    new_grid = history_grid.load_grid(new_historicals)
+    assert new_grid is not grid
+    assert history_grid.grid_cache[("level = 'state'", ())] == (
+        new_historicals,
+        new_grid,
+    )
+
+    # And once the other historicals are replaced too, their grid is dropped
+    # with the next one we build
+    cache(("level = 'county'", ()), {})
+    cache(("level = 'national'", ()), new_historicals.copy())
+    history_grid.load_grid(historicals_cache.cache[("level = 'national'", ())][1])
+    assert set(history_grid.grid_cache) == {
+        ("level = 'state'", ()),
+        ("level = 'national'", ()),
+    }
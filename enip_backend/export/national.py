@@ -1,27 +1,31 @@
 import logging
 from datetime import datetime
-from typing import Any, Iterable, List
+from typing import Any, Iterable, List, Optional
 
 from ddtrace import tracer
 
+from ..enip_common.config import EXPORT_RESULTS_ITERSIZE, HISTORICALS_CACHE
 from ..enip_common.states import AT_LARGE_HOUSE_STATES, DISTRICTS_BY_STATE
 from . import structs
 from .helpers import (
-    HistoricalResults,
+    AnyHistoricalResults,
+    CompactHistoricalResults,
     SQLRecord,
+    format_historicals,
     handle_candidate_results,
-    load_calls,
-    load_comments,
     load_election_results,
-    load_historicals,
+    load_export_context,
 )
+from .historicals_cache import load_cached_historicals, peek_cached_historicals
+from .history_grid import OtherHistories
 
 
 class NationalDataExporter:
     def __init__(self, ingest_run_id: str, ingest_run_dt: datetime):
         self.ingest_run_id = ingest_run_id
         self.ingest_run_dt = ingest_run_dt
-        self.historical_counts: HistoricalResults = {}
+        self.historical_counts: AnyHistoricalResults = {}
+        self.other_histories: Optional[OtherHistories] = None
         self.data = structs.NationalData()
 
     def grant_electoral_votes(self, party: structs.Party, count: int) -> None:
@@ -64,6 +68,7 @@ class NationalDataExporter:
             structs.NationalSummaryPresidentCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
     def record_district_result(self, record: SQLRecord) -> None:
@@ -102,6 +107,7 @@ class NationalDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
         # Handle a winner call
@@ -140,6 +146,7 @@ class NationalDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
         # Handle a winner call
@@ -186,6 +193,7 @@ class NationalDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
         # Handle a winner call
@@ -228,6 +236,7 @@ class NationalDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
         # Handle a winner call
@@ -249,16 +258,34 @@ class NationalDataExporter:
         sql_filter = "level IN ('national', 'state', 'district')"
         filter_params: List[Any] = []
 
-        with tracer.trace("enip.export.national.historicals"):
-            self.historical_counts = load_historicals(
-                self.ingest_run_dt, sql_filter, filter_params
+        # Load the comments, calls, and waypoint range in one statement. If
+        # there are no cached historicals to use, the historicals come with
+        # them; otherwise the cache only has to query anything when there's a
+        # new waypoint to merge in.
+        with tracer.trace("enip.export.national.load_context"):
+            context = load_export_context(
+                self.ingest_run_dt,
+                sql_filter,
+                filter_params,
+                include_historicals=HISTORICALS_CACHE == "none"
+                or peek_cached_historicals(sql_filter, filter_params) is None,
             )
+            self.historical_counts = load_cached_historicals(
+                self.ingest_run_dt,
+                sql_filter,
+                filter_params,
+                waypoint_range=context.waypoint_range,
+                loaded_counts=context.historical_counts,
+            )
+            self.comments = context.comments
+            self.calls = context.calls
 
-        with tracer.trace("enip.export.national.load_comments"):
-            self.comments = load_comments()
-
-        with tracer.trace("enip.export.national.load_calls"):
-            self.calls = load_calls()
+        self.historical_counts = format_historicals(self.historical_counts)
+        if isinstance(self.historical_counts, CompactHistoricalResults):
+            self.data = structs.CompactNationalData(
+                history_waypoints=self.historical_counts.waypoints
+            )
+        self.other_histories = OtherHistories.for_historicals(self.historical_counts)
 
         def handle_record(record):
             if record.level == "national":
@@ -281,10 +308,16 @@ class NationalDataExporter:
                 handle_record(record)
         else:
             for record in load_election_results(
-                self.ingest_run_id, sql_filter, filter_params
+                self.ingest_run_id,
+                sql_filter,
+                filter_params,
+                itersize=EXPORT_RESULTS_ITERSIZE,
             ):
                 handle_record(record)
 
+        if self.other_histories is not None:
+            self.other_histories.finish()
+
         # Add commentary
         for race, comments in self.comments["P"].items():
             for comment in comments:
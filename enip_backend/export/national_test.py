@@ -4,7 +4,14 @@ from datetime import datetime, timezone
 import pytest
 
 from . import structs
-from .helpers import Calls, Comments, HistoricalResults, SQLRecord
+from .helpers import (
+    Calls,
+    Comments,
+    ExportContext,
+    HistoricalResults,
+    SQLRecord,
+    WaypointRange,
+)
 from .national import NationalDataExporter
 
 mock_calls: Calls = {}
@@ -22,16 +29,19 @@ def init_mocks(mocker):
     mock_comments = {"P": {}, "S": {}, "H": {}, "N": {"N": []}}
     mock_historicals = {}
 
-    mock_load_calls = mocker.patch("enip_backend.export.national.load_calls")
-    mock_load_calls.return_value = mock_calls
-
-    mock_load_comments = mocker.patch("enip_backend.export.national.load_comments")
-    mock_load_comments.return_value = mock_comments
-
-    mock_load_historicals = mocker.patch(
-        "enip_backend.export.national.load_historicals"
+    mock_load_export_context = mocker.patch(
+        "enip_backend.export.national.load_export_context"
+    )
+    mock_load_export_context.return_value = ExportContext(
+        historical_counts=mock_historicals,
+        waypoint_range=WaypointRange(None, None),
+        comments=mock_comments,
+        calls=mock_calls,
+    )
+    mock_load_cached_historicals = mocker.patch(
+        "enip_backend.export.national.load_cached_historicals"
     )
-    mock_load_historicals.return_value = mock_historicals
+    mock_load_cached_historicals.return_value = mock_historicals
 
 
 @pytest.fixture
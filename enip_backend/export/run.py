@@ -1,6 +1,7 @@
 import json
 import logging
 import random
+import time
 from concurrent.futures import ThreadPoolExecutor
 
 import sentry_sdk
@@ -9,14 +10,33 @@ from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 
 from ..enip_common import s3
-from ..enip_common.config import CDN_URL
+from ..enip_common.config import (
+    CDN_URL,
+    EXPORT_RESULTS_ITERSIZE,
+    EXPORT_THREADS,
+    HISTORICALS_CACHE,
+)
 from ..enip_common.pg import get_ro_cursor
 from ..enip_common.states import STATES
+from .helpers import (
+    fingerprint_records,
+    load_context_fingerprint,
+    load_export_fingerprints,
+    load_historicals_by_state,
+    partition_by_state,
+    partition_historicals_by_state,
+    save_export_fingerprints,
+)
+from .historicals_cache import load_cached_historicals
 from .national import NationalDataExporter
 from .schemas import national_schema, state_schema
-from .state import StateDataExporter
+from .state import COUNTY_FILTER, StateDataExporter
 
-THREADS = 4
+THREADS = EXPORT_THREADS
+
+# Returned in place of the CDN URL for an export we skipped because its inputs
+# hadn't changed since it last ran
+SKIPPED = "skipped"
 
 
 def export_to_s3(ingest_run_id, ingest_run_dt, json_data, schema, path, export_name):
@@ -85,13 +105,34 @@ def export_to_s3(ingest_run_id, ingest_run_dt, json_data, schema, path, export_n
 
 
 @tracer.wrap("enip.export.export_state", service="enip-backend-state-thread")
-def export_state(ingest_run_dt, state_code, ingest_data):
+def export_state(
+    ingest_run_dt,
+    state_code,
+    ingest_data,
+    historical_counts=None,
+    historicals_db_seconds=None,
+    grid_historicals=None,
+    ingest_run_id=0,
+):
+    """
+    Exports one state. If historical_counts isn't given, the exporter loads
+    them, and records how long that took in historicals_db_seconds (a map of
+    state code -> seconds). If historical_counts are this state's share of
+    grid_historicals, the exporter uses the grid for those (see
+    StateDataExporter). ingest_run_id is the ingest ingest_data came from, if
+    it was stored.
+    """
     with tracer.trace("enip.export.export_state.run_export"):
-        data = StateDataExporter(ingest_run_dt, state_code).run_export(ingest_data)
+        exporter = StateDataExporter(
+            ingest_run_dt, state_code, historical_counts, grid_historicals
+        )
+        data = exporter.run_export(ingest_data)
+        if historicals_db_seconds is not None:
+            historicals_db_seconds[state_code] = exporter.historicals_db_seconds
 
     with tracer.trace("enip.export.export_state.export_to_s3"):
         return export_to_s3(
-            0,
+            ingest_run_id,
             ingest_run_dt,
             data.json(by_alias=True),
             state_schema,
@@ -100,8 +141,36 @@ def export_state(ingest_run_dt, state_code, ingest_data):
         )
 
 
+def mark_skipped(skipped):
+    """
+    Tags the current trace span with whether we skipped export work because
+    the inputs hadn't changed
+    """
+    span = tracer.current_span()
+    if span:
+        span.set_tag("enip.export.skipped", skipped)
+
+
 @tracer.wrap("enip.export.export_national")
 def export_national(ingest_run_id, ingest_run_dt, export_name, ingest_data=None):
+    # If we were handed the AP data, check whether anything has changed since
+    # the last national export and skip it if not
+    fingerprint = None
+    if ingest_data is not None:
+        with tracer.trace("enip.export.export_ntl.fingerprint"):
+            fingerprint = fingerprint_records(
+                ingest_data,
+                load_context_fingerprint(
+                    ingest_run_dt, include_comments_and_calls=True
+                ),
+            )
+            unchanged = load_export_fingerprints().get("national") == fingerprint
+
+        mark_skipped(unchanged)
+        if unchanged:
+            logging.info("  Skipping national export: inputs have not changed")
+            return SKIPPED
+
     logging.info("Running national export...")
     with tracer.trace("enip.export.export_ntl.run_export"):
         data = NationalDataExporter(ingest_run_id, ingest_run_dt).run_export(
@@ -123,25 +192,102 @@ def export_national(ingest_run_id, ingest_run_dt, export_name, ingest_data=None)
     else:
         logging.info(f"  National export completed WITHOUT new results: {cdn_url}")
 
+    if fingerprint:
+        save_export_fingerprints({"national": fingerprint})
+
     return cdn_url
 
 
-def export_all_states(ap_data, ingest_run_dt):
-    logging.info(f"Running all state exports from ingest at {str(ingest_run_dt)}...")
+@tracer.wrap("enip.export.export_all_states")
+def export_all_states(ap_data, ingest_run_dt, ingest_run_id=0):
+    """
+    Exports every state whose inputs have changed. ingest_run_dt is when this
+    run started, which the historicals and the exported files are as of, even
+    if ap_data came from an earlier ingest (ingest_run_id).
+    """
+    logging.info(
+        f"Running all state exports from ingest at {str(ingest_run_dt)} (AP data from ingest {ingest_run_id})..."
+    )
     any_failed = False
     results = {}
 
+    # Split the results by state up front, so each state export only walks its
+    # own records rather than the full county-level dataset
+    with tracer.trace("enip.export.export_all_states.partition"):
+        ap_data_by_state = partition_by_state(ap_data)
+
+    # Skip any states whose inputs haven't changed since their last export
+    with tracer.trace("enip.export.export_all_states.fingerprint"):
+        context = load_context_fingerprint(
+            ingest_run_dt, include_comments_and_calls=False
+        )
+        previous_fingerprints = load_export_fingerprints()
+        fingerprints = {
+            state_code: fingerprint_records(
+                ap_data_by_state.get(state_code, []), context
+            )
+            for state_code in STATES
+        }
+
+    changed_states = [
+        state_code
+        for state_code in STATES
+        if previous_fingerprints.get(f"states/{state_code}") != fingerprints[state_code]
+    ]
+    mark_skipped(not changed_states)
+    logging.info(
+        f"  Skipping {len(STATES) - len(changed_states)} state exports with unchanged inputs"
+    )
+    for state_code in STATES:
+        if state_code not in changed_states:
+            results[state_code] = SKIPPED
+    exported_fingerprints = {}
+
+    # Load the county historicals for every state we're exporting at once
+    # (with one query, or from the cache), and hand each state export its
+    # share. The state exports add up the "other" histories on the grid for
+    # the whole set of cached historicals, so it's only built once.
+    historicals_by_state = {}
+    grid_historicals = None
+    historicals_db_seconds = {}
+    if changed_states:
+        with tracer.trace("enip.export.export_all_states.load_historicals"):
+            start = time.monotonic()
+            if HISTORICALS_CACHE == "none":
+                historicals_by_state = load_historicals_by_state(
+                    ingest_run_dt, COUNTY_FILTER, [], itersize=EXPORT_RESULTS_ITERSIZE
+                )
+            else:
+                grid_historicals = load_cached_historicals(
+                    ingest_run_dt, COUNTY_FILTER, []
+                )
+                historicals_by_state = partition_historicals_by_state(
+                    grid_historicals,
+                    {
+                        state_code: ap_data_by_state.get(state_code, [])
+                        for state_code in changed_states
+                    },
+                )
+            historicals_db_seconds["all"] = time.monotonic() - start
+
     with ThreadPoolExecutor(max_workers=THREADS) as executor:
         # Do the states in a random order so if the DB is overloaded and we're
         # timing out regularly, we still eventually update all of the states
         # (because if we time out and miss a few states, they'll probably
         # go earlier in the next run)
-        states_list = list(STATES)
+        states_list = list(changed_states)
         random.shuffle(states_list)
 
         state_futures = {
             state_code: executor.submit(
-                export_state, ingest_run_dt, state_code, ap_data
+                export_state,
+                ingest_run_dt,
+                state_code,
+                ap_data_by_state.get(state_code, []),
+                historicals_by_state.get(state_code, {}),
+                historicals_db_seconds,
+                grid_historicals,
+                ingest_run_id=ingest_run_id,
             )
             for state_code in states_list
         }
@@ -149,7 +295,7 @@ def export_all_states(ap_data, ingest_run_dt):
         for state_code, future in state_futures.items():
             try:
                 was_different, cdn_url = future.result()
-                if future.result():
+                if was_different:
                     logging.info(
                         f"  Export {state_code} completed WITH new results: {cdn_url}"
                     )
@@ -159,10 +305,24 @@ def export_all_states(ap_data, ingest_run_dt):
                     )
 
                 results[state_code] = cdn_url
+                exported_fingerprints[f"states/{state_code}"] = fingerprints[state_code]
 
             except Exception as e:
                 logging.exception(f"  Export {state_code} failed")
                 sentry_sdk.capture_exception(e)
+                any_failed = True
+
+    # The total time spent loading historicals
+    span = tracer.current_span()
+    if span:
+        span.set_metric(
+            "enip.export.historicals_db_ms",
+            sum(historicals_db_seconds.values()) * 1000,
+        )
+
+    # Save the fingerprints of the states that did export, even if others
+    # failed, so the next run only redoes the failed ones
+    save_export_fingerprints(exported_fingerprints)
 
     if any_failed:
         raise RuntimeError("Some exports failed")
@@ -0,0 +1,165 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from . import run
+from .helpers import fingerprint_records
+from .testing import sql_record
+
+INGEST_RUN_DT = datetime(2020, 11, 3, 8, 0, 0, tzinfo=timezone.utc)
+CONTEXT = "2020-11-03 08:00:00+00:00"
+HISTORICALS = {
+    "MA-1": {"2020-11-03 07:00:00+00:00": 50},
+    "NY-1": {"2020-11-03 07:00:00+00:00": 150},
+}
+
+
+def record(statepostal, votecount):
+    return sql_record(
+        elex_id=f"{statepostal}-1", statepostal=statepostal, votecount=votecount
+    )
+
+
+def exported(ingest_run_dt, state_code, *args, **kwargs):
+    """
+    Stands in for export_state, returning the state code as the CDN URL
+    """
+    return True, state_code
+
+
+@pytest.fixture
+def fingerprints(mocker):
+    """
+    Mocks the fingerprint storage, returning the saved fingerprints (which
+    the test can fill in before exporting)
+    """
+    saved = {}
+    mocker.patch.object(run, "load_context_fingerprint", return_value=CONTEXT)
+    mocker.patch.object(run, "load_export_fingerprints", return_value=saved)
+    mocker.patch.object(run, "save_export_fingerprints", side_effect=saved.update)
+    return saved
+
+
+@pytest.fixture
+def national_exporter(mocker):
+    exporter = mocker.patch.object(run, "NationalDataExporter")
+    exporter.return_value.run_export.return_value.json.return_value = "{}"
+    mocker.patch.object(run, "export_to_s3", return_value=(True, "national.json"))
+    return exporter
+
+
+def test_export_national_skips_unchanged(fingerprints, national_exporter):
+    ingest_data = [record("MA", 100)]
+    fingerprints["national"] = fingerprint_records(ingest_data, CONTEXT)
+
+    assert run.export_national(1, INGEST_RUN_DT, "export", ingest_data) == run.SKIPPED
+    national_exporter.assert_not_called()
+    run.save_export_fingerprints.assert_not_called()
+
+
+def test_export_national_runs_changed(fingerprints, national_exporter):
+    fingerprints["national"] = fingerprint_records([record("MA", 100)], CONTEXT)
+    ingest_data = [record("MA", 200)]
+
+    assert run.export_national(1, INGEST_RUN_DT, "export", ingest_data) == (
+        "national.json"
+    )
+    national_exporter.return_value.run_export.assert_called_once_with(ingest_data)
+    assert fingerprints["national"] == fingerprint_records(ingest_data, CONTEXT)
+
+
+def test_export_all_states_skips_unchanged(mocker, fingerprints):
+    mocker.patch.object(run, "load_cached_historicals", return_value=HISTORICALS)
+    export_state = mocker.patch.object(
+        run,
+        "export_state",
+        side_effect=exported,
+    )
+
+    ap_data = [record("MA", 100), record("NY", 200)]
+    # MA and every state without results are unchanged since the last export
+    fingerprints.update(
+        {
+            f"states/{state_code}": fingerprint_records([], CONTEXT)
+            for state_code in run.STATES
+        }
+    )
+    fingerprints["states/MA"] = fingerprint_records([record("MA", 100)], CONTEXT)
+    fingerprints["states/NY"] = fingerprint_records([record("NY", 100)], CONTEXT)
+
+    assert run.export_all_states(ap_data, INGEST_RUN_DT, 12) == {
+        state_code: "NY" if state_code == "NY" else run.SKIPPED
+        for state_code in run.STATES
+    }
+    # NY gets its share of the cached historicals, and the whole set for the
+    # grid
+    export_state.assert_called_once_with(
+        INGEST_RUN_DT,
+        "NY",
+        [record("NY", 200)],
+        {"NY-1": HISTORICALS["NY-1"]},
+        mocker.ANY,
+        HISTORICALS,
+        ingest_run_id=12,
+    )
+    assert fingerprints["states/NY"] == fingerprint_records(
+        [record("NY", 200)], CONTEXT
+    )
+    run.save_export_fingerprints.assert_called_once_with(
+        {"states/NY": fingerprint_records([record("NY", 200)], CONTEXT)}
+    )
+
+
+def test_export_all_states_runs_all_without_fingerprints(mocker, fingerprints):
+    mocker.patch.object(run, "load_cached_historicals", return_value=HISTORICALS)
+    mocker.patch.object(
+        run,
+        "export_state",
+        side_effect=exported,
+    )
+
+    assert run.export_all_states([record("MA", 100)], INGEST_RUN_DT) == {
+        state_code: state_code for state_code in run.STATES
+    }
+    assert set(fingerprints) == {f"states/{state_code}" for state_code in run.STATES}
+
+
+def test_export_all_states_raises_on_failure(mocker, fingerprints):
+    mocker.patch.object(run, "load_cached_historicals", return_value=HISTORICALS)
+
+    def export_state(ingest_run_dt, state_code, *args, **kwargs):
+        if state_code == "NY":
+            raise ValueError("failed")
+        return (True, state_code)
+
+    mocker.patch.object(run, "export_state", side_effect=export_state)
+
+    with pytest.raises(RuntimeError):
+        run.export_all_states([record("MA", 100)], INGEST_RUN_DT)
+
+    # The other states' fingerprints are still saved
+    assert set(fingerprints) == {
+        f"states/{state_code}" for state_code in run.STATES if state_code != "NY"
+    }
+
+
+def test_export_all_states_batches_historicals(mocker, fingerprints):
+    mocker.patch.object(run, "HISTORICALS_CACHE", "none")
+    load_historicals_by_state = mocker.patch.object(
+        run,
+        "load_historicals_by_state",
+        return_value={"MA": {"MA-1": HISTORICALS["MA-1"]}},
+    )
+    export_state = mocker.patch.object(
+        run,
+        "export_state",
+        side_effect=exported,
+    )
+
+    run.export_all_states([record("MA", 100)], INGEST_RUN_DT)
+
+    # Without the cache, one query loads the historicals for every state
+    load_historicals_by_state.assert_called_once()
+    historicals = {call[0][1]: call[0][3] for call in export_state.call_args_list}
+    assert historicals["MA"] == {"MA-1": HISTORICALS["MA-1"]}
+    assert historicals["NY"] == {}
@@ -1,29 +1,55 @@
+import time
 from datetime import datetime
-from typing import Any, Iterable, List
+from typing import Any, Iterable, List, Optional
 
 from ddtrace import tracer
 
 from ..enip_common.states import AT_LARGE_HOUSE_STATES
 from . import structs
 from .helpers import (
-    HistoricalResults,
+    AnyHistoricalResults,
+    CompactHistoricalResults,
     SQLRecord,
+    format_historicals,
     handle_candidate_results,
     load_election_results,
-    load_historicals,
 )
+from .historicals_cache import load_cached_historicals
+from .history_grid import OtherHistories
+
+
+# The results the state exports use
+COUNTY_FILTER = "level = 'county'"
 
 
 class StateDataExporter:
     data: structs.StateData
 
-    def __init__(self, ingest_run_dt: datetime, statecode: str):
+    def __init__(
+        self,
+        ingest_run_dt: datetime,
+        statecode: str,
+        historical_counts: Optional[AnyHistoricalResults] = None,
+        grid_historicals: Optional[AnyHistoricalResults] = None,
+    ):
+        """
+        If historical_counts (this state's county historicals) isn't given, we
+        load it from the database. If it's this state's share of a larger set
+        of historicals (see partition_historicals_by_state), passing those as
+        grid_historicals lets us add up the "other" histories on their grid.
+        """
         self.ingest_run_dt = ingest_run_dt
-        self.historical_counts: HistoricalResults = {}
+        self.preloaded_historical_counts = historical_counts
+        self.grid_historicals = grid_historicals
+        self.historical_counts: AnyHistoricalResults = {}
+        self.other_histories: Optional[OtherHistories] = None
         self.data = structs.StateData()
 
         self.state = statecode
 
+        # How long we spent loading the historicals
+        self.historicals_db_seconds = 0.0
+
     def record_county_presidential_result(self, record: SQLRecord) -> None:
         """
         Records a "county"-level presidential result.
@@ -39,6 +65,7 @@ class StateDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
     def record_county_senate_result(self, record: SQLRecord) -> None:
@@ -65,6 +92,7 @@ class StateDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
     def record_county_house_result(self, record: SQLRecord) -> None:
@@ -91,18 +119,33 @@ class StateDataExporter:
             structs.StateSummaryCandidateNamed,
             record,
             self.historical_counts,
+            other_histories=self.other_histories,
         )
 
     def run_export(self, preloaded_results: Iterable[SQLRecord]) -> structs.StateData:
         self.data = structs.StateData()
 
-        sql_filter = "level = 'county' AND statepostal = %s"
+        sql_filter = f"{COUNTY_FILTER} AND statepostal = %s"
         filter_params: List[Any] = [self.state]
 
-        with tracer.trace("enip.export.state.historicals"):
-            self.historical_counts = load_historicals(
-                self.ingest_run_dt, sql_filter, filter_params
+        if self.preloaded_historical_counts is not None:
+            self.historical_counts = self.preloaded_historical_counts
+        else:
+            with tracer.trace("enip.export.state.historicals"):
+                start = time.monotonic()
+                self.historical_counts = load_cached_historicals(
+                    self.ingest_run_dt, sql_filter, filter_params
+                )
+                self.historicals_db_seconds = time.monotonic() - start
+
+        self.historical_counts = format_historicals(self.historical_counts)
+        if isinstance(self.historical_counts, CompactHistoricalResults):
+            self.data = structs.CompactStateData(
+                history_waypoints=self.historical_counts.waypoints
             )
+        self.other_histories = OtherHistories.for_historicals(
+            self.historical_counts, self.grid_historicals
+        )
 
         def handle_record(record):
             if record.officeid == "P":
@@ -120,4 +163,7 @@ class StateDataExporter:
             if record.statepostal == self.state:
                 handle_record(record)
 
+        if self.other_histories is not None:
+            self.other_histories.finish()
+
         return self.data
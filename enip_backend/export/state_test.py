@@ -2,9 +2,11 @@ import json
 from datetime import datetime, timezone
 
 import pytest
+from jsonschema import validate
 
 from . import structs
 from .helpers import HistoricalResults, SQLRecord
+from .schemas import state_schema
 from .state import StateDataExporter
 
 mock_historicals: HistoricalResults = {}
@@ -16,7 +18,7 @@ def init_mocks(mocker):
 
     mock_historicals = {}
 
-    mock_load_historicals = mocker.patch("enip_backend.export.state.load_historicals")
+    mock_load_historicals = mocker.patch("enip_backend.export.state.load_cached_historicals")
     mock_load_historicals.return_value = mock_historicals
 
 
@@ -386,3 +388,73 @@ def test_house_at_large_result():
             }
         ),
     )
+
+
+def test_preloaded_historicals(mocker):
+    load_historicals = mocker.patch("enip_backend.export.state.load_cached_historicals")
+    historicals = {"test_dem": {"A": 1, "B": 2}}
+    state_exporter = StateDataExporter(
+        datetime(2020, 11, 3, 8, 0, 0, tzinfo=timezone.utc), "MA", historicals
+    )
+
+    data = state_exporter.run_export(
+        [res_p("MA", "12345", "Dem", votecount=12345, votepct=0.5, elex_id="test_dem")]
+    )
+
+    assert not load_historicals.called
+    assert data.counties["12345"].P.dem.pop_vote_history == {"A": 1, "B": 2}
+
+
+def test_compact_pop_vote_history(mocker):
+    historicals = {
+        "test_dem": {"2020-11-03 21:00:00+00:00": 2, "2020-11-03 20:00:00+00:00": 1},
+        "test_gop": {"2020-11-03 20:00:00+00:00": 3},
+        "test_lib": {"2020-11-03 22:00:00+00:00": 4},
+        "test_grn": {"2020-11-03 20:00:00+00:00": 5, "2020-11-03 22:00:00+00:00": 6},
+    }
+    records = [
+        res_p("MA", "12345", "Dem", votecount=2, votepct=0.4, elex_id="test_dem"),
+        res_p("MA", "12345", "GOP", votecount=3, votepct=0.3, elex_id="test_gop"),
+        res_p("MA", "12345", "Lib", votecount=4, votepct=0.2, elex_id="test_lib"),
+        res_p("MA", "12345", "Grn", votecount=6, votepct=0.1, elex_id="test_grn"),
+        res_p("MA", "23456", "Dem", votecount=7, votepct=1.0, elex_id="test_none"),
+    ]
+
+    mocker.patch("enip_backend.export.helpers.POP_VOTE_HISTORY_FORMAT", "compact")
+    data = StateDataExporter(
+        datetime(2020, 11, 3, 8, 0, 0, tzinfo=timezone.utc), "MA", historicals
+    ).run_export(records)
+
+    assert data.history_waypoints == [
+        "2020-11-03 20:00:00+00:00",
+        "2020-11-03 21:00:00+00:00",
+        "2020-11-03 22:00:00+00:00",
+    ]
+    county = data.counties["12345"].P
+    assert county.dem.pop_vote_history == [1, 2]
+    assert county.gop.pop_vote_history == [3]
+    assert county.oth.pop_vote_history == [5, None, 10]
+    assert data.counties["23456"].P.dem.pop_vote_history == []
+    assert data.counties["23456"].P.oth.pop_vote_history == []
+    validate(instance=json.loads(data.json(by_alias=True)), schema=state_schema)
+
+    # The compact histories have the same counts as the maps
+    mocker.patch("enip_backend.export.helpers.POP_VOTE_HISTORY_FORMAT", "map")
+    map_data = StateDataExporter(
+        datetime(2020, 11, 3, 8, 0, 0, tzinfo=timezone.utc), "MA", historicals
+    ).run_export(records)
+
+    validate(instance=json.loads(map_data.json(by_alias=True)), schema=state_schema)
+    for fipscode, county_data in data.counties.items():
+        county = county_data.P
+        map_county = map_data.counties[fipscode].P
+        for party in ["dem", "gop", "oth"]:
+            if getattr(county, party) is None:
+                continue
+
+            history = getattr(county, party).pop_vote_history
+            assert getattr(map_county, party).pop_vote_history == {
+                waypoint: count
+                for waypoint, count in zip(data.history_waypoints, history)
+                if count is not None
+            }
@@ -17,6 +17,12 @@ class CamelModel(BaseModel):
         allow_population_by_field_name = True
 
 
+# A candidate's vote count at each hourly waypoint: a map of (waypoint ->
+# count), or with POP_VOTE_HISTORY_FORMAT=compact, a list of counts (or None)
+# matching the document's history_waypoints
+PopVoteHistory = Union[List[Optional[int]], Dict[str, int]]
+
+
 class Party(str, Enum):
     DEM = "dem"
     GOP = "gop"
@@ -46,14 +52,14 @@ class NationalSummaryPresidentCandidateNamed(CamelModel):
     pop_vote: int
     pop_pct: float
     elect_won: int = 0
-    pop_vote_history: Dict[str, int] = {}
+    pop_vote_history: PopVoteHistory = {}
 
 
 class NationalSummaryPresidentCandidateUnnamed(CamelModel):
     pop_vote: int = 0
     pop_pct: float = 0
     elect_won: int = 0
-    pop_vote_history: Dict[str, int] = {}
+    pop_vote_history: PopVoteHistory = {}
 
 
 class NationalSummaryPresident(CamelModel):
@@ -86,13 +92,13 @@ class StateSummaryCandidateNamed(CamelModel):
     last_name: str
     pop_vote: int
     pop_pct: float
-    pop_vote_history: Dict[str, int] = {}
+    pop_vote_history: PopVoteHistory = {}
 
 
 class StateSummaryCandidateUnnamed(CamelModel):
     pop_vote: int = 0
     pop_pct: float = 0
-    pop_vote_history: Dict[str, int] = {}
+    pop_vote_history: PopVoteHistory = {}
 
 
 class StateSummaryPresident(CamelModel):
@@ -145,6 +151,10 @@ class NationalData(CamelModel):
     ] = {}
 
 
+class CompactNationalData(NationalData):
+    history_waypoints: List[str] = []
+
+
 class CountyCongressionalResult(CamelModel):
     dem: Optional[StateSummaryCandidateNamed] = None
     gop: Optional[StateSummaryCandidateNamed] = None
@@ -171,3 +181,7 @@ class County(CamelModel):
 
 class StateData(CamelModel):
     counties: Dict[str, County] = {}
+
+
+class CompactStateData(StateData):
+    history_waypoints: List[str] = []
@@ -0,0 +1,221 @@
+from array import array
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from .helpers import SQLRecord
+
+T = TypeVar("T", bound=Hashable)
+
+# We store seatnum in an integer array, so we use this to represent None
+NULL_INT = -1
+
+
+class Categorical(Generic[T]):
+    """
+    A dictionary-encoded column: each distinct value is stored once, and each
+    row stores an integer code pointing to its value.
+    """
+
+    def __init__(self) -> None:
+        self.values: List[T] = []
+        self.index: Dict[T, int] = {}
+        self.codes = array("l")
+
+    def append(self, value: T) -> None:
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.index[value] = code
+
+        self.codes.append(code)
+
+    def __getitem__(self, i: int) -> T:
+        return self.values[self.codes[i]]
+
+
+# (column name, array typecode) for each integer/float column, "list" for
+# columns with unique values, or None for dictionary-encoded columns
+COLUMNS = [
+    ("ingest_id", "l"),
+    ("elex_id", "list"),
+    ("statepostal", None),
+    ("fipscode", None),
+    ("level", None),
+    ("reportingunitname", None),
+    ("officeid", None),
+    ("seatnum", "l"),
+    ("party", None),
+    ("first", None),
+    ("last", None),
+    ("electtotal", "l"),
+    ("electwon", "l"),
+    ("votecount", "l"),
+    ("votepct", "d"),
+    ("winner", "b"),
+]
+
+
+def contiguous_runs(indices: Iterable[int]) -> List[Tuple[int, int]]:
+    """
+    Converts a list of indices into a list of (start, stop) ranges
+    """
+    runs: List[Tuple[int, int]] = []
+    for i in indices:
+        if runs and runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], i + 1)
+        else:
+            runs.append((i, i + 1))
+
+    return runs
+
+
+def new_column(typecode: Optional[str]) -> Any:
+    if typecode is None:
+        return Categorical()
+    elif typecode == "list":
+        return []
+    else:
+        return array(typecode)
+
+
+class IngestTable:
+    """
+    A columnar, in-memory table of AP results. This is much more compact than
+    a list of SQLRecords (repeated strings like state codes, FIPS codes, and
+    candidate names are stored once), and filtering and grouping operate on
+    the integer codes rather than on the records.
+
+    Iterating over an IngestTable yields SQLRecords, so it can be used anywhere
+    we'd otherwise use a list of them.
+    """
+
+    def __init__(self) -> None:
+        self.columns: Dict[str, Any] = {
+            name: new_column(typecode) for name, typecode in COLUMNS
+        }
+
+    @classmethod
+    def from_records(cls, records: Iterable[SQLRecord]) -> "IngestTable":
+        table = cls()
+        for record in records:
+            table.append(record)
+
+        return table
+
+    def append(self, record: SQLRecord) -> None:
+        for (name, _), value in zip(COLUMNS, record):
+            if name == "seatnum" and value is None:
+                value = NULL_INT
+
+            self.columns[name].append(value)
+
+    def __len__(self) -> int:
+        return len(self.columns["ingest_id"])
+
+    def row(self, i: int) -> SQLRecord:
+        seatnum = self.columns["seatnum"][i]
+
+        return SQLRecord(
+            ingest_id=self.columns["ingest_id"][i],
+            elex_id=self.columns["elex_id"][i],
+            statepostal=self.columns["statepostal"][i],
+            fipscode=self.columns["fipscode"][i],
+            level=self.columns["level"][i],
+            reportingunitname=self.columns["reportingunitname"][i],
+            officeid=self.columns["officeid"][i],
+            seatnum=None if seatnum == NULL_INT else seatnum,
+            party=self.columns["party"][i],
+            first=self.columns["first"][i],
+            last=self.columns["last"][i],
+            electtotal=self.columns["electtotal"][i],
+            electwon=self.columns["electwon"][i],
+            votecount=self.columns["votecount"][i],
+            votepct=self.columns["votepct"][i],
+            winner=bool(self.columns["winner"][i]),
+        )
+
+    def __iter__(self) -> Iterator[SQLRecord]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def take(self, indices: Iterable[int]) -> "IngestTable":
+        """
+        Returns a new table containing the given rows, in the given order.
+
+        The new table shares its dictionaries with this one. That's safe
+        because dictionaries are only ever appended to, so existing codes
+        stay valid.
+        """
+        return self.take_runs(contiguous_runs(indices))
+
+    def take_runs(self, runs: List[Tuple[int, int]]) -> "IngestTable":
+        """
+        Like take, but takes a list of (start, stop) ranges of rows. The rows
+        we take are usually in long runs (the AP groups results by race, and
+        races by state), so this lets us copy slices rather than single rows.
+        """
+        table = IngestTable()
+        for name, column in self.columns.items():
+            if isinstance(column, Categorical):
+                taken = table.columns[name]
+                taken.values = column.values
+                taken.index = column.index
+                for start, stop in runs:
+                    taken.codes.extend(column.codes[start:stop])
+            else:
+                for start, stop in runs:
+                    table.columns[name].extend(column[start:stop])
+
+        return table
+
+    def where(self, **equals: Any) -> "IngestTable":
+        """
+        Returns a new table containing the rows where each of the given
+        dictionary-encoded columns is equal to the given value, e.g.
+        table.where(officeid="P", level="state")
+        """
+        matches: Sequence[int] = range(len(self))
+        for name, value in equals.items():
+            column = self.columns[name]
+            code = column.index.get(value)
+            if code is None:
+                return IngestTable()
+
+            codes = column.codes
+            matches = [i for i in matches if codes[i] == code]
+
+        return self.take(matches)
+
+    def partition_by(self, name: str) -> Dict[Any, "IngestTable"]:
+        """
+        Splits the table by the value of a dictionary-encoded column in a
+        single pass, preserving the order of the rows within each partition.
+        """
+        codes = self.columns[name].codes
+        values = self.columns[name].values
+
+        # Find the runs of rows with each value
+        runs: List[List[Tuple[int, int]]] = [[] for _ in values]
+        start = 0
+        for i in range(1, len(codes) + 1):
+            if i == len(codes) or codes[i] != codes[start]:
+                runs[codes[start]].append((start, i))
+                start = i
+
+        return {
+            value: self.take_runs(value_runs)
+            for value, value_runs in zip(values, runs)
+            if value_runs
+        }
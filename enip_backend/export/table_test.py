@@ -0,0 +1,37 @@
+from .helpers import partition_by_state
+from .table import IngestTable
+from .testing import sql_record
+
+
+RECORDS = [
+    sql_record(elex_id="MA-P-3", statepostal="MA", officeid="P", votecount=3),
+    sql_record(
+        elex_id="GA-S-2", statepostal="GA", officeid="S", seatnum=2, votecount=2
+    ),
+    sql_record(
+        elex_id="MA-H-1", statepostal="MA", officeid="H", seatnum=1, votecount=1
+    ),
+    sql_record(
+        elex_id="GA-P-4", statepostal="GA", officeid="P", level="state", votecount=4
+    ),
+]
+
+
+def test_round_trip():
+    table = IngestTable.from_records(RECORDS)
+    assert len(table) == len(RECORDS)
+    assert list(table) == RECORDS
+
+
+def test_where():
+    table = IngestTable.from_records(RECORDS)
+    assert list(table.where(officeid="P")) == [RECORDS[0], RECORDS[3]]
+    assert list(table.where(officeid="P", level="state")) == [RECORDS[3]]
+    assert list(table.where(officeid="X")) == []
+
+
+def test_partition_by_state():
+    partitioned = partition_by_state(IngestTable.from_records(RECORDS))
+    assert {state: list(records) for state, records in partitioned.items()} == (
+        partition_by_state(RECORDS)
+    )
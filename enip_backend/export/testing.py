@@ -0,0 +1,30 @@
+from .helpers import SQLRecord
+
+# Helpers shared by the tests
+
+DEFAULT_RECORD = SQLRecord(
+    ingest_id=1,
+    elex_id="MA-1",
+    statepostal="MA",
+    fipscode="25001",
+    level="county",
+    reportingunitname=None,
+    officeid="P",
+    seatnum=None,
+    party="Dem",
+    first="Joe",
+    last="Biden",
+    electtotal=0,
+    electwon=0,
+    votecount=1,
+    votepct=0.5,
+    winner=False,
+)
+
+
+def sql_record(**fields) -> SQLRecord:
+    """
+    Returns an SQLRecord for a county's presidential result, with fields in
+    place of the defaults
+    """
+    return DEFAULT_RECORD._replace(**fields)
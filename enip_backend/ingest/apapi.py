@@ -1,88 +1,519 @@
 import csv
+import hashlib
 import io
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter, itemgetter
 
 from ddtrace import tracer
-from elex.api.models import Election
+from elex.api.models import PCT_PRECISION, Election
 
-from ..enip_common.config import AP_API_KEY, ELECTION_DATE, INGEST_TEST_DATA
-from ..export.helpers import sqlrecord_from_dict
+from ..enip_common.config import (
+    AP_API_KEY,
+    AP_INGEST_ENGINE,
+    AP_RESULT_COPY_FORMAT,
+    ELECTION_DATE,
+    INGEST_TEST_DATA,
+)
+from ..enip_common.pg import (
+    IteratorFile,
+    binary_copy_chunks,
+    bulk_insert,
+    encode_bool,
+    encode_float8,
+    encode_int4,
+    encode_text,
+    encode_timestamptz,
+)
+from ..export.helpers import SQLRecord
+from ..export.table import IngestTable
+from . import apfeed, apjson
 
 OFFICE_IDS = ["P", "S", "H"]
 
+# We need to request both reporting-unit-level results, which gives us
+# everything except NE/ME congressional districts, and district results for
+# those few results. Each entry is (resultslevel, levels to keep from it).
+RESULTS_LEVELS = [("ru", None), ("district", ["district"])]
+
+# Max number of AP requests to have in flight at once
+FETCH_THREADS = 4
+
+# Approximate size (in characters) of each chunk of CSV we hand to COPY
+COPY_CHUNK_SIZE = 64 * 1024
+
+# The columns we store for each result (split between ap_result and
+# ap_candidate, see below). Other than ingest_id and elex_id (which is elex's
+# "id"), these are the attributes of elex's CandidateReportingUnit that its
+# serialize() method returns. We read the attributes directly rather than
+# calling serialize(), which builds a dict of every field for every row.
+AP_RESULT_COLUMNS = [
+    "ingest_id",
+    "elex_id",
+    "raceid",
+    "racetype",
+    "racetypeid",
+    "ballotorder",
+    "candidateid",
+    "description",
+    "delegatecount",
+    "electiondate",
+    "electtotal",
+    "electwon",
+    "fipscode",
+    "first",
+    "incumbent",
+    "initialization_data",
+    "is_ballot_measure",
+    "last",
+    "lastupdated",
+    "level",
+    "national",
+    "officeid",
+    "officename",
+    "party",
+    "polid",
+    "polnum",
+    "precinctsreporting",
+    "precinctsreportingpct",
+    "precinctstotal",
+    "reportingunitid",
+    "reportingunitname",
+    "runoff",
+    "seatname",
+    "seatnum",
+    "statename",
+    "statepostal",
+    "test",
+    "uncontested",
+    "votecount",
+    "votepct",
+    "winner",
+]
+get_ap_result_values = attrgetter(*AP_RESULT_COLUMNS[2:])
+
+# We pass results around as rows of AP_RESULT_COLUMNS without the ingest_id
+# (which is the same for every row)
+ROW_COLUMNS = AP_RESULT_COLUMNS[1:]
+LEVEL_INDEX = ROW_COLUMNS.index("level")
+get_row_values = itemgetter(*ROW_COLUMNS)
+get_record_values = itemgetter(*[ROW_COLUMNS.index(f) for f in SQLRecord._fields[1:]])
+
+# The columns that change from ingest to ingest. We write these to ap_result
+# (a row per elex_id per ingest), and the rest -- which only change if the AP
+# corrects something -- to ap_candidate (a row per elex_id), and only when
+# they've changed.
+COUNT_COLUMNS = [
+    "elex_id",
+    "electwon",
+    "lastupdated",
+    "precinctsreporting",
+    "precinctsreportingpct",
+    "precinctstotal",
+    "votecount",
+    "votepct",
+    "winner",
+]
+CANDIDATE_COLUMNS = ["elex_id"] + [c for c in ROW_COLUMNS if c not in COUNT_COLUMNS]
+get_count_values = itemgetter(*[ROW_COLUMNS.index(c) for c in COUNT_COLUMNS])
+get_candidate_values = itemgetter(
+    *[ROW_COLUMNS.index(c) for c in CANDIDATE_COLUMNS[1:]]
+)
+
+
+def ap_result_values(obj):
+    """
+    Returns the values of AP_RESULT_COLUMNS (other than ingest_id and elex_id)
+    for an elex CandidateReportingUnit. Like serialize(), we round votepct.
+    """
+    values = get_ap_result_values(obj)
+    return values[:-2] + (round(values[-2], PCT_PRECISION), values[-1])
+
+
+def fetch_results(resultslevel, feed_name="national"):
+    """
+    Makes the AP API request for a single results level and returns an
+    iterable of the rows for it. With the direct and incremental engines, the
+    rows are parsed as they're consumed. With the incremental engine,
+    feed_name is the feed we poll (see ingest/apfeed.py).
+    """
+    start = time.monotonic()
+    with tracer.trace(
+        "enip.ingest.fetch_results",
+        service="enip-backend-ingest-thread",
+        resource=resultslevel,
+    ):
+        if AP_INGEST_ENGINE == "direct":
+            text = apjson.fetch_results_json(resultslevel, OFFICE_IDS)
+            logging.info(
+                f"Fetched {len(text)} characters of {resultslevel} results from the AP in {time.monotonic() - start:.2f}s"
+            )
+            return map(
+                get_row_values, apjson.parse_results(text, electiondate=ELECTION_DATE)
+            )
+        elif AP_INGEST_ENGINE == "incremental":
+            races = apfeed.fetch_races(resultslevel, OFFICE_IDS, feed_name)
+            return map(get_row_values, apjson.races_results(races, ELECTION_DATE))
+        elif AP_INGEST_ENGINE == "elex":
+            election = Election(
+                testresults=INGEST_TEST_DATA,
+                resultslevel=resultslevel,
+                officeids=OFFICE_IDS,
+                setzerocounts=False,
+                electiondate=ELECTION_DATE,
+                api_key=AP_API_KEY,
+            )
+            results = election.results
+            logging.info(
+                f"Fetched {len(results)} {resultslevel} results from the AP in {time.monotonic() - start:.2f}s"
+            )
+            return ((obj.id,) + ap_result_values(obj) for obj in results)
+        else:
+            raise RuntimeError(f"Invalid AP_INGEST_ENGINE: {AP_INGEST_ENGINE}")
+
+
+def record_from_row(row, ingest_id):
+    """
+    Converts a row of ROW_COLUMNS to a SQLRecord (with the same conversions as
+    sqlrecord_from_dict)
+    """
+    (
+        elex_id,
+        statepostal,
+        fipscode,
+        level,
+        reportingunitname,
+        officeid,
+        seatnum,
+        party,
+        first,
+        last,
+        electtotal,
+        electwon,
+        votecount,
+        votepct,
+        winner,
+    ) = get_record_values(row)
+
+    return SQLRecord(
+        ingest_id=int(ingest_id),
+        elex_id=str(elex_id),
+        statepostal=str(statepostal),
+        fipscode=str(fipscode),
+        level=str(level),
+        reportingunitname=str(reportingunitname)
+        if reportingunitname is not None
+        else None,
+        officeid=str(officeid),
+        seatnum=int(seatnum) if seatnum is not None else None,
+        party=str(party),
+        first=str(first),
+        last=str(last),
+        electtotal=int(electtotal),
+        electwon=int(electwon),
+        votecount=int(votecount),
+        votepct=float(votepct),
+        winner=bool(winner),
+    )
+
+
+def candidate_hash(candidate_values):
+    return hashlib.md5(repr(candidate_values).encode()).hexdigest()
+
+
+def load_candidate_hashes(cursor):
+    """
+    Returns a map of (elex_id -> static_hash) for every row in ap_candidate
+    """
+    cursor.execute("SELECT elex_id, static_hash FROM ap_candidate")
+    return dict(cursor)
+
+
+def save_candidates(cursor, ingest_id, rows):
+    """
+    Upserts ap_candidate rows. Each row is (elex_id, static_hash) + the values
+    of the other CANDIDATE_COLUMNS.
+    """
+    columns = ["elex_id", "static_hash", "ingest_id"] + CANDIDATE_COLUMNS[1:]
+    updated_columns = columns[1:]
+    bulk_insert(
+        cursor,
+        "ap_candidate",
+        columns,
+        # Sorted, so concurrent upserts lock rows in the same order
+        sorted((row[:2] + (ingest_id,) + row[2:] for row in rows), key=itemgetter(0)),
+        on_conflict=f"""
+        ON CONFLICT (elex_id) DO UPDATE
+        SET ({", ".join(updated_columns)}) = (
+            {", ".join(f"EXCLUDED.{c}" for c in updated_columns)}
+        )
+        """,
+    )
+
+
+# The columns we compare with the last stored values to decide whether to
+# store a row as a delta: all of the ones we write to ap_result. The exports
+# read votepct too, and it changes when any candidate in the race gains votes,
+# so the full results can only be rebuilt from the deltas if we compare every
+# column.
+DELTA_COLUMNS = COUNT_COLUMNS[1:]
+
+
+def save_deltas(cursor):
+    """
+    Copies the rows in ap_result_incoming whose DELTA_COLUMNS differ from the
+    last stored values into ap_result. Returns the number of rows written.
+    """
+    cursor.execute(
+        f"""
+        INSERT INTO ap_result
+        SELECT incoming.*
+        FROM ap_result_incoming incoming
+        LEFT JOIN ap_result_latest latest ON latest.elex_id = incoming.elex_id
+        WHERE latest.elex_id IS NULL
+            OR ({", ".join(f"latest.{c}" for c in DELTA_COLUMNS)})
+                IS DISTINCT FROM
+                ({", ".join(f"incoming.{c}" for c in DELTA_COLUMNS)})
+        """
+    )
+    return cursor.rowcount
+
+
+def update_latest(cursor, ingest_id):
+    """
+    Updates ap_result_latest (the last stored values for each elex_id) with
+    the rows written to ap_result by this ingest
+    """
+    cursor.execute(
+        f"""
+        INSERT INTO ap_result_latest (elex_id, ingest_id, {", ".join(DELTA_COLUMNS)})
+        SELECT elex_id, ingest_id, {", ".join(DELTA_COLUMNS)}
+        FROM ap_result
+        WHERE ingest_id = %s
+        ON CONFLICT (elex_id) DO UPDATE
+        SET (ingest_id, {", ".join(DELTA_COLUMNS)}) = (
+            EXCLUDED.ingest_id,
+            {", ".join(f"EXCLUDED.{c}" for c in DELTA_COLUMNS)}
+        )
+        WHERE ({", ".join(f"ap_result_latest.{c}" for c in DELTA_COLUMNS)})
+            IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in DELTA_COLUMNS)})
+        """,
+        [ingest_id],
+    )
+
+
+def save_history(cursor, table, ingest_id):
+    """
+    If this ingest is an hourly waypoint, appends the counts in table (the
+    rows this ingest COPYd) that differ from the previous waypoint's to
+    ap_result_history. Returns the number of rows written.
+    """
+    cursor.execute(
+        f"""
+        INSERT INTO ap_result_history (elex_id, waypoint_60_dt, ingest_id, votecount)
+        SELECT
+            incoming.elex_id,
+            ingest_run.waypoint_60_dt,
+            incoming.ingest_id,
+            incoming.votecount
+        FROM {table} incoming
+        JOIN ingest_run ON ingest_run.ingest_id = incoming.ingest_id
+        LEFT JOIN LATERAL (
+            SELECT TRUE AS found, history.votecount
+            FROM ap_result_history history
+            WHERE history.elex_id = incoming.elex_id
+            ORDER BY history.waypoint_60_dt DESC
+            LIMIT 1
+        ) previous ON TRUE
+        WHERE ingest_run.ingest_id = %s
+            AND ingest_run.waypoint_60_dt IS NOT NULL
+            AND (
+                previous.found IS NULL
+                OR previous.votecount IS DISTINCT FROM incoming.votecount
+            )
+        ON CONFLICT (elex_id, waypoint_60_dt) DO NOTHING
+        """,
+        [ingest_id],
+    )
+    return cursor.rowcount
+
+
+def csv_chunks(column_headers, rows):
+    """
+    Serializes rows to CSV (with a header row), yielding the output in chunks
+    of roughly COPY_CHUNK_SIZE characters
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column_headers)
+
+    for row in rows:
+        writer.writerow(row)
+
+        if buffer.tell() >= COPY_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+# The columns we COPY into ap_result, and the binary COPY encoder for each
+COPY_COLUMNS = ["ingest_id"] + COUNT_COLUMNS
+COPY_BINARY_ENCODERS = [
+    {
+        "ingest_id": encode_int4,
+        "elex_id": encode_text,
+        "electwon": encode_int4,
+        "lastupdated": encode_timestamptz,
+        "precinctsreporting": encode_int4,
+        "precinctsreportingpct": encode_float8,
+        "precinctstotal": encode_int4,
+        "votecount": encode_int4,
+        "votepct": encode_float8,
+        "winner": encode_bool,
+    }[column]
+    for column in COPY_COLUMNS
+]
+
+
+def copy_chunks(rows):
+    """
+    Returns (COPY options, chunks) for serializing rows of COPY_COLUMNS in
+    the AP_RESULT_COPY_FORMAT
+    """
+    if AP_RESULT_COPY_FORMAT == "binary":
+        return (
+            "(FORMAT binary)",
+            binary_copy_chunks(COPY_BINARY_ENCODERS, rows, COPY_CHUNK_SIZE),
+        )
+    elif AP_RESULT_COPY_FORMAT == "csv":
+        return "DELIMITER AS ','  CSV HEADER", csv_chunks(COPY_COLUMNS, rows)
+    else:
+        raise RuntimeError(f"Invalid AP_RESULT_COPY_FORMAT: {AP_RESULT_COPY_FORMAT}")
+
 
 @tracer.wrap("enip.ingest.ingest_ap")
 def ingest_ap(
-    cursor, ingest_id, save_to_db, return_levels={"national", "state", "district"}
+    cursor,
+    ingest_id,
+    save_to_db,
+    return_levels={"national", "state", "district"},
+    deltas_only=False,
+    snapshot=None,
+    feed_name="national",
 ):
-    with tracer.trace("enip.ingest.ingest_ap.read_data"):
-        # Make the API request. We need to request both reporting-unit-level results,
-        # which gives us everything except NE/ME congressional districts, and
-        # district results for those few results.
-        election_ru = Election(
-            testresults=INGEST_TEST_DATA,
-            resultslevel="ru",
-            officeids=OFFICE_IDS,
-            setzerocounts=False,
-            electiondate=ELECTION_DATE,
-            api_key=AP_API_KEY,
-        )
-        election_district = Election(
-            testresults=INGEST_TEST_DATA,
-            resultslevel="district",
-            officeids=OFFICE_IDS,
-            setzerocounts=False,
-            electiondate=ELECTION_DATE,
-            api_key=AP_API_KEY,
-        )
+    """
+    Fetches results from the AP and returns an IngestTable of the records for
+    return_levels.
 
-        # Convert the AP results to an in-memory CSV (much faster than a bunch of inserts)
-        csv_file = io.StringIO()
-        writer = csv.writer(csv_file)
-        n_rows = 0
-        column_headers = None
-        return_data = []
+    If save_to_db is set, the counts are written to ap_result, and any new or
+    changed candidates to ap_candidate. By default we write a full snapshot of
+    the counts; with deltas_only, we only write the rows whose counts differ
+    from the last stored values for that elex_id (see ap_result_snapshot in
+    init.sql for rebuilding the full data). On an hourly waypoint, the changed
+    counts are also appended to ap_result_history.
 
-        def process_election_results(results, filter_levels=None):
-            nonlocal n_rows
-            nonlocal column_headers
+    If snapshot (a SnapshotWriter) is passed, every record -- regardless of
+    return_levels -- is also written to it.
 
-            for obj in results:
-                row = obj.serialize()
-                row["ingest_id"] = ingest_id
-                row["elex_id"] = row["id"]
-                del row["id"]
+    With the incremental engine, feed_name is the AP feed this run polls, so
+    separate runs don't share one.
+    """
+    n_rows = 0
+    return_data = IngestTable()
 
-                if column_headers is None:
-                    column_headers = row.keys()
-                    writer.writerow(column_headers)
+    # The ap_candidate rows we need to write, and the hashes of the ones we
+    # already have
+    changed_candidates = []
+    candidate_hashes = load_candidate_hashes(cursor) if save_to_db else {}
 
-                if filter_levels and row["level"] not in filter_levels:
-                    continue
+    def generate_rows():
+        nonlocal n_rows
 
-                if save_to_db:
-                    writer.writerow(row.values())
+        # Make the API requests in parallel so the total fetch time is set by
+        # the slowest request rather than the sum of all of them. Results are
+        # still processed in RESULTS_LEVELS order, and any failed request is
+        # re-raised here.
+        with ThreadPoolExecutor(
+            max_workers=min(FETCH_THREADS, len(RESULTS_LEVELS))
+        ) as executor:
+            futures = [
+                (
+                    executor.submit(fetch_results, resultslevel, feed_name),
+                    filter_levels,
+                )
+                for resultslevel, filter_levels in RESULTS_LEVELS
+            ]
 
-                if row["level"] in return_levels:
-                    return_data.append(sqlrecord_from_dict(row))
-                n_rows += 1
+            for future, filter_levels in futures:
+                for row in future.result():
+                    # Check the level first so we don't do any work for rows
+                    # we're going to drop
+                    level = row[LEVEL_INDEX]
+                    if filter_levels and level not in filter_levels:
+                        continue
 
-        process_election_results(election_ru.results)
-        process_election_results(election_district.results, ["district"])
+                    n_rows += 1
 
-        logging.info(f"Got {n_rows} rows from the AP")
+                    if level in return_levels or snapshot:
+                        record = record_from_row(row, ingest_id)
+                        if level in return_levels:
+                            return_data.append(record)
+                        if snapshot:
+                            snapshot.write(record)
 
-    if save_to_db:
-        with tracer.trace("enip.ingest.ingest_ap.save_to_db"):
-            # Run the COPY command to insert the rows
-            logging.info(f"Writing {n_rows} rows to Postgres...")
+                    if save_to_db:
+                        candidate_values = get_candidate_values(row)
+                        static_hash = candidate_hash(candidate_values)
+                        if candidate_hashes.get(row[0]) != static_hash:
+                            changed_candidates.append(
+                                (row[0], static_hash) + candidate_values
+                            )
 
-            csv_file.seek(0)
+                        yield (ingest_id,) + get_count_values(row)
 
-            cursor.copy_expert(
-                sql=f"COPY ap_result ({','.join(column_headers)}) FROM stdin WITH DELIMITER AS ','  CSV HEADER;",
-                file=csv_file,
-            )
+    with tracer.trace("enip.ingest.ingest_ap.read_data"):
+        rows = generate_rows()
+
+        if save_to_db:
+            with tracer.trace("enip.ingest.ingest_ap.save_to_db"):
+                # Stream the rows into a COPY command (much faster than a
+                # bunch of inserts). The rows are serialized as Postgres reads
+                # them, so we never hold the whole payload in memory.
+                if deltas_only:
+                    # COPY into a scratch table so we can diff against the last
+                    # stored values before writing to ap_result
+                    cursor.execute(
+                        "CREATE TEMPORARY TABLE ap_result_incoming (LIKE ap_result) ON COMMIT DROP"
+                    )
+                    copy_table = "ap_result_incoming"
+                else:
+                    copy_table = "ap_result"
+
+                copy_options, chunks = copy_chunks(rows)
+                cursor.copy_expert(
+                    sql=f"COPY {copy_table} ({','.join(COPY_COLUMNS)}) FROM stdin WITH {copy_options};",
+                    file=IteratorFile(chunks),
+                )
+
+                # The history compares with the previous waypoint, not the
+                # previous ingest, so it needs every row we COPYd
+                n_history = save_history(cursor, copy_table, ingest_id)
+                n_saved = save_deltas(cursor) if deltas_only else n_rows
+                update_latest(cursor, ingest_id)
+                save_candidates(cursor, ingest_id, changed_candidates)
+
+                logging.info(
+                    f"Wrote {n_saved} of {n_rows} rows, {n_history} history rows, and {len(changed_candidates)} changed candidates to Postgres"
+                )
+        else:
+            # Nothing to save, so this just builds the records we return
+            for _ in rows:
+                pass
+
+        logging.info(f"Got {n_rows} rows from the AP")
 
     logging.info(
         f"Done with ingest of AP data! Returning {len(return_data)} data points for national export"
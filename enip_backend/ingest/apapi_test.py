@@ -0,0 +1,201 @@
+import csv
+import io
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from elex.api.models import Election
+
+from . import apapi, apjson
+from ..enip_common.pg_test import read_binary_copy
+from .apapi import COPY_BINARY_ENCODERS, COUNT_COLUMNS, ingest_ap
+from .apjson_test import read_ap_results
+
+
+class FakeCursor:
+    def __init__(self, candidate_hashes):
+        self.candidate_hashes = candidate_hashes
+        self.copied = None
+        self.copy_sql = None
+        self.executed = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.executed.append(" ".join(sql.split()))
+
+    def __iter__(self):
+        # The only thing ingest_ap reads is the candidate hashes
+        return iter(self.candidate_hashes.items())
+
+    def copy_expert(self, sql, file):
+        self.copy_sql = sql
+        data = file.read()
+        if isinstance(data, bytes):
+            self.copied = data
+        else:
+            self.copied = list(csv.reader(io.StringIO(data)))
+
+
+def test_ingest_ap_saves_counts_and_changed_candidates(mocker):
+    text = read_ap_results()
+    mocker.patch.object(Election, "get_raw_races")
+    mocker.patch.object(apjson, "fetch_results_json", return_value=text)
+    mocker.patch.object(apapi, "AP_INGEST_ENGINE", "direct")
+    bulk_insert = mocker.patch.object(apapi, "bulk_insert")
+
+    # The first ingest writes every candidate, and just the counts to ap_result
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True)
+
+    header, *rows = cursor.copied
+    assert header == ["ingest_id"] + COUNT_COLUMNS
+    assert {row[0] for row in rows} == {"12"}
+
+    _, table, columns, candidates = bulk_insert.call_args[0]
+    assert table == "ap_candidate"
+    assert columns[:3] == ["elex_id", "static_hash", "ingest_id"]
+    assert not set(columns) & set(COUNT_COLUMNS[1:])
+    assert sorted(candidate[0] for candidate in candidates) == sorted(
+        row[1] for row in rows
+    )
+    assert {candidate[2] for candidate in candidates} == {12}
+
+    # The next ingest only writes the candidates that have changed
+    candidate_hashes = {candidate[0]: candidate[1] for candidate in candidates}
+    changed_elex_id = candidates[0][0]
+    candidate_hashes[changed_elex_id] = "stale"
+
+    cursor = FakeCursor(candidate_hashes)
+    ingest_ap(cursor, 13, True)
+
+    _, _, _, candidates = bulk_insert.call_args[0]
+    assert [candidate[0] for candidate in candidates] == [changed_elex_id]
+    assert len(cursor.copied) == len(rows) + 1
+
+
+# How Postgres reads each type from our CSV (an unquoted empty field is NULL)
+CSV_PARSERS = {
+    "int": int,
+    "float": float,
+    "bool": lambda value: value.lower() in ("t", "true"),
+    "text": str,
+    "timestamptz": lambda value: datetime.fromisoformat(value.replace("Z", "+00:00")),
+}
+COPY_COLUMN_TYPES = [
+    "int",
+    "text",
+    "int",
+    "timestamptz",
+    "int",
+    "float",
+    "int",
+    "int",
+    "float",
+    "bool",
+]
+
+
+def test_ingest_ap_binary_copy_matches_csv(mocker):
+    text = read_ap_results()
+    mocker.patch.object(Election, "get_raw_races")
+    mocker.patch.object(apjson, "fetch_results_json", return_value=text)
+    mocker.patch.object(apapi, "AP_INGEST_ENGINE", "direct")
+    mocker.patch.object(apapi, "bulk_insert")
+
+    mocker.patch.object(apapi, "AP_RESULT_COPY_FORMAT", "csv")
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True)
+    assert "CSV HEADER" in cursor.copy_sql
+    _, *csv_rows = cursor.copied
+
+    mocker.patch.object(apapi, "AP_RESULT_COPY_FORMAT", "binary")
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True)
+    assert "(FORMAT binary)" in cursor.copy_sql
+    binary_rows = read_binary_copy(cursor.copied, COPY_BINARY_ENCODERS)
+
+    assert len(COPY_COLUMN_TYPES) == len(COPY_BINARY_ENCODERS)
+    parsed_csv_rows = [
+        tuple(
+            CSV_PARSERS[column_type](value) if value != "" else None
+            for column_type, value in zip(COPY_COLUMN_TYPES, row)
+        )
+        for row in csv_rows
+    ]
+    assert binary_rows
+    assert binary_rows == parsed_csv_rows
+
+
+def history_inserts(cursor):
+    return [sql for sql in cursor.executed if "INTO ap_result_history" in sql]
+
+
+def test_ingest_ap_saves_history_from_copied_rows(mocker):
+    text = read_ap_results()
+    mocker.patch.object(Election, "get_raw_races")
+    mocker.patch.object(apjson, "fetch_results_json", return_value=text)
+    mocker.patch.object(apapi, "AP_INGEST_ENGINE", "direct")
+    mocker.patch.object(apapi, "bulk_insert")
+
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True)
+    [sql] = history_inserts(cursor)
+    assert "FROM ap_result incoming" in sql
+
+    # With deltas, the history still compares every row we fetched with the
+    # previous waypoint
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True, deltas_only=True)
+    [sql] = history_inserts(cursor)
+    assert "FROM ap_result_incoming incoming" in sql
+
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, False)
+    assert not history_inserts(cursor)
+
+
+def test_ingest_ap_fetches_levels_concurrently(mocker):
+    text = read_ap_results()
+    rows = list(
+        map(apapi.get_row_values, apjson.parse_results(text, electiondate="2020-11-03"))
+    )
+    district_rows = [row for row in rows if row[apapi.LEVEL_INDEX] == "district"]
+    assert district_rows
+
+    # Each fetch waits until both have started, so this only finishes if
+    # they're in flight at the same time
+    started = threading.Barrier(len(apapi.RESULTS_LEVELS), timeout=5)
+
+    def fetch_results(resultslevel, feed_name):
+        started.wait()
+        if resultslevel == "ru":
+            # Finish after the district results
+            time.sleep(0.1)
+            return iter(rows)
+        return iter(district_rows)
+
+    mocker.patch.object(apapi, "fetch_results", side_effect=fetch_results)
+    bulk_insert = mocker.patch.object(apapi, "bulk_insert")
+
+    cursor = FakeCursor({})
+    ingest_ap(cursor, 12, True)
+
+    # The rows come out in RESULTS_LEVELS order: the reporting unit results,
+    # then just the districts from the district results
+    _, *copied = cursor.copied
+    assert [row[1] for row in copied] == [row[0] for row in rows] + [
+        row[0] for row in district_rows
+    ]
+
+
+def test_ingest_ap_reraises_failed_fetch(mocker):
+    def fetch_results(resultslevel, feed_name):
+        if resultslevel == "district":
+            raise RuntimeError("AP request failed")
+        return iter([])
+
+    mocker.patch.object(apapi, "fetch_results", side_effect=fetch_results)
+
+    with pytest.raises(RuntimeError, match="AP request failed"):
+        ingest_ap(FakeCursor({}), 12, False)
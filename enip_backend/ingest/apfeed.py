@@ -0,0 +1,204 @@
+import gzip
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import elex
+import requests
+from ddtrace import tracer
+
+from ..enip_common.config import (
+    AP_API_KEY,
+    AP_FEED_CHECKPOINT_INTERVAL,
+    AP_FULL_RESYNC_INTERVAL,
+    ELECTION_DATE,
+)
+from . import apjson
+from .snapshots import get_snapshot_store
+
+# Incremental polling of the AP elections API. Every AP response includes a
+# "nextrequest" URL that returns only the reporting units that have changed
+# since that response. We keep the merged races from the last full response
+# (plus every change since) in memory, so on a warm Lambda each poll only has
+# to download and parse the changes. Every AP_FEED_CHECKPOINT_INTERVAL we also
+# write the merged races, with the nextrequest URL they're current as of, to
+# the snapshot store, so a cold start can pick up from there. Every
+# AP_FULL_RESYNC_INTERVAL we throw the merged data away and start again from a
+# full response, in case we've missed anything.
+#
+# Each run that polls the AP (the national ingest, and the state exports when
+# there's no AP snapshot to use) has its own feed, so they never overwrite each
+# other's checkpoints.
+FEED_NAME = "ap_feed_{feed}_{resultslevel}.json.gz"
+
+FeedKey = Tuple[str, str]
+
+feeds: Dict[FeedKey, Dict[str, Any]] = {}
+feed_locks: Dict[FeedKey, threading.Lock] = {}
+feed_locks_lock = threading.Lock()
+
+# A reporting unit is identified by its state, level, and ID (statewide units
+# don't have an ID)
+UnitKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+def unit_key(unit: Dict[str, Any]) -> UnitKey:
+    return (unit.get("statePostal"), unit.get("level"), unit.get("reportingunitID"))
+
+
+def merge_races(
+    races: List[Dict[str, Any]], changed_races: List[Dict[str, Any]]
+) -> int:
+    """
+    Merges the races from a nextrequest response into races (in place). Each
+    changed race replaces the race-level fields, and the reporting units it
+    contains replace the matching units. Returns the number of reporting units
+    that changed.
+    """
+    races_by_id = {race["raceID"]: race for race in races}
+    n_units = 0
+
+    for changed_race in changed_races:
+        changed_units = changed_race.get("reportingUnits", [])
+        n_units += len(changed_units)
+
+        race = races_by_id.get(changed_race["raceID"])
+        if race is None:
+            races.append(changed_race)
+            races_by_id[changed_race["raceID"]] = changed_race
+            continue
+
+        for key, value in changed_race.items():
+            if key != "reportingUnits":
+                race[key] = value
+
+        units = race.setdefault("reportingUnits", [])
+        unit_indices = {unit_key(unit): i for i, unit in enumerate(units)}
+        for unit in changed_units:
+            i = unit_indices.get(unit_key(unit))
+            if i is None:
+                unit_indices[unit_key(unit)] = len(units)
+                units.append(unit)
+            else:
+                units[i] = unit
+
+    return n_units
+
+
+def feed_lock(key: FeedKey) -> threading.Lock:
+    with feed_locks_lock:
+        return feed_locks.setdefault(key, threading.Lock())
+
+
+def load_feed(store, key: FeedKey) -> Optional[Dict[str, Any]]:
+    name, resultslevel = key
+    content = store.read(FEED_NAME.format(feed=name, resultslevel=resultslevel))
+    if not content:
+        return None
+    return json.loads(gzip.decompress(content))
+
+
+def save_feed(store, key: FeedKey, feed: Dict[str, Any], now: datetime) -> None:
+    """
+    Writes a checkpoint of the merged feed to the snapshot store
+    """
+    feed["checkpointedAt"] = now.isoformat()
+    name, resultslevel = key
+    with tracer.trace("enip.ingest.apfeed.save_feed"):
+        store.write(
+            FEED_NAME.format(feed=name, resultslevel=resultslevel),
+            gzip.compress(json.dumps(feed).encode()),
+        )
+
+
+def needs_checkpoint(feed: Dict[str, Any], now: datetime) -> bool:
+    checkpointed_at = datetime.fromisoformat(feed["checkpointedAt"])
+    return now - checkpointed_at > AP_FEED_CHECKPOINT_INTERVAL
+
+
+def needs_full_fetch(feed: Optional[Dict[str, Any]], now: datetime) -> bool:
+    if not feed or not feed.get("nextrequest"):
+        return True
+
+    if feed["electionDate"] != ELECTION_DATE:
+        return True
+
+    full_fetched_at = datetime.fromisoformat(feed["fullFetchedAt"])
+    return now - full_fetched_at > AP_FULL_RESYNC_INTERVAL
+
+
+def fetch_next(nextrequest: str) -> Dict[str, Any]:
+    """
+    Makes a nextrequest request, adding our API key (and asking for JSON) if
+    the URL doesn't already do that
+    """
+    query = parse_qs(urlparse(nextrequest).query)
+    params = {}
+    if "apiKey" not in query:
+        params["apiKey"] = AP_API_KEY
+    if "format" not in query:
+        params["format"] = "json"
+
+    response = elex.cache.get(nextrequest, params=params)
+    response.raise_for_status()
+    return json.loads(response.content.decode("utf-8"))
+
+
+@tracer.wrap("enip.ingest.apfeed.fetch_races")
+def fetch_races(
+    resultslevel: str, officeids: List[str], feed_name: str = "national"
+) -> List[Dict[str, Any]]:
+    """
+    Returns the current AP races (in the AP's JSON format) for a results level,
+    fetching only the changes since the last call on feed_name when we can
+    """
+    store = get_snapshot_store()
+    if not store:
+        raise RuntimeError("Incremental AP polling requires an AP_SNAPSHOT_STORE")
+
+    key = (feed_name, resultslevel)
+    with feed_lock(key):
+        start = time.monotonic()
+        now = datetime.now(tz=timezone.utc)
+        feed = feeds.get(key)
+        if feed is None:
+            # A cold start, so pick up from the last checkpoint
+            feed = load_feed(store, key)
+
+        if feed and not needs_full_fetch(feed, now):
+            try:
+                changes = fetch_next(feed["nextrequest"])
+            except requests.RequestException:
+                logging.exception(
+                    f"Failed to fetch {resultslevel} changes from the AP, falling back to a full fetch"
+                )
+            else:
+                n_units = merge_races(feed["races"], changes.get("races", []))
+                feed["nextrequest"] = changes.get("nextrequest") or feed["nextrequest"]
+                feeds[key] = feed
+                if needs_checkpoint(feed, now):
+                    save_feed(store, key, feed, now)
+
+                logging.info(
+                    f"Fetched {n_units} changed {resultslevel} reporting units from the AP in {time.monotonic() - start:.2f}s"
+                )
+                return feed["races"]
+
+        payload = json.loads(apjson.fetch_results_json(resultslevel, officeids))
+        feed = {
+            "electionDate": ELECTION_DATE,
+            "fullFetchedAt": now.isoformat(),
+            "nextrequest": payload.get("nextrequest"),
+            "races": payload.get("races", []),
+        }
+        feeds[key] = feed
+        save_feed(store, key, feed, now)
+
+        logging.info(
+            f"Fetched all {len(feed['races'])} {resultslevel} races from the AP in {time.monotonic() - start:.2f}s"
+        )
+        return feed["races"]
@@ -0,0 +1,176 @@
+import copy
+import json
+from datetime import timedelta
+
+import elex
+import pytest
+
+from . import apfeed, apjson
+from .apapi import OFFICE_IDS
+from .apjson_test import read_ap_results
+from .fake_ap_server import FakeAPServer
+from .snapshots import LocalSnapshotStore
+
+
+def find_unit(payload, race_id, reportingunit_id):
+    race = next(race for race in payload["races"] if race["raceID"] == race_id)
+    return race, next(
+        unit
+        for unit in race["reportingUnits"]
+        if unit.get("reportingunitID") == reportingunit_id
+    )
+
+
+def make_changes(full):
+    """
+    Returns (the changes response, the full response with those changes): new
+    votes in a Maine township, and a call in the Georgia senate race
+    """
+    updated = copy.deepcopy(full)
+    changed_races = []
+
+    race, township = find_unit(updated, "20438", "1001")
+    for candidate in township["candidates"]:
+        candidate["voteCount"] += 25
+    township["precinctsReporting"] += 1
+    changed_races.append(dict(race, reportingUnits=[township]))
+
+    race, state = find_unit(updated, "11692", None)
+    race["lastUpdated"] = "2020-11-04T04:00:00Z"
+    state["candidates"][0]["winner"] = "X"
+    changed_races.append(dict(race, reportingUnits=[state]))
+
+    return {"races": changed_races}, updated
+
+
+@pytest.fixture
+def fake_ap(mocker, tmp_path):
+    full = json.loads(read_ap_results())
+    changes, updated = make_changes(full)
+
+    server = FakeAPServer(json.dumps(full), [json.dumps(changes)]).start()
+    mocker.patch.object(elex, "BASE_URL", server.url)
+    mocker.patch.object(
+        apfeed, "get_snapshot_store", return_value=LocalSnapshotStore(str(tmp_path))
+    )
+    mocker.patch.object(apfeed, "feeds", {})
+
+    yield server, full, updated
+    server.stop()
+
+
+def results(races):
+    return list(apjson.races_results(races, "2020-11-03"))
+
+
+def test_fetch_races_incremental(fake_ap, mocker):
+    server, full, updated = fake_ap
+
+    # The first fetch is a full fetch
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(full["races"])
+    assert "minDateTime" not in server.requests[-1]
+
+    # Then we only fetch changes, and merge them in
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+    assert "minDateTime=0" in server.requests[-1]
+    assert "apiKey" in server.requests[-1]
+
+    # No changes
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+    assert "minDateTime=1" in server.requests[-1]
+
+    # Once the resync interval has passed, we do another full fetch
+    mocker.patch.object(apfeed, "AP_FULL_RESYNC_INTERVAL", timedelta(seconds=-1))
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(full["races"])
+    assert "minDateTime" not in server.requests[-1]
+    assert len(server.requests) == 4
+
+
+def test_fetch_races_checkpoints(fake_ap, mocker):
+    server, full, updated = fake_ap
+    store = apfeed.get_snapshot_store()
+    write = mocker.patch.object(store, "write", wraps=store.write)
+
+    def checkpoint():
+        return results(apfeed.load_feed(store, ("national", "ru"))["races"])
+
+    # A full fetch is always checkpointed...
+    apfeed.fetch_races("ru", OFFICE_IDS)
+    assert write.call_count == 1
+
+    # ...but the changes are only merged in memory until the checkpoint
+    # interval has passed
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+    assert write.call_count == 1
+    assert checkpoint() == results(full["races"])
+
+    mocker.patch.object(apfeed, "AP_FEED_CHECKPOINT_INTERVAL", timedelta(seconds=-1))
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+    assert write.call_count == 2
+    assert checkpoint() == results(updated["races"])
+
+    # A cold start picks up from the checkpoint, and only fetches changes
+    mocker.patch.object(apfeed, "feeds", {})
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+    assert "minDateTime=1" in server.requests[-1]
+    assert len(server.requests) == 4
+
+
+def test_fetch_races_separate_feeds(fake_ap):
+    server, full, updated = fake_ap
+
+    # The national run polls for changes...
+    apfeed.fetch_races("ru", OFFICE_IDS)
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == results(updated["races"])
+
+    # ...but the state run has its own feed, so its first fetch is a full one,
+    # and it doesn't disturb the national one
+    apfeed.fetch_races("ru", OFFICE_IDS, "states")
+    assert "minDateTime" not in server.requests[-1]
+    assert set(apfeed.feeds) == {("national", "ru"), ("states", "ru")}
+    assert apfeed.feeds[("national", "ru")]["nextrequest"] != (
+        apfeed.feeds[("states", "ru")]["nextrequest"]
+    )
+
+
+def test_fetch_races_matches_parse(fake_ap):
+    _, full, _ = fake_ap
+
+    # The incremental path parses decoded races; make sure that's the same as
+    # parsing the response directly
+    assert results(apfeed.fetch_races("ru", OFFICE_IDS)) == list(
+        apjson.parse_results(json.dumps(full), electiondate="2020-11-03")
+    )
+
+
+def test_merge_races():
+    races = [
+        {
+            "raceID": "1",
+            "lastUpdated": "a",
+            "reportingUnits": [
+                {"statePostal": "GA", "level": "state", "candidates": []},
+                {"statePostal": "GA", "level": "subunit", "reportingunitID": "1"},
+            ],
+        }
+    ]
+    changed = [
+        {
+            "raceID": "1",
+            "lastUpdated": "b",
+            "reportingUnits": [
+                {"statePostal": "GA", "level": "state", "candidates": [{"last": "X"}]},
+                {"statePostal": "GA", "level": "subunit", "reportingunitID": "2"},
+            ],
+        },
+        {"raceID": "2", "reportingUnits": []},
+    ]
+
+    assert apfeed.merge_races(races, changed) == 2
+    assert [race["raceID"] for race in races] == ["1", "2"]
+    assert races[0]["lastUpdated"] == "b"
+    assert races[0]["reportingUnits"] == [
+        {"statePostal": "GA", "level": "state", "candidates": [{"last": "X"}]},
+        {"statePostal": "GA", "level": "subunit", "reportingunitID": "1"},
+        {"statePostal": "GA", "level": "subunit", "reportingunitID": "2"},
+    ]
@@ -0,0 +1,335 @@
+import json
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import elex
+from elex.api.maps import FIPS_TO_STATE, STATE_ABBR
+from elex.api.models import PCT_PRECISION
+
+from ..enip_common.config import AP_API_KEY, ELECTION_DATE, INGEST_TEST_DATA
+
+# A parser for AP elections API results that produces the same values elex's
+# CandidateReportingUnit objects would (see AP_RESULT_COLUMNS in apapi.py),
+# without building elex's model objects. We decode the response one race at a
+# time, so we only ever hold the parsed JSON for a single race, and yield
+# each result as soon as its race is parsed.
+#
+# The derivations below (IDs, levels, vote percentages, and the county
+# roll-ups of New England townships) mirror elex 2.4's models.py; the parity
+# test in apjson_test.py checks them against elex.
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+decoder = json.JSONDecoder()
+
+
+def fetch_results_json(resultslevel: str, officeids: List[str]) -> str:
+    """
+    Makes the same AP API request as elex's Election.results, and returns the
+    raw JSON
+    """
+    params = {
+        "omitResults": False,
+        "level": resultslevel,
+        "setzerocounts": False,
+        "test": INGEST_TEST_DATA,
+        "officeID": officeids,
+        "apiKey": AP_API_KEY,
+        "format": "json",
+    }
+    # Go through elex's session so we share its ETag cache
+    response = elex.cache.get(
+        f"{elex.BASE_URL}/elections/{ELECTION_DATE}", params=sorted(params.items())
+    )
+    response.raise_for_status()
+
+    # The AP always sends UTF-8; decoding it ourselves avoids requests guessing
+    # the encoding of a very large response
+    return response.content.decode("utf-8")
+
+
+def skip_whitespace(text: str, pos: int) -> int:
+    return WHITESPACE.match(text, pos).end()  # type: ignore
+
+
+def expect(text: str, pos: int, chars: str) -> str:
+    if pos >= len(text) or text[pos] not in chars:
+        raise json.JSONDecodeError(f"Expecting one of {chars!r}", text, pos)
+    return text[pos]
+
+
+def iter_payload(text: str) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields the (key, value) pairs of the top-level JSON object in text, except
+    that each element of the "races" array is decoded and yielded separately
+    as ("races", race)
+    """
+    pos = skip_whitespace(text, 0)
+    expect(text, pos, "{")
+    pos = skip_whitespace(text, pos + 1)
+    if expect(text, pos, '}"') == "}":
+        return
+
+    while True:
+        key, pos = decoder.raw_decode(text, pos)
+        pos = skip_whitespace(text, pos)
+        expect(text, pos, ":")
+        pos = skip_whitespace(text, pos + 1)
+
+        if key == "races" and expect(text, pos, "[n") == "[":
+            pos = skip_whitespace(text, pos + 1)
+            if text[pos : pos + 1] != "]":
+                while True:
+                    race, pos = decoder.raw_decode(text, pos)
+                    yield key, race
+
+                    pos = skip_whitespace(text, pos)
+                    if expect(text, pos, ",]") == "]":
+                        break
+                    pos = skip_whitespace(text, pos + 1)
+            pos += 1
+        else:
+            value, pos = decoder.raw_decode(text, pos)
+            yield key, value
+
+        pos = skip_whitespace(text, pos)
+        if expect(text, pos, ",}") == "}":
+            return
+        pos = skip_whitespace(text, pos + 1)
+
+
+def get_level(statepostal: Optional[str], level: Optional[str]) -> Optional[str]:
+    # The AP calls counties and townships "subunits"; New England states report
+    # townships
+    if level == "subunit":
+        return "township" if statepostal in FIPS_TO_STATE else "county"
+    return level
+
+
+def get_reportingunitid(
+    level: Optional[str], statepostal: Optional[str], reportingunitid: Optional[str]
+) -> Optional[str]:
+    if not reportingunitid:
+        if level == "state":
+            return f"state-{statepostal}-1"
+        return reportingunitid
+    return f"{level}-{reportingunitid}"
+
+
+def get_unique_id(result: Dict[str, Any]) -> str:
+    # Candidate IDs aren't globally unique, so elex uses the AP's politician ID
+    # if there is one, and the ballot position otherwise
+    if result["is_ballot_measure"]:
+        return result["candidateid"]
+    elif result["polid"]:
+        return f"polid-{result['polid']}"
+    else:
+        return f"polnum-{result['polnum']}"
+
+
+def set_elex_id(result: Dict[str, Any]) -> None:
+    result[
+        "elex_id"
+    ] = f"{result['raceid']}-{get_unique_id(result)}-{result['reportingunitid']}"
+
+
+def set_votepcts(results: List[Dict[str, Any]], uncontested: bool) -> None:
+    # If there are no votes (or the race is uncontested), votepct stays at
+    # whatever the AP (or the township we rolled up) gave us
+    if not uncontested:
+        total = sum(result["votecount"] for result in results)
+        if total:
+            for result in results:
+                result["votepct"] = float(result["votecount"]) / float(total)
+
+
+def unit_results(
+    race_fields: Dict[str, Any], unit: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """
+    Returns the results for each candidate in a reporting unit (with votepct
+    not yet rounded)
+    """
+    statepostal = unit.get("statePostal")
+    level = get_level(statepostal, unit.get("level"))
+    fipscode = unit.get("fipsCode")
+
+    unit_fields = dict(
+        race_fields,
+        electtotal=unit.get("electTotal", 0),
+        fipscode=fipscode.zfill(5) if fipscode else fipscode,
+        lastupdated=race_fields["lastupdated"] or unit.get("lastUpdated"),
+        level=level,
+        precinctsreporting=unit.get("precinctsReporting", 0),
+        precinctsreportingpct=unit.get("precinctsReportingPct", 0.0) * 0.01,
+        precinctstotal=unit.get("precinctsTotal", 0),
+        reportingunitid=get_reportingunitid(
+            level, statepostal, unit.get("reportingunitID")
+        ),
+        reportingunitname=unit.get("reportingunitName"),
+        statename=STATE_ABBR[statepostal]
+        if statepostal is not None
+        else unit.get("stateName"),
+        statepostal=statepostal,
+    )
+
+    results = []
+    for candidate in unit.get("candidates", []):
+        polid = candidate.get("polID")
+        winner = candidate.get("winner", False)
+        result = dict(
+            unit_fields,
+            ballotorder=candidate.get("ballotOrder"),
+            candidateid=candidate.get("candidateID"),
+            delegatecount=candidate.get("delegateCount", 0),
+            electwon=candidate.get("electWon", 0),
+            first=candidate.get("first"),
+            incumbent=candidate.get("incumbent", False),
+            last=candidate.get("last"),
+            party=candidate.get("party"),
+            polid=None if polid == "0" else polid,
+            polnum=candidate.get("polNum"),
+            runoff=winner == "R",
+            votecount=candidate.get("voteCount", 0),
+            votepct=candidate.get("votePct", 0.0),
+            winner=winner == "X",
+        )
+        set_elex_id(result)
+        results.append(result)
+
+    set_votepcts(results, race_fields["uncontested"])
+    return results
+
+
+def county_results(
+    race_fields: Dict[str, Any], statepostal: str, townships: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    elex rolls the township results in New England states up into county
+    results. This does the same, given the results for every township in the
+    race.
+    """
+    results: List[Dict[str, Any]] = []
+    for fipscode, county_name in FIPS_TO_STATE[statepostal].items():
+        # Sum each candidate's results across the townships in this county,
+        # keyed in the order we first see each candidate
+        county: Dict[str, Dict[str, Any]] = {}
+        for township in townships:
+            if township["fipscode"] != fipscode:
+                continue
+
+            key = get_unique_id(township)
+            if key not in county:
+                county[key] = dict(
+                    township,
+                    level="county",
+                    reportingunitid=f"{statepostal}-{fipscode}",
+                    reportingunitname=county_name,
+                )
+            else:
+                result = county[key]
+                result["votecount"] += township["votecount"]
+                result["precinctstotal"] += township["precinctstotal"]
+                result["precinctsreporting"] += township["precinctsreporting"]
+                try:
+                    result["precinctsreportingpct"] = float(
+                        result["precinctsreporting"]
+                    ) / float(result["precinctstotal"])
+                except ZeroDivisionError:
+                    result["precinctsreportingpct"] = 0.0
+
+        rolled_up = list(county.values())
+        for result in rolled_up:
+            # elex re-reads the rolled-up results from its own attributes, in
+            # which winner is a bool rather than "X" and electwon is absent, and
+            # falsy optional values become None
+            result.update(
+                ballotorder=result["ballotorder"] or None,
+                candidateid=result["candidateid"] or None,
+                polid=result["polid"] or None,
+                polnum=result["polnum"] or None,
+                statename=STATE_ABBR[statepostal],
+                votepct=result["votepct"] or 0.0,
+                winner=False,
+                runoff=False,
+                electwon=0,
+            )
+            set_elex_id(result)
+
+        set_votepcts(rolled_up, race_fields["uncontested"])
+        results.extend(rolled_up)
+
+    return results
+
+
+def race_results(race: Dict[str, Any], electiondate: str) -> List[Dict[str, Any]]:
+    """
+    Returns the results for every candidate in every reporting unit of a race
+    """
+    officeid = race.get("officeID")
+    race_fields = {
+        "description": race.get("description"),
+        "electiondate": electiondate,
+        "initialization_data": False,
+        "is_ballot_measure": officeid == "I",
+        "lastupdated": race.get("lastUpdated"),
+        "national": race.get("national", False),
+        "officeid": officeid,
+        "officename": race.get("officeName"),
+        "raceid": race.get("raceID"),
+        "racetype": race.get("raceType"),
+        "racetypeid": race.get("raceTypeID"),
+        "seatname": race.get("seatName"),
+        "seatnum": race.get("seatNum"),
+        "test": race.get("test", False),
+        "uncontested": race.get("uncontested", False),
+    }
+
+    units = race.get("reportingUnits", [])
+    results: List[Dict[str, Any]] = []
+    townships: List[Dict[str, Any]] = []
+    for unit in units:
+        results_for_unit = unit_results(race_fields, unit)
+        results.extend(results_for_unit)
+
+        if results_for_unit and results_for_unit[0]["level"] == "township":
+            if "Mail Ballots C.D." not in (unit.get("reportingunitName") or ""):
+                townships.extend(results_for_unit)
+
+    # elex takes the race's state from its last reporting unit
+    statepostal = (
+        str(units[-1].get("statePostal")) if units else race.get("statePostal")
+    )
+    if statepostal in FIPS_TO_STATE:
+        results.extend(county_results(race_fields, str(statepostal), townships))
+
+    for result in results:
+        result["votepct"] = round(result["votepct"], PCT_PRECISION)
+
+    return results
+
+
+def races_results(
+    races: Iterable[Dict[str, Any]], electiondate: str
+) -> Iterator[Dict[str, Any]]:
+    """
+    Like parse_results, but for races that have already been decoded
+    """
+    for race in races:
+        yield from race_results(race, electiondate)
+
+
+def parse_results(
+    text: str, electiondate: Optional[str] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Parses an AP elections API results response, yielding a dict of the
+    AP_RESULT_COLUMNS (other than ingest_id) for each result, in the same order
+    as elex's Election.results. electiondate defaults to the response's
+    electionDate (which the AP sends before the races).
+    """
+    for key, value in iter_payload(text):
+        if key == "electionDate" and electiondate is None:
+            electiondate = value
+        elif key == "races":
+            yield from race_results(value, electiondate)  # type: ignore
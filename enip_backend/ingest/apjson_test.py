@@ -0,0 +1,69 @@
+import json
+import os.path
+
+import pytest
+from elex.api.models import Election
+
+from . import apapi, apjson
+from .apapi import ap_result_values, get_row_values, ingest_ap
+
+AP_RESULTS_PATH = os.path.join(os.path.dirname(__file__), "testdata", "ap_results.json")
+
+
+def read_ap_results():
+    with open(AP_RESULTS_PATH, "r") as f:
+        return f.read()
+
+
+def test_parse_results_matches_elex():
+    expected = [
+        (obj.id,) + ap_result_values(obj)
+        for obj in Election(datafile=AP_RESULTS_PATH, setzerocounts=False).results
+    ]
+    actual = [
+        get_row_values(result) for result in apjson.parse_results(read_ap_results())
+    ]
+
+    # Make sure the fixture covers the cases we care about
+    levels = {row[apapi.LEVEL_INDEX] for row in actual}
+    assert levels == {"national", "state", "district", "county", "township"}
+
+    assert actual == expected
+
+
+def test_parse_results_electiondate():
+    results = list(apjson.parse_results(read_ap_results(), electiondate="2020-11-04"))
+    assert {result["electiondate"] for result in results} == {"2020-11-04"}
+
+
+def test_parse_results_empty():
+    assert (
+        list(apjson.parse_results('{"electionDate": "2020-11-03", "races": []}')) == []
+    )
+    assert list(apjson.parse_results(" { } ")) == []
+
+
+def test_parse_results_malformed():
+    text = read_ap_results()
+    with pytest.raises(json.JSONDecodeError):
+        list(apjson.parse_results(text[: len(text) // 2]))
+
+    with pytest.raises(json.JSONDecodeError):
+        list(apjson.parse_results("[]"))
+
+
+def test_ingest_ap_engines_match(mocker):
+    text = read_ap_results()
+    mocker.patch.object(Election, "get_raw_races", return_value=json.loads(text))
+    mocker.patch.object(apjson, "fetch_results_json", return_value=text)
+
+    return_levels = {"national", "state", "district", "county"}
+
+    mocker.patch.object(apapi, "AP_INGEST_ENGINE", "elex")
+    elex_records = list(ingest_ap(None, 12, False, return_levels=return_levels))
+
+    mocker.patch.object(apapi, "AP_INGEST_ENGINE", "direct")
+    direct_records = list(ingest_ap(None, 12, False, return_levels=return_levels))
+
+    assert len(direct_records) > 0
+    assert direct_records == elex_records
@@ -0,0 +1,276 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extras
+import pytest
+
+from ..export.helpers import election_results_params, election_results_query
+from ..export.query_plans_test import EXPLAIN_TEST_POSTGRES_URL, INIT_SQL_PATH
+from . import apapi
+from .apapi import COUNT_COLUMNS, ROW_COLUMNS, ingest_ap, record_from_row
+from .partitions import ensure_partitions
+
+# Checks what the delta storage (SAVE_AP_RESULT_DELTAS) writes to ap_result,
+# and that the results the exports rebuild from a full snapshot and the
+# deltas after it match the full results, against a scratch schema in the
+# same local Postgres as query_plans_test. It's skipped unless
+# EXPLAIN_TEST_POSTGRES_URL is set.
+SCHEMA = "delta_storage_test"
+
+START = datetime(2020, 11, 3, 20, 0, tzinfo=timezone.utc)
+
+pytestmark = pytest.mark.skipif(
+    not EXPLAIN_TEST_POSTGRES_URL, reason="EXPLAIN_TEST_POSTGRES_URL is not set"
+)
+
+
+@pytest.fixture
+def conn():
+    conn = psycopg2.connect(
+        EXPLAIN_TEST_POSTGRES_URL, cursor_factory=psycopg2.extras.NamedTupleCursor
+    )
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+            cursor.execute(f"SET search_path TO {SCHEMA}")
+
+            with open(INIT_SQL_PATH, "r") as f:
+                cursor.execute(f.read())
+        conn.commit()
+
+        yield conn
+
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def row(elex_id, votecount, votepct, winner=False, electwon=0, lastupdated=START):
+    """
+    A row of ROW_COLUMNS for a presidential candidate. The elex_id is
+    "<statepostal>-<fipscode>-<party>".
+    """
+    statepostal, fipscode, party = elex_id.split("-")
+    values = {column: None for column in ROW_COLUMNS}
+    values.update(
+        elex_id=elex_id,
+        raceid=1,
+        racetype="General",
+        racetypeid="G",
+        electiondate="2020-11-03",
+        electtotal=0,
+        electwon=electwon,
+        fipscode=fipscode,
+        first="Foo",
+        last="Barson",
+        lastupdated=lastupdated,
+        level="county" if fipscode != "0" else "state",
+        officeid="P",
+        party=party,
+        precinctsreporting=0,
+        precinctsreportingpct=0.0,
+        precinctstotal=10,
+        statepostal=statepostal,
+        votecount=votecount,
+        votepct=votepct,
+        winner=winner,
+    )
+    return tuple(values[column] for column in ROW_COLUMNS)
+
+
+def ingest(conn, mocker, rows, mode):
+    """
+    Runs ingest_ap on rows, saving them in mode ("full" or "delta") like
+    ingest_all does, and returns the ingest_id
+    """
+
+    def fetch_results(resultslevel, feed_name):
+        return rows if resultslevel == "ru" else []
+
+    mocker.patch.object(apapi, "fetch_results", side_effect=fetch_results)
+
+    with conn.cursor() as cursor:
+        ensure_partitions(cursor)
+        cursor.execute(
+            """
+            INSERT INTO ingest_run (ingest_dt, ap_result_mode) VALUES (now(), %s)
+            RETURNING ingest_id
+            """,
+            [mode],
+        )
+        ingest_id = cursor.fetchone().ingest_id
+        ingest_ap(cursor, ingest_id, True, deltas_only=mode == "delta")
+    conn.commit()
+
+    return ingest_id
+
+
+def stored_elex_ids(conn, ingest_id):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT elex_id FROM ap_result WHERE ingest_id = %s", [ingest_id]
+        )
+        return {record.elex_id for record in cursor}
+
+
+def test_save_deltas_stores_changed_rows(conn, mocker):
+    rows = {
+        "MA-0-Dem": row("MA-0-Dem", 100, 0.5),
+        "MA-0-GOP": row("MA-0-GOP", 100, 0.5),
+        "NY-0-Dem": row("NY-0-Dem", 50, 1.0),
+    }
+
+    def ingest_rows(mode):
+        return ingest(conn, mocker, list(rows.values()), mode)
+
+    ingest_id = ingest_rows("full")
+    assert stored_elex_ids(conn, ingest_id) == set(rows)
+
+    # Nothing has changed
+    assert stored_elex_ids(conn, ingest_rows("delta")) == set()
+
+    # A count changes, and with it the other candidate's votepct. We also
+    # store new candidates.
+    rows["MA-0-Dem"] = row("MA-0-Dem", 110, 0.52)
+    rows["MA-0-GOP"] = row("MA-0-GOP", 100, 0.48)
+    rows["NY-0-GOP"] = row("NY-0-GOP", 0, 0.0)
+    assert stored_elex_ids(conn, ingest_rows("delta")) == {
+        "MA-0-Dem",
+        "MA-0-GOP",
+        "NY-0-GOP",
+    }
+
+    # A call
+    rows["NY-0-Dem"] = row("NY-0-Dem", 50, 1.0, winner=True, electwon=29)
+    winner_ingest_id = ingest_rows("delta")
+    assert stored_elex_ids(conn, winner_ingest_id) == {"NY-0-Dem"}
+
+    # A correction, back to the counts we stored from the full snapshot
+    rows["MA-0-Dem"] = row("MA-0-Dem", 100, 0.5)
+    rows["MA-0-GOP"] = row("MA-0-GOP", 100, 0.5)
+    last_ingest_id = ingest_rows("delta")
+    assert stored_elex_ids(conn, last_ingest_id) == {"MA-0-Dem", "MA-0-GOP"}
+
+    # ap_result_latest has the ingest that last stored each elex_id
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT elex_id, ingest_id FROM ap_result_latest")
+        assert dict(cursor) == {
+            "MA-0-Dem": last_ingest_id,
+            "MA-0-GOP": last_ingest_id,
+            "NY-0-Dem": winner_ingest_id,
+            "NY-0-GOP": winner_ingest_id - 1,
+        }
+
+
+def make_payloads(n_ingests):
+    """
+    Yields the rows for n_ingests ingests of a few states and counties, where
+    each ingest updates some of the reporting units
+    """
+    rng = random.Random(0)
+    units = [
+        (statepostal, fipscode)
+        for statepostal in ["MA", "NY", "PA"]
+        for fipscode in ["0", "1", "2"]
+    ]
+    counts = {unit: {"Dem": 0, "GOP": 0, "Lib": 0} for unit in units}
+    lastupdated = {unit: START for unit in units}
+    winners = set()
+
+    for i in range(n_ingests):
+        for unit in rng.sample(units, 3):
+            for party in counts[unit]:
+                counts[unit][party] += rng.randrange(0, 3) * 10
+            lastupdated[unit] = START + timedelta(minutes=5 * i)
+        if i == n_ingests // 2:
+            winners.add(("PA", "0", "Dem"))
+
+        rows = []
+        for (statepostal, fipscode), unit_counts in counts.items():
+            total = sum(unit_counts.values())
+            for party, votecount in unit_counts.items():
+                rows.append(
+                    row(
+                        f"{statepostal}-{fipscode}-{party}",
+                        votecount,
+                        votecount / total if total else 0.0,
+                        winner=(statepostal, fipscode, party) in winners,
+                        lastupdated=lastupdated[(statepostal, fipscode)],
+                    )
+                )
+        yield rows
+
+
+def election_results(conn, ingest_id, filter_sql, filter_params):
+    """
+    The records the exports load for an ingest, without the ingest_id (which
+    is the ingest each row was stored by)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            election_results_query(filter_sql),
+            election_results_params(ingest_id, filter_params),
+        )
+        return sorted(record[1:] for record in cursor)
+
+
+def snapshot(conn, ingest_id):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT {', '.join(COUNT_COLUMNS)} FROM ap_result_snapshot(%s)",
+            [ingest_id],
+        )
+        return sorted(cursor)
+
+
+# The filters the national and state exports use, with the levels and states
+# they match
+FILTERS = [
+    ("level IN ('national', 'state', 'district')", [], {"state"}, None),
+    ("level = 'county' AND statepostal = %s", ["NY"], {"county"}, "NY"),
+]
+
+
+@pytest.mark.parametrize("filter_sql,filter_params,levels,statepostal", FILTERS)
+def test_deltas_rebuild_full_results(
+    conn, mocker, filter_sql, filter_params, levels, statepostal
+):
+    modes = ["full", "delta", "delta", "delta", "full", "delta", "delta"]
+    payloads = list(make_payloads(len(modes)))
+    ingest_ids = [
+        ingest(conn, mocker, rows, mode) for mode, rows in zip(modes, payloads)
+    ]
+
+    # Then store each payload again as a full snapshot, to compare with
+    full_ingest_ids = [ingest(conn, mocker, rows, "full") for rows in payloads]
+
+    for ingest_id, full_ingest_id, rows in zip(ingest_ids, full_ingest_ids, payloads):
+        # The results we rebuild are the ones we fetched...
+        expected_records = sorted(
+            record_from_row(row, ingest_id)[1:]
+            for row in rows
+            if row[ROW_COLUMNS.index("level")] in levels
+            and statepostal in (None, row[ROW_COLUMNS.index("statepostal")])
+        )
+        assert expected_records
+        assert (
+            election_results(conn, ingest_id, filter_sql, filter_params)
+            == expected_records
+        )
+
+        # ...and the same as a full snapshot of them
+        assert election_results(
+            conn, ingest_id, filter_sql, filter_params
+        ) == election_results(conn, full_ingest_id, filter_sql, filter_params)
+        assert snapshot(conn, ingest_id) == snapshot(conn, full_ingest_id)
+
+    # And we stored less than the full snapshots did
+    n_stored = sum(len(stored_elex_ids(conn, ingest_id)) for ingest_id in ingest_ids)
+    n_full = sum(len(stored_elex_ids(conn, ingest_id)) for ingest_id in full_ingest_ids)
+    assert n_stored < n_full
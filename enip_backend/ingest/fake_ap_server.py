@@ -0,0 +1,100 @@
+import json
+import logging
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# A stand-in for the AP elections API that serves recorded responses, for
+# testing the ingest (and in particular incremental polling) locally. Requests
+# for /elections/<date> get the recorded full response; requests with a
+# minDateTime (i.e. the nextrequest URLs we hand out) get each recorded change
+# response in turn, and then empty change responses.
+#
+# Run with:
+#   pipenv run python -m enip_backend.ingest.fake_ap_server full.json [changes.json ...]
+# and then ingest with AP_API_BASE_URL=http://localhost:8000
+
+
+class FakeAPServer:
+    def __init__(
+        self, full: str, changes: List[str], host: str = "localhost", port: int = 0
+    ):
+        self.host = host
+        self.full = full
+        self.changes = list(changes)
+        self.requests: List[str] = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.requests.append(self.path)
+                status, body = server.respond(self.path)
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.httpd.server_port}"
+
+    def respond(self, path: str):
+        parsed = urlparse(path)
+        if not parsed.path.startswith("/elections/"):
+            return 404, b"{}"
+
+        query = parse_qs(parsed.query)
+        if "minDateTime" not in query:
+            payload = json.loads(self.full)
+            n_changes = 0
+        elif self.changes:
+            payload = json.loads(self.changes.pop(0))
+            n_changes = int(query["minDateTime"][0]) + 1
+        else:
+            payload = {"races": []}
+            n_changes = int(query["minDateTime"][0])
+
+        # Like the AP, hand out a nextrequest URL with the same parameters
+        # (other than the API key). We use a counter as the minDateTime.
+        next_query = {k: v for k, v in query.items() if k != "apiKey"}
+        next_query["minDateTime"] = [str(n_changes)]
+        payload[
+            "nextrequest"
+        ] = f"{self.url}{parsed.path}?{urlencode(next_query, doseq=True)}"
+
+        return 200, json.dumps(payload).encode()
+
+    def start(self) -> "FakeAPServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def read_file(path: str) -> str:
+    with open(path, "r") as f:
+        return f.read()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    full_path, *change_paths = sys.argv[1:]
+    fake_server = FakeAPServer(
+        read_file(full_path), [read_file(path) for path in change_paths], port=8000
+    )
+    logging.info(f"Serving recorded AP responses at {fake_server.url}")
+    fake_server.httpd.serve_forever()
@@ -0,0 +1,284 @@
+import argparse
+import gzip
+import io
+import logging
+import re
+import tempfile
+from typing import List, NamedTuple, Optional
+
+from ..enip_common.config import AP_RESULT_PARTITION_SIZE, AP_RESULT_RETENTION
+from ..enip_common.pg import get_cursor
+from .snapshots import get_snapshot_store
+
+# Tools for managing the ap_result partitions (see init.sql). Each partition
+# holds a range of ingest_ids and is named ap_result_<start>_<end>. Once a
+# partition is retired -- all of its ingests are older than
+# AP_RESULT_RETENTION, and the exports don't need it because it's older than
+# the last full snapshot (the history is in ap_result_history) -- it can be
+# detached (so it's no longer scanned, indexed, or vacuumed as part of
+# ap_result) and archived (a gzipped CSV in the AP snapshot store, after which
+# the table is dropped).
+# Archived partitions can be restored and re-attached.
+#
+# Run with:
+#   pipenv run python -m enip_backend.ingest.partitions list
+#   pipenv run python -m enip_backend.ingest.partitions archive ap_result_1_289
+PARTITION_NAME_RE = re.compile(r"^ap_result_(\d+)_(\d+)$")
+
+Partition = NamedTuple(
+    "Partition",
+    [
+        ("name", str),
+        ("start", int),
+        ("end", int),
+        ("attached", bool),
+        ("size_bytes", int),
+    ],
+)
+
+
+def parse_partition_name(name: str) -> Optional[Partition]:
+    """
+    Returns a (detached, empty) Partition for a partition name, or None if it
+    isn't one
+    """
+    match = PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+
+    return Partition(
+        name=name,
+        start=int(match.group(1)),
+        end=int(match.group(2)),
+        attached=False,
+        size_bytes=0,
+    )
+
+
+def archive_name(partition: Partition) -> str:
+    return f"{partition.name}.csv.gz"
+
+
+def ensure_partitions(cursor) -> None:
+    """
+    Makes sure there are ap_result partitions for the next couple of ingests
+    """
+    cursor.execute("SELECT ap_result_ensure_partitions(%s)", [AP_RESULT_PARTITION_SIZE])
+
+
+def list_partitions(cursor) -> List[Partition]:
+    """
+    Returns all the ap_result partitions in the database, attached or not,
+    oldest first
+    """
+    cursor.execute(
+        """
+        SELECT
+            pg_class.relname AS name,
+            pg_inherits.inhparent IS NOT NULL AS attached,
+            pg_total_relation_size(pg_class.oid) AS size_bytes
+        FROM pg_class
+        LEFT JOIN pg_inherits ON pg_inherits.inhrelid = pg_class.oid
+        WHERE pg_class.relkind = 'r'
+            AND pg_class.relname ~ '^ap_result_[0-9]+_[0-9]+$'
+            AND pg_table_is_visible(pg_class.oid)
+        """
+    )
+
+    partitions = []
+    for record in cursor:
+        partition = parse_partition_name(record.name)
+        if partition:
+            partitions.append(
+                partition._replace(
+                    attached=record.attached, size_bytes=record.size_bytes
+                )
+            )
+
+    partitions.sort(key=lambda partition: partition.start)
+    return partitions
+
+
+def get_partition(cursor, name: str) -> Optional[Partition]:
+    for partition in list_partitions(cursor):
+        if partition.name == name:
+            return partition
+    return None
+
+
+def load_retention_bound(cursor) -> Optional[int]:
+    """
+    Returns the oldest ingest_id we keep: the first one within
+    AP_RESULT_RETENTION, or the last full snapshot (which ap_result_snapshot
+    starts from) if that's older. The historicals come from ap_result_history,
+    so they don't need older ingests. Partitions that end at or before this
+    can be detached.
+    """
+    cursor.execute(
+        """
+        SELECT
+            (
+                SELECT MAX(ingest_id) FROM ingest_run WHERE ap_result_mode = 'full'
+            ) AS full_ingest_id,
+            (
+                SELECT MIN(ingest_id) FROM ingest_run WHERE ingest_dt >= now() - %s
+            ) AS retained_ingest_id
+        """,
+        [AP_RESULT_RETENTION],
+    )
+    record = cursor.fetchone()
+    if record.full_ingest_id is None:
+        return None
+    if record.retained_ingest_id is None:
+        return record.full_ingest_id
+    return min(record.full_ingest_id, record.retained_ingest_id)
+
+
+def is_retired(partition: Partition, retention_bound: Optional[int]) -> bool:
+    return retention_bound is not None and partition.end <= retention_bound
+
+
+def check_retired(cursor, partition: Partition, force: bool) -> None:
+    if force:
+        return
+
+    retention_bound = load_retention_bound(cursor)
+    if not is_retired(partition, retention_bound):
+        raise RuntimeError(
+            f"{partition.name} may still be needed by the exports (they need ingest_id {retention_bound} onwards). Use --force to detach it anyway."
+        )
+
+
+def detach_partition(cursor, partition: Partition, force: bool = False) -> None:
+    check_retired(cursor, partition, force)
+
+    if partition.attached:
+        cursor.execute(f"ALTER TABLE ap_result DETACH PARTITION {partition.name}")
+        logging.info(f"Detached {partition.name}")
+
+
+def archive_partition(cursor, partition: Partition) -> None:
+    """
+    Copies a detached partition to the snapshot store, and drops it
+    """
+    store = get_snapshot_store()
+    if not store:
+        raise RuntimeError("Archiving partitions requires an AP_SNAPSHOT_STORE")
+
+    current = get_partition(cursor, partition.name)
+    if not current or current.attached:
+        raise RuntimeError(f"{partition.name} must be detached before archiving")
+
+    # Compress into a temporary file so we don't hold the uncompressed
+    # partition in memory
+    with tempfile.TemporaryFile() as fileobj:
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as gzip_file:
+            cursor.copy_expert(
+                f"COPY {partition.name} TO STDOUT WITH CSV HEADER", gzip_file
+            )
+
+        fileobj.seek(0)
+        store.write(archive_name(partition), fileobj.read())
+
+    cursor.execute(f"DROP TABLE {partition.name}")
+    logging.info(f"Archived {partition.name} to {archive_name(partition)}")
+
+
+def attach_partition(cursor, name: str) -> None:
+    """
+    Attaches a detached partition, restoring it from the snapshot store first
+    if it was archived
+    """
+    partition = get_partition(cursor, name)
+    if partition and partition.attached:
+        logging.info(f"{name} is already attached")
+        return
+
+    if not partition:
+        partition = parse_partition_name(name)
+        if not partition:
+            raise RuntimeError(f"Not an ap_result partition: {name}")
+
+        store = get_snapshot_store()
+        content = store.read(archive_name(partition)) if store else None
+        if not content:
+            raise RuntimeError(f"No archive for {name}")
+
+        cursor.execute(f"CREATE TABLE {name} (LIKE ap_result INCLUDING DEFAULTS)")
+        with gzip.GzipFile(fileobj=io.BytesIO(content)) as gzip_file:
+            cursor.copy_expert(f"COPY {name} FROM STDIN WITH CSV HEADER", gzip_file)
+        logging.info(f"Restored {name} from {archive_name(partition)}")
+
+    cursor.execute(
+        f"ALTER TABLE ap_result ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+        [partition.start, partition.end],
+    )
+    logging.info(f"Attached {name}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Manage the ap_result partitions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the partitions")
+    subparsers.add_parser("create", help="Create partitions for the next ingests")
+    for command in ["detach", "archive"]:
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument(
+            "names", nargs="*", help="Partitions to process (default: all retired)"
+        )
+        subparser.add_argument(
+            "--force", action="store_true", help="Skip the retention check"
+        )
+    subparser = subparsers.add_parser("attach")
+    subparser.add_argument("names", nargs="+")
+    args = parser.parse_args()
+
+    # Each partition is handled in its own transaction, so we don't hold locks
+    # on ap_result for longer than we need to
+    with get_cursor() as cursor:
+        partitions = list_partitions(cursor)
+        retention_bound = load_retention_bound(cursor)
+
+    if args.command == "list":
+        for partition in partitions:
+            status = "attached" if partition.attached else "detached"
+            if is_retired(partition, retention_bound):
+                status += ", retired"
+            print(
+                f"{partition.name}\tingest_id {partition.start}-{partition.end - 1}\t{partition.size_bytes // 1024 // 1024}MB\t{status}"
+            )
+    elif args.command == "create":
+        with get_cursor() as cursor:
+            ensure_partitions(cursor)
+    elif args.command in ("detach", "archive"):
+        if args.names:
+            by_name = {partition.name: partition for partition in partitions}
+            missing = set(args.names) - set(by_name)
+            if missing:
+                raise RuntimeError(f"No such partitions: {', '.join(sorted(missing))}")
+            selected = [by_name[name] for name in args.names]
+        else:
+            selected = [
+                partition
+                for partition in partitions
+                if is_retired(partition, retention_bound)
+            ]
+
+        for partition in selected:
+            # Detaching locks ap_result, so we commit that before we start
+            # copying the partition
+            with get_cursor() as cursor:
+                detach_partition(cursor, partition, args.force)
+
+            if args.command == "archive":
+                with get_cursor() as cursor:
+                    archive_partition(cursor, partition._replace(attached=False))
+    elif args.command == "attach":
+        for name in args.names:
+            with get_cursor() as cursor:
+                attach_partition(cursor, name)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    main()
@@ -0,0 +1,203 @@
+from datetime import timedelta
+
+import psycopg2
+import psycopg2.extras
+import pytest
+
+from ..export.query_plans_test import EXPLAIN_TEST_POSTGRES_URL, INIT_SQL_PATH
+from . import partitions
+from .partitions import (
+    Partition,
+    archive_name,
+    archive_partition,
+    attach_partition,
+    detach_partition,
+    ensure_partitions,
+    get_partition,
+    is_retired,
+    list_partitions,
+    load_retention_bound,
+    parse_partition_name,
+)
+from .snapshots import LocalSnapshotStore
+
+
+def test_parse_partition_name():
+    assert parse_partition_name("ap_result_1_289") == Partition(
+        name="ap_result_1_289", start=1, end=289, attached=False, size_bytes=0
+    )
+    assert parse_partition_name("ap_result_latest") is None
+    assert parse_partition_name("ap_result_incoming") is None
+
+
+def test_is_retired():
+    partition = parse_partition_name("ap_result_289_577")
+    assert partition
+
+    assert is_retired(partition, 577)
+    assert is_retired(partition, 1000)
+    assert not is_retired(partition, 576)
+
+    # Nothing is retired if we don't have any full snapshots or waypoints yet
+    assert not is_retired(partition, None)
+
+
+# The rest of these check the partition lifecycle against a scratch schema in
+# the same local Postgres as query_plans_test. They're skipped unless
+# EXPLAIN_TEST_POSTGRES_URL is set.
+SCHEMA = "partitions_test"
+
+requires_postgres = pytest.mark.skipif(
+    not EXPLAIN_TEST_POSTGRES_URL, reason="EXPLAIN_TEST_POSTGRES_URL is not set"
+)
+
+
+@pytest.fixture
+def cursor():
+    conn = psycopg2.connect(
+        EXPLAIN_TEST_POSTGRES_URL, cursor_factory=psycopg2.extras.NamedTupleCursor
+    )
+    conn.autocommit = True
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+            cursor.execute(f"SET search_path TO {SCHEMA}")
+
+            with open(INIT_SQL_PATH, "r") as f:
+                cursor.execute(f.read())
+
+            yield cursor
+
+            cursor.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    finally:
+        conn.close()
+
+
+def use_partition_size(cursor, mocker, size):
+    """
+    Replaces the (empty) partitions init.sql created with ones of size ingests
+    """
+    mocker.patch.object(partitions, "AP_RESULT_PARTITION_SIZE", size)
+    for partition in list_partitions(cursor):
+        cursor.execute(f"DROP TABLE {partition.name}")
+    ensure_partitions(cursor)
+
+
+def add_ingests(cursor, n, age, full_every=3):
+    """
+    Adds n ingests from age ago, 5 minutes apart, each with a result, and a
+    full snapshot every full_every ingests
+    """
+    cursor.execute("SELECT COALESCE(MAX(ingest_id), 0) AS ingest_id FROM ingest_run")
+    first = cursor.fetchone().ingest_id + 1
+
+    for i in range(n):
+        ensure_partitions(cursor)
+        cursor.execute(
+            """
+            INSERT INTO ingest_run (ingest_dt, ap_result_mode)
+            VALUES (now() - %s, %s)
+            RETURNING ingest_id
+            """,
+            [
+                age - i * timedelta(minutes=5),
+                "full" if i % full_every == 0 else "delta",
+            ],
+        )
+        ingest_id = cursor.fetchone().ingest_id
+        cursor.execute(
+            "INSERT INTO ap_result (ingest_id, elex_id, votecount) VALUES (%s, 'MA-1', %s)",
+            [ingest_id, ingest_id],
+        )
+
+    return first
+
+
+def stored_ingest_ids(cursor):
+    cursor.execute("SELECT ingest_id FROM ap_result ORDER BY ingest_id")
+    return [record.ingest_id for record in cursor]
+
+
+@requires_postgres
+def test_ensure_partitions(cursor, mocker):
+    use_partition_size(cursor, mocker, 10)
+    add_ingests(cursor, 25, timedelta(hours=1))
+
+    # The partitions are contiguous, and go past the next ingest
+    current = list_partitions(cursor)
+    assert all(partition.attached for partition in current)
+    assert [partition.start for partition in current[1:]] == [
+        partition.end for partition in current[:-1]
+    ]
+    assert [partition.start for partition in current] == [1, 11, 21, 31]
+
+    # Calling it again doesn't add any more
+    ensure_partitions(cursor)
+    assert list_partitions(cursor) == current
+
+
+@requires_postgres
+def test_load_retention_bound(cursor, mocker):
+    mocker.patch.object(partitions, "AP_RESULT_RETENTION", timedelta(hours=24))
+
+    # Nothing is retired until there's a full snapshot
+    add_ingests(cursor, 2, timedelta(days=2), full_every=1000)
+    cursor.execute("UPDATE ingest_run SET ap_result_mode = 'delta'")
+    assert load_retention_bound(cursor) is None
+
+    # Ingests from within the retention are kept, even though they're older
+    # than the last full snapshot
+    add_ingests(cursor, 3, timedelta(days=2))
+    recent = add_ingests(cursor, 6, timedelta(hours=1))
+    assert load_retention_bound(cursor) == recent
+
+    # And the last full snapshot is kept, even if it's older than that
+    cursor.execute(
+        "UPDATE ingest_run SET ap_result_mode = 'delta' WHERE ingest_id >= %s", [recent]
+    )
+    assert load_retention_bound(cursor) == recent - 3
+
+
+@requires_postgres
+def test_partition_lifecycle(cursor, mocker, tmp_path):
+    use_partition_size(cursor, mocker, 10)
+    mocker.patch.object(partitions, "AP_RESULT_RETENTION", timedelta(hours=24))
+    mocker.patch.object(
+        partitions, "get_snapshot_store", return_value=LocalSnapshotStore(tmp_path)
+    )
+
+    add_ingests(cursor, 12, timedelta(days=2))
+    add_ingests(cursor, 3, timedelta(hours=1))
+    ingest_ids = stored_ingest_ids(cursor)
+
+    old, recent = list_partitions(cursor)[:2]
+    assert (old.name, recent.name) == ("ap_result_1_11", "ap_result_11_21")
+    retention_bound = load_retention_bound(cursor)
+    assert is_retired(old, retention_bound)
+    assert not is_retired(recent, retention_bound)
+
+    # We can't detach a partition the exports might need, without --force
+    with pytest.raises(RuntimeError):
+        detach_partition(cursor, recent)
+
+    detach_partition(cursor, old)
+    assert get_partition(cursor, old.name) == old._replace(attached=False)
+    assert stored_ingest_ids(cursor) == ingest_ids[10:]
+
+    # Archiving drops the detached table, and attaching restores it
+    archive_partition(cursor, old._replace(attached=False))
+    assert get_partition(cursor, old.name) is None
+    assert (tmp_path / archive_name(old)).exists()
+
+    attach_partition(cursor, old.name)
+    assert get_partition(cursor, old.name).attached
+    assert stored_ingest_ids(cursor) == ingest_ids
+
+    # Attaching an attached partition does nothing
+    attach_partition(cursor, old.name)
+
+    # We can only archive detached partitions
+    with pytest.raises(RuntimeError):
+        archive_partition(cursor, recent)
@@ -1,17 +1,23 @@
 import logging
 
-from ..enip_common.pg import get_cursor
+from ..enip_common.config import SAVE_AP_RESULT_DELTAS
+from ..enip_common.pg import bulk_insert, get_cursor
 from ..enip_common.states import PRESIDENTIAL_REPORTING_UNITS, SENATE_RACES
 from .apapi import ingest_ap
 from .ingest_run import insert_ingest_run
+from .partitions import ensure_partitions
+from .snapshots import (
+    SnapshotWriter,
+    get_snapshot_store,
+    read_latest_snapshot,
+    write_snapshot,
+)
 
 SAVE_WAYPOINT = "waypoint_15_dt"
 
 
-def _calls_update_stmt(table):
+def _calls_on_conflict(table):
     return f"""
-    INSERT INTO {table} (state, ap_call, ap_called_at)
-    VALUES (%s, %s, NOW())
     ON CONFLICT (state) DO UPDATE
     SET (ap_call, ap_called_at) = (
         EXCLUDED.ap_call,
@@ -24,6 +30,18 @@ def _calls_update_stmt(table):
     """
 
 
+def _update_calls(cursor, table, rows):
+    # rows are (state, ap_call), sorted by state
+    bulk_insert(
+        cursor,
+        table,
+        ["state", "ap_call", "ap_called_at"],
+        rows,
+        on_conflict=_calls_on_conflict(table),
+        template="(%s, %s, NOW())",
+    )
+
+
 def update_senate_calls(cursor, ingest_data):
     def extract_state(record):
         if record.statepostal == "GA" and record.seatnum == 2:
@@ -31,13 +49,13 @@ def update_senate_calls(cursor, ingest_data):
         return record.statepostal
 
     winners = {state: None for state in SENATE_RACES}
-    for record in ingest_data:
-        if record.officeid == "S" and record.level == "state" and record.winner:
+    for record in ingest_data.where(officeid="S", level="state"):
+        if record.winner:
             winners[extract_state(record)] = record.party
 
     rows = [(k, v) for k, v in winners.items()]
     rows.sort(key=lambda tup: tup[0])
-    cursor.executemany(_calls_update_stmt("senate_calls"), rows)
+    _update_calls(cursor, "senate_calls", rows)
 
 
 def update_president_calls(cursor, ingest_data):
@@ -55,7 +73,7 @@ def update_president_calls(cursor, ingest_data):
         return record.statepostal
 
     winners = {state: None for state in PRESIDENTIAL_REPORTING_UNITS}
-    for record in ingest_data:
+    for record in ingest_data.where(officeid="P"):
         # For state results, look at the "winner" property to determine who won
         if record.officeid == "P" and record.level == "state" and record.winner:
             winners[extract_state(record)] = record.party
@@ -73,18 +91,46 @@ def update_president_calls(cursor, ingest_data):
 
     rows = [(k, v) for k, v in winners.items()]
     rows.sort(key=lambda tup: tup[0])
-    cursor.executemany(_calls_update_stmt("president_calls"), rows)
+    _update_calls(cursor, "president_calls", rows)
 
 
 def ingest_all(force_save=False):
+    # If we have somewhere to put it, write a snapshot of all the AP data we
+    # fetch so the state exports can reuse it
+    snapshot_store = get_snapshot_store()
+    snapshot = SnapshotWriter() if snapshot_store else None
+
+    # Creating ap_result partitions locks the table, so do it in its own
+    # transaction rather than holding the lock for the whole ingest
+    with get_cursor() as cursor:
+        ensure_partitions(cursor)
+
     with get_cursor() as cursor:
         # Create a record for this ingest run
         ingest_id, ingest_dt, waypoint_names = insert_ingest_run(cursor)
         logging.info(f"Ingest ID: {ingest_id}")
 
-        # Fetch the AP results
-        save_to_db = force_save or ("waypoint_15_dt" in waypoint_names)
-        ingest_data = ingest_ap(cursor, ingest_id, save_to_db=save_to_db)
+        # Fetch the AP results. We save a full snapshot on each waypoint, and
+        # (if enabled) just the changed rows for every other ingest.
+        if force_save or (SAVE_WAYPOINT in waypoint_names):
+            ap_result_mode = "full"
+        elif SAVE_AP_RESULT_DELTAS:
+            ap_result_mode = "delta"
+        else:
+            ap_result_mode = None
+
+        ingest_data = ingest_ap(
+            cursor,
+            ingest_id,
+            save_to_db=ap_result_mode is not None,
+            deltas_only=ap_result_mode == "delta",
+            snapshot=snapshot,
+        )
+        cursor.execute(
+            "UPDATE ingest_run SET ap_result_mode = %s WHERE ingest_id = %s",
+            [ap_result_mode, ingest_id],
+        )
+
         # keep update order the same as calls_gsheet_run:
         # Senate then President, sorted by state
         logging.info("Updating senate calls in db")
@@ -93,9 +139,43 @@ def ingest_all(force_save=False):
         update_president_calls(cursor, ingest_data)
         logging.info("Comitting...")
 
+    if snapshot:
+        try:
+            write_snapshot(snapshot_store, ingest_id, ingest_dt, snapshot.close())
+        except Exception:
+            # The state exports will fall back to fetching from the AP
+            logging.exception("Failed to write AP snapshot")
+
     logging.info(f"All done! Completed ingest {ingest_id} at {ingest_dt}")
     return ingest_id, ingest_dt, ingest_data
 
 
+def ingest_states():
+    """
+    Returns (ingest_id, records) with the county-level AP data for the state
+    exports. We reuse the snapshot from the latest national run if it's recent
+    enough, and ingest_id is the ingest it came from. Otherwise we fetch the
+    data from the AP without saving it, and ingest_id is -1.
+    """
+    snapshot_store = get_snapshot_store()
+    snapshot = (
+        read_latest_snapshot(snapshot_store, return_levels={"county"})
+        if snapshot_store
+        else None
+    )
+    if snapshot:
+        return snapshot.ingest_id, snapshot.records
+
+    ingest_id = -1
+    ap_data = ingest_ap(
+        cursor=None,
+        ingest_id=ingest_id,
+        save_to_db=False,
+        return_levels={"county"},
+        feed_name="states",
+    )
+    return ingest_id, ap_data
+
+
 if __name__ == "__main__":
     ingest_all(force_save=True)
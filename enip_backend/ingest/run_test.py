@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+
+from . import run
+from .snapshots import LocalSnapshotStore, SnapshotWriter, write_snapshot
+from .snapshots_test import RECORDS
+
+
+def test_ingest_states_reuses_snapshot(mocker, tmp_path):
+    store = LocalSnapshotStore(str(tmp_path))
+    snapshot = SnapshotWriter()
+    for record in RECORDS:
+        snapshot.write(record)
+    write_snapshot(store, 12, datetime.now(tz=timezone.utc), snapshot.close())
+
+    mocker.patch.object(run, "get_snapshot_store", return_value=store)
+    ingest_ap = mocker.patch.object(run, "ingest_ap")
+
+    # We get the snapshot's counties, and the ingest they came from
+    ingest_id, ap_data = run.ingest_states()
+    assert ingest_id == 12
+    assert list(ap_data) == [RECORDS[1], RECORDS[3]]
+    ingest_ap.assert_not_called()
+
+
+def test_ingest_states_without_snapshot(mocker, tmp_path):
+    mocker.patch.object(
+        run, "get_snapshot_store", return_value=LocalSnapshotStore(str(tmp_path))
+    )
+    ingest_ap = mocker.patch.object(run, "ingest_ap", return_value=RECORDS)
+
+    assert run.ingest_states() == (-1, RECORDS)
+    ingest_ap.assert_called_once_with(
+        cursor=None,
+        ingest_id=-1,
+        save_to_db=False,
+        return_levels={"county"},
+        feed_name="states",
+    )
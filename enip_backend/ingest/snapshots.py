@@ -0,0 +1,261 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import os.path
+import re
+import tempfile
+from datetime import datetime, timezone
+from typing import Iterable, List, NamedTuple, Optional, Set
+
+from ddtrace import tracer
+
+from ..enip_common import s3
+from ..enip_common.config import (
+    AP_SNAPSHOT_DIR,
+    AP_SNAPSHOT_MAX_AGE,
+    AP_SNAPSHOT_RETENTION,
+    AP_SNAPSHOT_STORE,
+)
+from ..export.helpers import SQLRecord
+from ..export.table import IngestTable
+
+# Snapshots of the AP data, as fetched by the national run, that the state
+# exports can reuse instead of making their own AP requests. Each snapshot is
+# a gzipped CSV of SQLRecords for every level (including counties), and
+# latest.json points at the most recent one. We only keep the latest
+# AP_SNAPSHOT_RETENTION of them.
+LATEST_NAME = "latest.json"
+SNAPSHOT_NAME_RE = re.compile(r"^(\d+)\.csv\.gz$")
+
+Snapshot = NamedTuple(
+    "Snapshot",
+    [("ingest_id", int), ("ingest_dt", datetime), ("records", IngestTable)],
+)
+
+
+class LocalSnapshotStore:
+    """
+    Stores snapshots in a directory on the local filesystem
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def write(self, name: str, content: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write to a temporary file and rename so readers never see a partial
+        # snapshot
+        path = os.path.join(self.directory, name)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def list(self) -> List[str]:
+        try:
+            return os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+    def delete(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+class S3SnapshotStore:
+    """
+    Stores snapshots (privately) in S3, under ap_snapshots/
+    """
+
+    def write(self, name: str, content: bytes) -> None:
+        s3.write_bytes(
+            f"ap_snapshots/{name}",
+            content,
+            content_type="application/octet-stream",
+            acl="private",
+            cache_control="no-store",
+        )
+
+    def read(self, name: str) -> Optional[bytes]:
+        return s3.read_bytes(f"ap_snapshots/{name}")
+
+    def list(self) -> List[str]:
+        return s3.list_names("ap_snapshots/")
+
+    def delete(self, name: str) -> None:
+        s3.delete(f"ap_snapshots/{name}")
+
+
+def get_snapshot_store():
+    if AP_SNAPSHOT_STORE == "s3":
+        return S3SnapshotStore()
+    elif AP_SNAPSHOT_STORE == "local":
+        return LocalSnapshotStore(AP_SNAPSHOT_DIR)
+    elif AP_SNAPSHOT_STORE == "none":
+        return None
+    else:
+        raise RuntimeError(f"Invalid AP_SNAPSHOT_STORE: {AP_SNAPSHOT_STORE}")
+
+
+class SnapshotWriter:
+    """
+    Writes SQLRecords to a gzipped CSV (in a temporary file, so we don't hold
+    the snapshot in memory while we're building it)
+    """
+
+    def __init__(self) -> None:
+        self.fileobj = tempfile.TemporaryFile()
+        self.gzip_file = gzip.GzipFile(fileobj=self.fileobj, mode="wb")
+        self.text_file = io.TextIOWrapper(self.gzip_file, encoding="utf-8")
+        self.writer = csv.writer(self.text_file)
+        self.writer.writerow(SQLRecord._fields)
+
+    def write(self, record: SQLRecord) -> None:
+        self.writer.writerow(record)
+
+    def close(self) -> bytes:
+        """
+        Finishes writing the snapshot and returns its contents
+        """
+        self.text_file.flush()
+        self.text_file.detach()
+        self.gzip_file.close()
+
+        self.fileobj.seek(0)
+        content = self.fileobj.read()
+        self.fileobj.close()
+        return content
+
+
+def parse_record(row: Iterable[str]) -> SQLRecord:
+    """
+    Parses a row of a snapshot (as SnapshotWriter wrote it) back into a
+    SQLRecord
+    """
+    (
+        ingest_id,
+        elex_id,
+        statepostal,
+        fipscode,
+        level,
+        reportingunitname,
+        officeid,
+        seatnum,
+        party,
+        first,
+        last,
+        electtotal,
+        electwon,
+        votecount,
+        votepct,
+        winner,
+    ) = row
+    return SQLRecord(
+        ingest_id=int(ingest_id),
+        elex_id=elex_id,
+        statepostal=statepostal,
+        fipscode=fipscode,
+        level=level,
+        reportingunitname=reportingunitname or None,
+        officeid=officeid,
+        seatnum=int(seatnum) if seatnum else None,
+        party=party,
+        first=first,
+        last=last,
+        electtotal=int(electtotal),
+        electwon=int(electwon),
+        votecount=int(votecount),
+        votepct=float(votepct),
+        winner=winner == "True",
+    )
+
+
+def prune_snapshots(store, retention: int = AP_SNAPSHOT_RETENTION) -> None:
+    """
+    Deletes all but the latest retention AP snapshots (leaving latest.json and
+    the historicals snapshots alone)
+    """
+    if retention <= 0:
+        return
+
+    ingest_ids = []
+    for name in store.list():
+        match = SNAPSHOT_NAME_RE.match(name)
+        if match:
+            ingest_ids.append(int(match.group(1)))
+
+    for ingest_id in sorted(ingest_ids)[:-retention]:
+        store.delete(f"{ingest_id}.csv.gz")
+
+
+@tracer.wrap("enip.ingest.snapshots.write_snapshot")
+def write_snapshot(store, ingest_id: int, ingest_dt: datetime, content: bytes) -> None:
+    name = f"{ingest_id}.csv.gz"
+    store.write(name, content)
+    store.write(
+        LATEST_NAME,
+        json.dumps(
+            {"ingestId": ingest_id, "ingestDt": ingest_dt.isoformat(), "name": name}
+        ).encode(),
+    )
+    logging.info(f"Wrote AP snapshot {name} ({len(content)} bytes)")
+
+    try:
+        prune_snapshots(store)
+    except Exception:
+        logging.exception("Failed to prune the old AP snapshots")
+
+
+@tracer.wrap("enip.ingest.snapshots.read_latest_snapshot")
+def read_latest_snapshot(
+    store, return_levels: Set[str], max_age=AP_SNAPSHOT_MAX_AGE
+) -> Optional[Snapshot]:
+    """
+    Reads the records for return_levels from the latest snapshot. Returns None
+    if there is no snapshot newer than max_age.
+    """
+    latest_content = store.read(LATEST_NAME)
+    if not latest_content:
+        logging.info("No AP snapshot available")
+        return None
+
+    latest = json.loads(latest_content)
+    ingest_dt = datetime.fromisoformat(latest["ingestDt"])
+    age = datetime.now(tz=timezone.utc) - ingest_dt
+    if age > max_age:
+        logging.info(f"Latest AP snapshot {latest['name']} is too old ({age})")
+        return None
+
+    content = store.read(latest["name"])
+    if not content:
+        logging.warning(f"AP snapshot {latest['name']} is missing")
+        return None
+
+    records = IngestTable()
+    reader = csv.reader(
+        io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(content)), encoding="utf-8")
+    )
+    next(reader)
+    for row in reader:
+        record = parse_record(row)
+        if record.level in return_levels:
+            records.append(record)
+
+    logging.info(
+        f"Read {len(records)} records from AP snapshot {latest['name']} (age {age})"
+    )
+    return Snapshot(
+        ingest_id=int(latest["ingestId"]), ingest_dt=ingest_dt, records=records
+    )
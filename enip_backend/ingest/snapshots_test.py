@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta, timezone
+
+from ..export.testing import sql_record
+from .snapshots import (
+    LocalSnapshotStore,
+    SnapshotWriter,
+    parse_record,
+    prune_snapshots,
+    read_latest_snapshot,
+    write_snapshot,
+)
+
+
+SNAPSHOT_RECORD = sql_record(
+    ingest_id=12,
+    statepostal="ME",
+    last="Biden, Jr.",
+    electtotal=4,
+    electwon=2,
+    votecount=12345,
+    votepct=0.234,
+)
+
+
+RECORDS = [
+    SNAPSHOT_RECORD._replace(
+        elex_id="test_state", level="state", fipscode="None", winner=True
+    ),
+    SNAPSHOT_RECORD._replace(
+        elex_id="test_county", level="county", fipscode="23001", seatnum=2
+    ),
+    SNAPSHOT_RECORD._replace(
+        elex_id="test_district",
+        level="district",
+        fipscode="None",
+        reportingunitname="District 1",
+    ),
+    SNAPSHOT_RECORD._replace(elex_id="test_county", level="county", fipscode="23003"),
+]
+
+
+def write(store, ingest_dt, ingest_id=12):
+    snapshot = SnapshotWriter()
+    for r in RECORDS:
+        snapshot.write(r)
+    write_snapshot(store, ingest_id, ingest_dt, snapshot.close())
+
+
+def test_round_trip(tmp_path):
+    store = LocalSnapshotStore(str(tmp_path))
+    ingest_dt = datetime.now(tz=timezone.utc)
+    write(store, ingest_dt)
+
+    snapshot = read_latest_snapshot(store, return_levels={"county"})
+    assert snapshot.ingest_id == 12
+    assert snapshot.ingest_dt == ingest_dt
+    assert list(snapshot.records) == [RECORDS[1], RECORDS[3]]
+
+    snapshot = read_latest_snapshot(store, return_levels={"state", "district"})
+    assert list(snapshot.records) == [RECORDS[0], RECORDS[2]]
+
+
+def test_stale_snapshot(tmp_path):
+    store = LocalSnapshotStore(str(tmp_path))
+    write(store, datetime.now(tz=timezone.utc) - timedelta(minutes=20))
+
+    assert (
+        read_latest_snapshot(
+            store, return_levels={"county"}, max_age=timedelta(minutes=10)
+        )
+        is None
+    )
+
+
+def test_no_snapshot(tmp_path):
+    store = LocalSnapshotStore(str(tmp_path / "empty"))
+    assert read_latest_snapshot(store, return_levels={"county"}) is None
+
+
+def test_parse_record_types():
+    row = ["12", "test_county", "ME", "23001", "county", "", "P", "2", "Dem"]
+    row += ["Joe", "Biden, Jr.", "4", "2", "12345", "0.234", "False"]
+    record = parse_record(row)
+
+    assert record == RECORDS[1]
+    assert [type(value) for value in record] == [type(value) for value in RECORDS[1]]
+
+
+def test_prune_snapshots(tmp_path):
+    store = LocalSnapshotStore(str(tmp_path))
+    store.write("historicals_0123456789abcdef.json.gz", b"{}")
+
+    ingest_dt = datetime.now(tz=timezone.utc)
+    for ingest_id in [8, 9, 10, 11, 12]:
+        write(store, ingest_dt, ingest_id)
+    prune_snapshots(store, retention=2)
+
+    # Only the latest snapshots are left, and the latest one is still readable
+    assert sorted(store.list()) == [
+        "11.csv.gz",
+        "12.csv.gz",
+        "historicals_0123456789abcdef.json.gz",
+        "latest.json",
+    ]
+    snapshot = read_latest_snapshot(store, return_levels={"county"})
+    assert snapshot.ingest_id == 12
+    assert list(snapshot.records) == [RECORDS[1], RECORDS[3]]
+
+    # Without retention, we keep them all
+    write(store, ingest_dt, 13)
+    prune_snapshots(store, retention=0)
+    assert "11.csv.gz" in store.list()
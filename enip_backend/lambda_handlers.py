@@ -9,8 +9,7 @@ from .calls_gsheet_sync.run import sync_calls_gsheet
 from .comments_gsheet_sync.run import sync_comments_gsheet
 from .enip_common import config
 from .export.run import export_all_states, export_national
-from .ingest.apapi import ingest_ap
-from .ingest.run import ingest_all
+from .ingest.run import ingest_all, ingest_states
 
 logging.getLogger().setLevel(logging.INFO)
 patch_all()
@@ -36,12 +35,13 @@ def run(event, context):
 def run_states(event, context):
     with tracer.trace("enip.run_states"):
         with tracer.trace("enip.run_states.ingest"):
+            # The AP data may come from the latest national run's snapshot,
+            # but the historicals and the exported files are still as of this
+            # run
             ingest_dt = datetime.now(tz=timezone.utc)
-            ap_data = ingest_ap(
-                cursor=None, ingest_id=-1, save_to_db=False, return_levels={"county"}
-            )
+            ingest_id, ap_data = ingest_states()
         with tracer.trace("enip.run_states.export"):
-            export_all_states(ap_data, ingest_dt)
+            export_all_states(ap_data, ingest_dt, ingest_id)
 
 
 def run_sync_calls_gsheet(event, context):